@@ -1,10 +1,47 @@
 import asyncio
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
 import signal
 import sys
+from time import monotonic
 import traceback
 
+from loopmonitor import LoopMonitor
+
+class RateLimitFilter(logging.Filter):
+    # lets through at most `limit` records per `interval` seconds from each
+    # logging call site at or below `level`, so per-message debug logs
+    # don't grow with message volume. the next record let through from a
+    # call site says how many were dropped
+    def __init__(self, limit, interval=1.0, level=logging.DEBUG):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.level = level
+        # (pathname, lineno) -> [window start, records in window, dropped]
+        self.sites = {}
+
+    def filter(self, record):
+        if(record.levelno > self.level or not self.limit):
+            return True
+        now = monotonic()
+        site = self.sites.get((record.pathname, record.lineno))
+        if(site is None):
+            site = self.sites[(record.pathname, record.lineno)] = [now, 0, 0]
+        elif(now - site[0] >= self.interval):
+            site[0] = now
+            site[1] = 0
+        if(site[1] >= self.limit):
+            site[2] += 1
+            return False
+        site[1] += 1
+        if(site[2]):
+            record.msg = f'{record.getMessage()} [{site[2]} similar suppressed]'
+            record.args = None
+            site[2] = 0
+        return True
+
 class AsyncLoop:
     LVL_STR = {
         logging.DEBUG: 'DBG',
@@ -13,16 +50,40 @@ class AsyncLoop:
         logging.ERROR: 'ERR',
         logging.CRITICAL: 'CRIT',
         }
-
-    def __init__(self, id='asyncloop', log_levels=[logging.NOTSET]):
+    # subclasses that recover from dropped connections themselves turn this off
+    SHUTDOWN_ON_CONNECTION_ERROR = True
+    # seconds shutdown gives drain() before cancelling whatever is left
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, id='asyncloop', log_levels=[logging.NOTSET],
+                 log_rate_limit=0, event_loop='asyncio',
+                 lag_interval=LoopMonitor.LAG_INTERVAL,
+                 slow_callback=LoopMonitor.SLOW_CALLBACK):
         self.id = id
         self.lgr = logging.getLogger(id)
         # by default log everything
         if(log_levels[0] == logging.NOTSET):
             self.lgr.setLevel(logging.DEBUG)
+        # the handlers below write to stdout and disk, so they run on a
+        # listener thread and the loop only puts records on a queue
+        self.log_handlers = []
+        self.log_listener = None
+        log_queue = SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        if(log_rate_limit):
+            queue_handler.addFilter(RateLimitFilter(log_rate_limit))
+        self.lgr.addHandler(queue_handler)
         for log_level in log_levels:
             self.setup_logger(log_level)
-        self.loop = asyncio.get_event_loop()
+        self.log_listener = QueueListener(log_queue, *self.log_handlers,
+                                          respect_handler_level=True)
+        self.log_listener.start()
+        self.loop = LoopMonitor.new_event_loop(event_loop)
+        if(event_loop == 'uvloop' and LoopMonitor.get_name(self.loop) != 'uvloop'):
+            self.lgr.warning('uvloop is not installed, using the asyncio event loop')
+        # reports loop lag and callbacks blocking the loop to on_loop_lag
+        # and on_slow_callback
+        self.monitor = LoopMonitor(self, lag_interval, slow_callback)
         signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
         for s in signals:
             self.loop.add_signal_handler(
@@ -30,6 +91,8 @@ class AsyncLoop:
 
         self.loop.set_exception_handler(self.custom_exception_handler)
         self.tasks = []
+        self.shutdown_timeout = self.SHUTDOWN_TIMEOUT
+        self.shutting_down = False
 
     def setup_logger(self, log_level, mb_limit=10, log_limit=10):
         log_format = "%(asctime)s %(levelname)s [%(name)s.%(funcName)s()] %(message)s [%(filename)s:%(lineno)d]"
@@ -49,13 +112,47 @@ class AsyncLoop:
 
         handler.setLevel(log_level)
         handler.setFormatter(formatter)
-        self.lgr.addHandler(handler)
+        self.log_handlers.append(handler)
+        if(self.log_listener):
+            self.log_listener.handlers = tuple(self.log_handlers)
+
+    def flush_logs(self):
+        # blocks until everything logged so far has been written out
+        if(self.log_listener):
+            self.log_listener.stop()
+            self.log_listener.start()
+
+    def on_loop_lag(self, lag):
+        # subclasses can record every sample, only bad lag is logged here
+        if(lag >= (self.monitor.slow_callback or LoopMonitor.LAG_WARNING)):
+            self.lgr.warning(f'event loop is running {lag*1000:.1f} ms behind')
+
+    def on_slow_callback(self, name, took):
+        self.lgr.warning(f'{name} blocked the event loop for {took*1000:.1f} ms')
+
+    async def drain(self, deadline):
+        # subclasses stop taking new work here and finish what they have
+        # by deadline (loop time), everything still running after is cancelled
+        pass
 
     async def shutdown(self, signal=None):
         sig_name = 'request to shutdown'
         if(signal):
             sig_name = signal.name
-        self.lgr.debug(f"Received {sig_name}, attempting to exit gracefullly")
+        if(self.shutting_down):
+            # cancels the first shutdown along with everything else
+            self.lgr.warning(f"Received {sig_name} while draining, exiting now")
+        else:
+            self.shutting_down = True
+            self.lgr.info(f"Received {sig_name}, draining for up to {self.shutdown_timeout}s")
+            try:
+                await asyncio.wait_for(self.drain(self.loop.time() + self.shutdown_timeout),
+                                       self.shutdown_timeout + 1)
+            except asyncio.TimeoutError:
+                self.lgr.error('draining did not finish in time')
+            except Exception as e:
+                self.lgr.exception(f'draining failed: {type(e).__name__}: {e}')
+        self.flush_logs()
 
         tasks = [t for t in asyncio.all_tasks() if t is not
                  asyncio.current_task() and not t.done() and not t.cancelled()]
@@ -73,8 +170,11 @@ class AsyncLoop:
 
         self.lgr.error(f'unhandled exception: {type(exception).__name__}: {exception}')
         if isinstance(exception, ConnectionError):
-            self.lgr.error('connection error, shutting down')
-            asyncio.create_task(self.shutdown())
+            if(self.SHUTDOWN_ON_CONNECTION_ERROR):
+                self.lgr.error('connection error, shutting down')
+                asyncio.create_task(self.shutdown())
+            else:
+                self.lgr.error('connection error, leaving recovery to the connection owner')
         elif isinstance(exception, asyncio.InvalidStateError):
             self.lgr.error('invalid state, shutting down')
             asyncio.create_task(self.shutdown())
@@ -83,6 +183,9 @@ class AsyncLoop:
 
     def run_loop(self):
         try:
+            self.monitor.install()
+            if(self.monitor.lag_interval > 0):
+                self.loop.create_task(self.monitor.run_loop())
             for task in self.tasks:
                 if(type(task) == dict):
                     self.loop.create_task(task['func'](*task['args']))
@@ -90,7 +193,10 @@ class AsyncLoop:
                     self.loop.create_task(task())
             self.loop.run_forever()
         finally:
+            self.monitor.uninstall()
             self.loop.close()
+            if(self.log_listener):
+                self.log_listener.stop()
 
 # async def testfunc(cls, a, b, c):
 #     while True:
@@ -0,0 +1,69 @@
+from os import makedirs
+from os.path import basename, join
+import re
+import shutil
+from uuid import uuid4
+
+class AttachmentTooLarge(Exception):
+    pass
+
+class AttachmentStore:
+    # bytes read from the request per write to disk
+    CHUNK_SIZE = 256 * 1024
+    # signal won't send anything bigger
+    MAX_SIZE = 100 * 1024 * 1024
+    MAX_FILES = 32
+
+    # uploads are streamed into a directory signal-cli can also see (a
+    # volume shared with the container), one directory per request, and
+    # signal-cli is given the paths as it sees them. nothing is kept in
+    # memory beyond one chunk, and disk writes happen off the loop
+    def __init__(self, caller, path, remote_path='', max_size=MAX_SIZE,
+                 max_files=MAX_FILES):
+        self.caller = caller
+        self.path = path
+        # where signal-cli finds self.path, if it is mounted elsewhere
+        self.remote_path = remote_path or path
+        self.max_size = max_size
+        self.max_files = max_files
+
+    @staticmethod
+    def safe_name(filename):
+        # the name recipients see, without any directories or oddities
+        name = re.sub(r'[^\w.\- ]', '_', basename(filename or '')).strip('. ')
+        return name or 'attachment'
+
+    def run(self, func, *args):
+        return self.caller.loop.run_in_executor(None, func, *args)
+
+    async def create(self):
+        # returns the name of a new, empty directory for one request
+        name = uuid4().hex
+        await self.run(makedirs, join(self.path, name))
+        return name
+
+    async def save(self, directory, part, index):
+        # streams a multipart body part to disk, returns the path to give
+        # signal-cli. each file gets its own subdirectory so two uploads
+        # with the same name keep it
+        name = self.safe_name(part.filename)
+        directory = join(directory, str(index))
+        await self.run(makedirs, join(self.path, directory))
+        f = await self.run(open, join(self.path, directory, name), 'wb')
+        try:
+            size = 0
+            while True:
+                chunk = await part.read_chunk(self.CHUNK_SIZE)
+                if(not chunk):
+                    break
+                size += len(chunk)
+                if(size > self.max_size):
+                    raise AttachmentTooLarge(f'{name} is larger than {self.max_size} bytes')
+                await self.run(f.write, chunk)
+        finally:
+            await self.run(f.close)
+        return join(self.remote_path, directory, name)
+
+    def remove(self, directory):
+        # can be awaited, or left to finish on its own
+        return self.run(shutil.rmtree, join(self.path, directory), True)
@@ -0,0 +1,605 @@
+import argparse
+import asyncio
+from copy import deepcopy
+from json import dumps as j_encode
+import logging
+from os.path import abspath
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+from fakesignalcli import FakeSignalCli, load_recording, make_envelope
+from eventrouter import EventRouter
+from jsoncodec import codec, JsonCodec
+from jsonlineframer import JsonLineFramer
+from receiptaggregator import ReceiptAggregator
+from sendscheduler import SendScheduler
+from signalevent import SignalEvent
+
+# one of each kind of line signal-cli sends us
+def make_samples():
+    msg = make_envelope(0, 'hello there')
+    samples = {'message': msg}
+
+    quote = deepcopy(msg)
+    quote['params']['envelope']['dataMessage']['quote'] = {
+        'id': 1664746930000, 'author': '+15551000001', 'text': 'hi'}
+    samples['quote'] = quote
+
+    reaction = deepcopy(msg)
+    dm = reaction['params']['envelope']['dataMessage']
+    dm['message'] = None
+    dm['reaction'] = {'emoji': '👍', 'targetAuthor': '+15551000001',
+                      'targetSentTimestamp': 1664746930000, 'isRemove': False}
+    samples['reaction'] = reaction
+
+    group = deepcopy(msg)
+    group['params']['envelope']['dataMessage']['groupInfo'] = {
+        'groupId': 'R2F0ZXdheSBncm91cCBpZA==', 'type': 'DELIVER'}
+    samples['group'] = group
+
+    attachment = deepcopy(msg)
+    attachment['params']['envelope']['dataMessage']['attachments'] = [{
+        'contentType': 'image/jpeg', 'filename': 'cat.jpg',
+        'id': 'aBcD1234.jpg', 'size': 123456}]
+    samples['attachment'] = attachment
+
+    receipt = deepcopy(msg)
+    env = receipt['params']['envelope']
+    del env['dataMessage']
+    env['receiptMessage'] = {'when': 1664746936057, 'isDelivery': True,
+                             'isRead': False, 'isViewed': False,
+                             'timestamps': [1664746930000]}
+    samples['receipt'] = receipt
+
+    typing = deepcopy(receipt)
+    env = typing['params']['envelope']
+    del env['receiptMessage']
+    env['typingMessage'] = {'action': 'STARTED', 'timestamp': 1664746936057}
+    samples['typing'] = typing
+
+    sync = deepcopy(receipt)
+    env = sync['params']['envelope']
+    del env['receiptMessage']
+    env['syncMessage'] = {'readMessages': [{'sender': '+15551000001',
+                                            'timestamp': 1664746930000}]}
+    samples['sync'] = sync
+
+    samples['result'] = {'jsonrpc': '2.0', 'id': 7, 'result': {
+        'timestamp': 1664746936057,
+        'results': [{'recipientAddress': {'number': '+15551000001'}, 'type': 'SUCCESS'}]}}
+    samples['error'] = {'jsonrpc': '2.0', 'id': 8, 'error': {
+        'code': -1, 'message': 'Failed to send message',
+        'data': {'response': {'results': [
+            {'recipientAddress': {'number': '+15551000001'}, 'type': 'UNREGISTERED_FAILURE'}]}}}}
+    return samples
+
+def make_stream(count, text='Ok'):
+    return b''.join((j_encode(make_envelope(i, text))+'\n').encode('utf-8')
+                    for i in range(count))
+
+def chunk_stream(stream, chunk_size):
+    return [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+def report(name, count, elapsed):
+    print(f'{name:<28} {count:>9} lines {elapsed*1000:>10.1f} ms {count/elapsed:>12.0f} lines/s')
+
+# the framing that SignalReceiveHandler.data_received used to do, kept here
+# so the new framer always has something to be measured against
+class LegacyFramer:
+    def __init__(self):
+        self.json_buffer = ''
+
+    def feed(self, data):
+        raw = data.decode()
+        if(raw[len(raw) - 1] != '\n'):
+            self.json_buffer += raw
+            return []
+        elif(self.json_buffer != ''):
+            raw = self.json_buffer + raw
+            self.json_buffer = ''
+        if(len(raw) <= 1):
+            return []
+        return [cmd for cmd in raw.split('\n') if cmd]
+
+def run_framer(framer, chunks):
+    count = 0
+    start = perf_counter()
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+    return count, perf_counter() - start
+
+def bench_framer(args):
+    # ascii text so the legacy framer does not trip over split characters
+    stream = make_stream(args.count)
+    for chunk_size in args.chunk_sizes:
+        chunks = chunk_stream(stream, chunk_size)
+        print(f'-- {len(stream)} bytes in {len(chunks)} chunks of {chunk_size} bytes')
+        report('JsonLineFramer', *run_framer(JsonLineFramer(), chunks))
+        if(not args.skip_legacy):
+            report('legacy str buffer', *run_framer(LegacyFramer(), chunks))
+
+def read_event(event):
+    # touch everything a handler might look at
+    return (event.type, event.subtype, event.id, event.sender, event.sender_name,
+            event.sender_uuid, event.recipient, event.timestamp, event.group_id,
+            event.has_message, event.has_reply, event.has_reaction,
+            event.has_attachment, event.message, event.re_timestamp, event.results)
+
+def bench_event(args):
+    count = args.count
+    noop = lambda *a: None
+    print(f'{"kind":<12} {"classify":>12} {"read all":>12} {"retained":>14}')
+    for kind, sample in make_samples().items():
+        start = perf_counter()
+        for i in range(count):
+            e = SignalEvent(sample, noop, noop)
+            e.get_type()
+            e.get_subtype()
+        classify = (perf_counter() - start) / count
+
+        start = perf_counter()
+        for i in range(count):
+            read_event(SignalEvent(sample, noop, noop))
+        read_all = (perf_counter() - start) / count
+
+        # memory held by the events themselves, the json is shared
+        tracemalloc.start()
+        events = [SignalEvent(sample, noop, noop) for i in range(count)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del events
+
+        print(f'{kind:<12} {classify*1e6:>9.2f} us {read_all*1e6:>9.2f} us '
+              f'{size/count:>8.0f} B/event')
+
+# what routing every event through a list of checks would cost, for
+# comparison with the indexed EventRouter
+class LinearRouter(EventRouter):
+    def __init__(self, caller):
+        super().__init__(caller)
+        self.linear = []
+
+    def add(self, handler, **kwargs):
+        route = super().add(handler, **kwargs)
+        self.linear.append(route)
+        return route
+
+    def match(self, event):
+        text = event.message if event.data is not None else ''
+        return [route for route in self.linear if route.matches(event, text)]
+
+def make_routes(router, count, regexes):
+    # mostly commands, a quarter for particular senders and a few regexes
+    noop = lambda event: None
+    for i in range(count):
+        if(i % 4 == 3):
+            router.add(noop, sender=f'+1666{1000000 + i}')
+        elif(i % 4 == 2 and i // 4 < regexes):
+            router.add(noop, regex=rf'\bkeyword{i}\b')
+        else:
+            router.add(noop, prefix=f'/cmd{i} ')
+
+def bench_router(args):
+    noop = lambda *a: None
+    samples = make_samples()
+    events = {
+        'command': SignalEvent(make_envelope(0, '/cmd0 some args'), noop, noop),
+        'no match': SignalEvent(samples['message'], noop, noop),
+        'receipt': SignalEvent(samples['receipt'], noop, noop),
+    }
+    print(f'{"handlers":>9} ' + ' '.join(f'{kind + " idx/lin":>22}' for kind in events))
+    for count in args.handlers:
+        indexed = EventRouter(None)
+        make_routes(indexed, count, args.regexes)
+        linear = LinearRouter(None)
+        make_routes(linear, count, args.regexes)
+        row = f'{count:>9} '
+        for kind, event in events.items():
+            took = time_per_call(lambda: indexed.match(event), args.count)
+            # the linear scan gets slow, fewer rounds are enough for it
+            took_linear = time_per_call(lambda: linear.match(event), max(args.count // count, 10))
+            row += f'{took*1e6:>9.2f} / {took_linear*1e6:>9.2f} us '
+        print(row)
+
+def time_per_call(func, count):
+    start = perf_counter()
+    for i in range(count):
+        func()
+    return (perf_counter() - start) / count
+
+def bench_codec(args):
+    count = args.count
+    account = '+12345678901'
+    recipient = '+15551000001'
+    samples = {kind: j_encode(sample).encode('utf-8')
+               for kind, sample in make_samples().items()}
+    # the dict + encode way the hot builders used to work, for comparison
+    dict_receipt = lambda: codec.encode({
+        "jsonrpc": "2.0", "method": "sendReceipt",
+        "params": {"account": account, "recipient": recipient,
+                   "targetTimestamp": 1664746936057}, "id": 42})
+    encoders = {
+        'make_message': lambda: SignalEvent.make_message(account, [recipient], 'hello there', msg_id=42),
+        'make_updateprofile': lambda: SignalEvent.make_updateprofile(account, 'FL', 'First', 'Last', 42),
+        'make_typing': lambda: SignalEvent.make_typing(account, recipient, msg_id=42),
+        'make_receipt': lambda: SignalEvent.make_receipt(account, recipient, 1664746936057, msg_id=42),
+        'receipt as dict': dict_receipt,
+    }
+
+    for name in JsonCodec.available():
+        codec.use(name)
+        print(f'-- {name}')
+        for kind, func in encoders.items():
+            print(f'encode {kind:<20} {time_per_call(func, count)*1e6:>8.2f} us')
+        for kind, data in samples.items():
+            took = time_per_call(lambda: codec.decode(data), count)
+            print(f'decode {kind:<20} {took*1e6:>8.2f} us')
+    codec.use(JsonCodec.AUTO)
+
+# drives the scheduler with a simulated clock so runs are deterministic
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def simulate(scheduler, clock, arrivals, duration):
+    # arrivals: sorted list of (time, key, item, priority)
+    # returns {item: time it was sent}
+    sent = {}
+    i = 0
+    while(clock.now <= duration):
+        while(i < len(arrivals) and arrivals[i][0] <= clock.now):
+            at, key, item, priority = arrivals[i]
+            scheduler.push(key, item, priority)
+            i += 1
+        item, wait = scheduler.pop()
+        if(item is not None):
+            sent[item] = clock.now
+            continue
+        next_arrival = arrivals[i][0] if i < len(arrivals) else None
+        if(wait is None and next_arrival is None):
+            break
+        steps = [t for t in (None if wait is None else clock.now + wait, next_arrival)
+                 if t is not None]
+        clock.now = min(steps)
+    return sent
+
+def bench_scheduler(args):
+    rate = args.rate
+    clock = SimClock()
+
+    # throughput: one steady stream well above the global rate
+    sched = SendScheduler(rate, args.burst, clock=clock)
+    arrivals = [(0.0, '+1555%07d' % (n % 100), ('bulk', n), SendScheduler.PRIORITY_NORMAL)
+                for n in range(int(rate * args.duration * 2))]
+    sent = simulate(sched, clock, arrivals, args.duration)
+    print(f'-- throughput, global limit {rate}/s burst {args.burst}, {args.duration}s simulated')
+    print(f'sent {len(sent)} ({len(sent)/args.duration:.1f}/s), {len(sched)} still queued')
+
+    # fairness: a big digest fan-out to one recipient is queued first, then
+    # a handful of other recipients and some alerts show up
+    clock = SimClock()
+    sched = SendScheduler(rate, args.burst, args.recipient_rate, args.recipient_burst, clock=clock)
+    arrivals = [(0.0, '+15550000000', ('fanout', n), SendScheduler.PRIORITY_DIGEST)
+                for n in range(args.fanout)]
+    arrivals += [(0.5, '+1555%07d' % (n + 1), ('other', n), SendScheduler.PRIORITY_NORMAL)
+                 for n in range(args.others)]
+    arrivals += [(1.0 + n, '+1555%07d' % (n + 1), ('alert', n), SendScheduler.PRIORITY_ALERT)
+                 for n in range(5)]
+    arrivals.sort(key=lambda a: a[0])
+    arrived = {a[2]: a[0] for a in arrivals}
+    sent = simulate(sched, clock, arrivals, args.duration)
+
+    print(f'-- fairness, {args.fanout} digests to one recipient (limit {args.recipient_rate}/s) '
+          f'then {args.others} other recipients and 5 alerts')
+    for kind in ('fanout', 'other', 'alert'):
+        waits = sorted(sent[item] - arrived[item] for item in sent if item[0] == kind)
+        total = sum(1 for item in arrived if item[0] == kind)
+        if(waits):
+            print(f'{kind:<8} sent {len(waits):>6}/{total:<6} wait min {waits[0]:.3f}s '
+                  f'p50 {waits[len(waits)//2]:.3f}s max {waits[-1]:.3f}s')
+        else:
+            print(f'{kind:<8} sent      0/{total}')
+
+def get_rss_mb(pid):
+    # linux only, None elsewhere
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if(line.startswith('VmRSS:')):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def metric_sum(metrics, prefix):
+    # every sample of a metric in /metrics output, added up
+    return sum(float(line.rsplit(' ', 1)[1]) for line in metrics.splitlines()
+               if line.startswith(prefix))
+
+def percentile(values, p):
+    if(not values):
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run_client(args):
+    # the sigmsg process under test, started by the e2e benchmark
+    from signalclient import SignalClient
+    SignalClient('127.0.0.1', args.signal_port, args.rest_port,
+                 '+12345678901', 'bench',
+                 outbox_path='outbox.db' if args.outbox else '',
+                 receipt_window=args.receipt_window,
+                 rest_workers=args.rest_workers,
+                 event_loop=args.event_loop,
+                 slow_callback=0.1,
+                 record_path=args.record,
+                 log_level=logging.getLevelName(args.log_level)).run_loop()
+
+async def wait_for_rest(session, url, proc, timeout=15):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while(loop.time() < deadline):
+        if(proc.returncode is not None):
+            raise RuntimeError(f'client exited with {proc.returncode}')
+        try:
+            async with session.get(url + '/status') as resp:
+                if(resp.status == 200):
+                    return
+        except OSError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError('client REST api did not come up')
+
+async def run_e2e(args):
+    import aiohttp
+
+    fake = await FakeSignalCli(port=args.signal_port, recv_rate=args.recv_rate,
+                               chunk_size=args.chunk_size, error_rate=args.error_rate,
+                               delay=args.delay, senders=args.senders,
+                               duplicate_rate=args.duplicate_rate).start()
+    workdir = tempfile.mkdtemp(prefix='sigmsg-bench-')
+    # logs end up in the working directory, keep them out of the repo
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, abspath(__file__), 'client',
+        '--signal-port', str(args.signal_port), '--rest-port', str(args.rest_port),
+        '--log-level', args.log_level, '--receipt-window', str(args.receipt_window),
+        '--rest-workers', str(args.rest_workers), '--event-loop', args.event_loop,
+        '--record', abspath(args.record) if args.record else '',
+        *(['--outbox'] if args.outbox else []),
+        cwd=workdir,
+        stdout=asyncio.subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{args.rest_port}'
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_for_rest(session, url, proc)
+            rss_start = get_rss_mb(proc.pid)
+
+            latencies = []
+            errors = 0
+            requests = args.count // args.batch
+            remaining = [requests]
+
+            async def worker():
+                nonlocal errors
+                while(remaining[0] > 0):
+                    remaining[0] -= 1
+                    n = remaining[0]
+                    if(args.batch > 1):
+                        path = '/batch'
+                        body = [{'recipients': ['+1555%07d' % ((n * args.batch + i) % 1000)],
+                                 'message': f'load {n}.{i}'} for i in range(args.batch)]
+                    else:
+                        path = '/'
+                        body = {'recipients': ['+1555%07d' % (n % 1000)], 'message': f'load {n}'}
+                    start = perf_counter()
+                    async with session.post(url + path, json=body) as resp:
+                        data = await resp.json()
+                    latencies.append(perf_counter() - start)
+                    if(resp.status != 200 or 'error' in data):
+                        errors += 1
+
+            start = perf_counter()
+            await asyncio.gather(*[worker() for i in range(args.concurrency)])
+            elapsed = perf_counter() - start
+            rss_end = get_rss_mb(proc.pid)
+
+            async with session.get(url + '/metrics') as resp:
+                metrics = await resp.text()
+    finally:
+        if(proc.returncode is None):
+            proc.terminate()
+            await proc.wait()
+        await fake.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    received = metric_sum(metrics, 'signalclient_events_received_total{type="received"')
+    latencies.sort()
+    sent = len(latencies) * args.batch
+    print(f'-- {sent} messages, {args.batch} per request, concurrency {args.concurrency}, '
+          f'inbound {args.recv_rate}/s, chunk size {args.chunk_size or "-"}'
+          f'{", outbox" if args.outbox else ""}'
+          f'{f", {args.rest_workers} rest workers" if args.rest_workers else ""}')
+    print(f'throughput     {sent/elapsed:>10.0f} msgs/s ({elapsed:.2f}s)')
+    print(f'latency p50    {percentile(latencies, 50)*1000:>10.2f} ms')
+    print(f'latency p99    {percentile(latencies, 99)*1000:>10.2f} ms')
+    print(f'errors         {errors:>10}')
+    print(f'inbound events {received:>10.0f}')
+    if(args.duplicate_rate):
+        duplicates = metric_sum(metrics, 'signalclient_inbound_duplicates_total')
+        print(f'duplicates     {duplicates:>10.0f} dropped')
+    slow = metric_sum(metrics, 'signalclient_slow_callbacks_total')
+    lag = [metric_sum(metrics, 'signalclient_event_loop_lag_seconds_sum'),
+           metric_sum(metrics, 'signalclient_event_loop_lag_seconds_count')]
+    print(f'event loop     {args.event_loop:>10}, {slow:.0f} slow callbacks'
+          f'{f", {lag[0]/lag[1]*1000:.2f} ms mean lag" if lag[1] else ""}')
+    print(f'sendReceipt    {fake.received.get("sendReceipt", 0):>10} '
+          f'(window {args.receipt_window}s, {args.senders} senders)')
+    if(rss_start is not None):
+        print(f'rss            {rss_start:>10.1f} MB -> {rss_end:.1f} MB')
+
+def bench_e2e(args):
+    asyncio.run(run_e2e(args))
+
+async def run_replay(args):
+    import aiohttp
+
+    replay = load_recording(args.recording, args.max_gap)
+    if(not replay):
+        print(f'nothing signal-cli sent in {args.recording}')
+        return
+    fake = await FakeSignalCli(port=args.signal_port, replay=replay, speed=args.speed).start()
+    workdir = tempfile.mkdtemp(prefix='sigmsg-bench-')
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, abspath(__file__), 'client',
+        '--signal-port', str(args.signal_port), '--rest-port', str(args.rest_port),
+        '--log-level', args.log_level, '--event-loop', args.event_loop,
+        cwd=workdir,
+        stdout=asyncio.subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{args.rest_port}'
+    loop = asyncio.get_running_loop()
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_for_rest(session, url, proc)
+            rss_start = get_rss_mb(proc.pid)
+            # done once every line was sent, counted as received and handled,
+            # or when nothing moved for --timeout seconds (undecodable lines)
+            received = 0
+            progress = loop.time()
+            while True:
+                await asyncio.sleep(0.05)
+                async with session.get(url + '/metrics') as resp:
+                    metrics = await resp.text()
+                now = loop.time()
+                count = (metric_sum(metrics, 'signalclient_events_received_total') -
+                         metric_sum(metrics, 'signalclient_events_received_total{type="result"') -
+                         metric_sum(metrics, 'signalclient_events_received_total{type="error"'))
+                if(count != received):
+                    received = count
+                    progress = now
+                if(fake.replay_end is not None and received >= len(replay) and
+                   metric_sum(metrics, 'signalclient_inbound_queue_events') == 0):
+                    break
+                if(now - progress > args.timeout):
+                    print(f'stalled after {received:.0f} of {len(replay)} lines')
+                    break
+            elapsed = now - fake.replay_start
+            rss_end = get_rss_mb(proc.pid)
+    finally:
+        if(proc.returncode is None):
+            proc.terminate()
+            await proc.wait()
+        await fake.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    span = replay[-1][0]
+    lag = [metric_sum(metrics, 'signalclient_event_loop_lag_seconds_sum'),
+           metric_sum(metrics, 'signalclient_event_loop_lag_seconds_count')]
+    print(f'-- {args.recording}: {len(replay)} lines over {span:.2f}s, '
+          f'speed {args.speed or "max"}, {args.event_loop}')
+    print(f'replayed       {fake.replayed:>10} lines in {elapsed:.2f}s '
+          f'({span / elapsed if elapsed else 0:.1f}x the recorded pace)')
+    print(f'handled        {received / elapsed if elapsed else 0:>10.0f} events/s')
+    print(f'duplicates     {metric_sum(metrics, "signalclient_inbound_duplicates_total"):>10.0f} dropped')
+    print(f'slow callbacks {metric_sum(metrics, "signalclient_slow_callbacks_total"):>10.0f}'
+          f'{f", {lag[0]/lag[1]*1000:.2f} ms mean lag" if lag[1] else ""}')
+    if(rss_start is not None):
+        print(f'rss            {rss_start:>10.1f} MB -> {rss_end:.1f} MB')
+
+def bench_replay(args):
+    asyncio.run(run_replay(args))
+
+def main():
+    parser = argparse.ArgumentParser(description='sigmsg benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('framer', help='inbound json-rpc line framing')
+    p.add_argument('--count', type=int, default=20000)
+    p.add_argument('--chunk-sizes', type=int, nargs='+',
+                   default=[65536, 4096, 1000])
+    p.add_argument('--skip-legacy', action='store_true')
+    p.set_defaults(func=bench_framer)
+
+    p = sub.add_parser('event', help='SignalEvent parsing cost per envelope kind')
+    p.add_argument('--count', type=int, default=100000)
+    p.set_defaults(func=bench_event)
+
+    p = sub.add_parser('router', help='inbound event routing time against number of handlers')
+    p.add_argument('--count', type=int, default=20000)
+    p.add_argument('--handlers', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    p.add_argument('--regexes', type=int, default=10, help='handlers matching on a regex')
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser('codec', help='json encode/decode per message type for each codec')
+    p.add_argument('--count', type=int, default=100000)
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser('e2e', help='REST api to fake signal-cli load test')
+    p.add_argument('--count', type=int, default=20000, help='messages to send')
+    p.add_argument('--concurrency', type=int, default=50)
+    p.add_argument('--batch', type=int, default=1, help='messages per request, >1 uses /batch')
+    p.add_argument('--recv-rate', type=float, default=0, help='inbound envelopes per second')
+    p.add_argument('--chunk-size', type=int, default=0)
+    p.add_argument('--error-rate', type=float, default=0)
+    p.add_argument('--delay', type=float, default=0, help='fake signal-cli answer delay')
+    p.add_argument('--signal-port', type=int, default=17583)
+    p.add_argument('--rest-port', type=int, default=18080)
+    p.add_argument('--log-level', default='INFO')
+    p.add_argument('--outbox', action='store_true', help='keep sends in a sqlite outbox')
+    p.add_argument('--receipt-window', type=float, default=ReceiptAggregator.WINDOW,
+                   help='seconds read receipts to a sender are coalesced over (0 = one per message)')
+    p.add_argument('--senders', type=int, default=500, help='distinct inbound senders')
+    p.add_argument('--duplicate-rate', type=float, default=0,
+                   help='fraction of inbound envelopes delivered twice')
+    p.add_argument('--rest-workers', type=int, default=0,
+                   help='processes serving the REST api (0 = the sigmsg process itself)')
+    p.add_argument('--event-loop', default='asyncio', choices=('asyncio', 'uvloop'),
+                   help='event loop for sigmsg (uvloop falls back to asyncio if not installed)')
+    p.add_argument('--record', default='',
+                   help='record the json-rpc traffic to this file, for the replay benchmark')
+    p.set_defaults(func=bench_e2e)
+
+    p = sub.add_parser('replay', help='a traffic recording played into sigmsg, receive path throughput')
+    p.add_argument('recording', help='RECORD_PATH of a recording, its rotated files are read too')
+    p.add_argument('--speed', type=float, default=0,
+                   help='times the recorded pace, 0 = as fast as sigmsg takes it')
+    p.add_argument('--max-gap', type=float, default=5,
+                   help='longest pause, quiet stretches of the recording are cut to this')
+    p.add_argument('--timeout', type=float, default=5,
+                   help='seconds without progress before giving up')
+    p.add_argument('--signal-port', type=int, default=17583)
+    p.add_argument('--rest-port', type=int, default=18080)
+    p.add_argument('--log-level', default='INFO')
+    p.add_argument('--event-loop', default='asyncio', choices=('asyncio', 'uvloop'))
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser('client', help=argparse.SUPPRESS)
+    p.add_argument('--signal-port', type=int)
+    p.add_argument('--rest-port', type=int)
+    p.add_argument('--log-level', default='INFO')
+    p.add_argument('--outbox', action='store_true')
+    p.add_argument('--receipt-window', type=float, default=ReceiptAggregator.WINDOW)
+    p.add_argument('--rest-workers', type=int, default=0)
+    p.add_argument('--event-loop', default='asyncio')
+    p.add_argument('--record', default='')
+    p.set_defaults(func=run_client)
+
+    p = sub.add_parser('scheduler', help='send rate limiting and fairness (simulated clock)')
+    p.add_argument('--rate', type=float, default=50)
+    p.add_argument('--burst', type=int, default=10)
+    p.add_argument('--recipient-rate', type=float, default=5)
+    p.add_argument('--recipient-burst', type=int, default=5)
+    p.add_argument('--fanout', type=int, default=1000)
+    p.add_argument('--others', type=int, default=100)
+    p.add_argument('--duration', type=float, default=60)
+    p.set_defaults(func=bench_scheduler)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
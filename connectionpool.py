@@ -0,0 +1,57 @@
+class NoConnection(Exception):
+    pass
+
+class ConnectionPool:
+    ROUTING = ('least_loaded', 'round_robin')
+
+    # picks the signal-cli connection each send goes out on. a send for a
+    # given account only goes to connections for that account, anything
+    # else to any of them. connections that are down are only used when
+    # none are up, their queues hold the messages until they reconnect
+    def __init__(self, connections, routing=ROUTING[0]):
+        if(routing not in ConnectionPool.ROUTING):
+            raise ValueError(f'connection routing must be one of {ConnectionPool.ROUTING}')
+        if(not connections):
+            raise ValueError('at least one signal-cli connection is needed')
+        self.connections = connections
+        self.routing = routing
+        self.turn = 0
+        # account -> its connections
+        self.accounts = {}
+        for connection in connections:
+            self.accounts.setdefault(connection.account, []).append(connection)
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def get_candidates(self, account=None):
+        if(account):
+            candidates = self.accounts.get(account)
+            if(candidates is None):
+                raise NoConnection(f'no signal-cli connection for account {account}')
+            return candidates
+        return self.connections
+
+    def select(self, account=None):
+        candidates = self.get_candidates(account)
+        if(len(candidates) == 1):
+            return candidates[0]
+
+        up = [c for c in candidates if c.is_connected()] or candidates
+        self.turn += 1
+        start = self.turn % len(up)
+        if(self.routing == 'round_robin'):
+            return up[start]
+        # least loaded, ties going round robin
+        best = None
+        for i in range(len(up)):
+            connection = up[(start + i) % len(up)]
+            if(best is None or connection.get_load() < best.get_load()):
+                best = connection
+        return best
+
+    def has_account(self, account):
+        return account in self.accounts
@@ -0,0 +1,249 @@
+from asyncio import (Event as a_Event, sleep as a_sleep, wait_for as a_wait_for,
+                     TimeoutError as a_TimeoutError)
+from itertools import islice
+
+from connectionpool import NoConnection
+from fanout import FanOut
+from signalevent import SignalEvent
+from signalsendhandler import SendQueueFull
+
+class ContactDirectory:
+    # seconds between full refreshes from signal-cli
+    REFRESH_INTERVAL = 300
+    # seconds before trying again after a refresh failed
+    RETRY = 10
+    # seconds an invalidation waits, so a burst of group updates is one refresh
+    INVALIDATE_DELAY = 1
+    MAX_CONTACTS = 100000
+    MAX_GROUPS = 10000
+    # most records in one page of a listing
+    PAGE_MAX = 1000
+
+    # the contacts and groups of every account, from signal-cli's
+    # listContacts/listGroups, so handlers and the REST api can look up a
+    # name or a group's members without a round trip to signal-cli. they
+    # are loaded at startup, refreshed every refresh_interval seconds and
+    # sooner when a sync or group update envelope says they changed.
+    # senders of messages that aren't known yet are added as they come in.
+    # lookups are dict gets, by number, uuid or group id
+    def __init__(self, caller, refresh_interval=REFRESH_INTERVAL,
+                 max_contacts=MAX_CONTACTS, max_groups=MAX_GROUPS):
+        self.caller = caller
+        self.refresh_interval = refresh_interval
+        self.max_contacts = max_contacts
+        self.max_groups = max_groups
+        # number (or uuid, without one) -> contact
+        self.contacts = {}
+        # uuid -> the same contact
+        self.uuids = {}
+        # group id -> group
+        self.groups = {}
+        # what needs loading again, and a wakeup for the refresh loop
+        self.stale_contacts = True
+        self.stale_groups = True
+        self.wakeup = a_Event()
+
+        # stats for /status
+        self.refreshes = 0
+        self.failures = 0
+        self.invalidations = 0
+        self.dropped = 0
+        self.refreshed_at = None
+
+    @staticmethod
+    def make_contact(contact):
+        # what signal-cli has on a contact, in a few fields. profile names
+        # are used where the contact has no name of its own
+        profile = contact.get('profile') or {}
+        given = contact.get('givenName') or profile.get('givenName') or ''
+        family = contact.get('familyName') or profile.get('familyName') or ''
+        return {
+            'number': contact.get('number') or '',
+            'uuid': (contact.get('uuid') or '').lower(),
+            'username': contact.get('username') or '',
+            'name': contact.get('name') or ' '.join(n for n in (given, family) if n),
+            'given_name': given,
+            'family_name': family,
+            'about': profile.get('about') or '',
+            'blocked': bool(contact.get('isBlocked')),
+        }
+
+    @staticmethod
+    def get_address(member):
+        # members are {number, uuid} from newer signal-cli, numbers before
+        if(type(member) is dict):
+            return member.get('number') or (member.get('uuid') or '').lower()
+        return member
+
+    @staticmethod
+    def make_group(group):
+        return {
+            'id': group.get('id') or '',
+            'name': group.get('name') or '',
+            'description': group.get('description') or '',
+            'members': [ContactDirectory.get_address(m) for m in group.get('members') or []],
+            'admins': [ContactDirectory.get_address(m) for m in group.get('admins') or []],
+            'blocked': bool(group.get('isBlocked')),
+            # our accounts in the group
+            'accounts': [],
+        }
+
+    def add_contact(self, contacts, uuids, contact):
+        key = contact['number'] or contact['uuid']
+        if(not key):
+            return
+        if(key not in contacts and len(contacts) >= self.max_contacts):
+            self.dropped += 1
+            return
+        contacts[key] = contact
+        if(contact['uuid']):
+            uuids[contact['uuid']] = contact
+
+    def get_contact(self, key):
+        # by number or uuid, None if it isn't known
+        contact = self.contacts.get(key) or self.uuids.get(key)
+        if(contact is None and key):
+            key = FanOut.normalize(key)
+            contact = self.contacts.get(key) or self.uuids.get(key)
+        return contact
+
+    def get_name(self, key):
+        contact = self.get_contact(key)
+        return contact['name'] if contact else ''
+
+    def get_group(self, group_id):
+        # base64 ids lose their +s in a query string
+        return self.groups.get(group_id) or self.groups.get(group_id.replace(' ', '+'))
+
+    def get_group_account(self, group_id):
+        # one of our accounts that is in the group, None if not known
+        group = self.groups.get(group_id)
+        return group['accounts'][0] if group and group['accounts'] else None
+
+    def get_page(self, records, offset=0, limit=100):
+        return list(islice(records.values(), max(offset, 0),
+                           max(offset, 0) + min(max(limit, 0), self.PAGE_MAX)))
+
+    def observe(self, event):
+        # every inbound envelope comes through here, so no more than a
+        # few dict lookups for the ones that don't change anything
+        if(event.subtype == SignalEvent.SUBTYPE_SYNC):
+            sync = event.envelope['syncMessage']
+            kind = sync.get('type')
+            if(kind == 'CONTACTS_SYNC' or 'blockedNumbers' in sync):
+                self.invalidate(contacts=True)
+            if(kind == 'GROUPS_SYNC' or 'blockedGroupIds' in sync):
+                self.invalidate(groups=True)
+        elif(event.data is not None):
+            group = event.data.get('groupInfo')
+            if(group and group.get('type') in ('UPDATE', 'QUIT')):
+                self.invalidate(groups=True)
+            envelope = event.envelope
+            number = envelope.get('sourceNumber') or ''
+            uuid = (envelope.get('sourceUuid') or '').lower()
+            if((self.contacts.get(number) if number else self.uuids.get(uuid)) is None):
+                self.add_contact(self.contacts, self.uuids, {
+                    'number': number, 'uuid': uuid, 'username': '',
+                    'name': envelope.get('sourceName') or '',
+                    'given_name': '', 'family_name': '', 'about': '', 'blocked': False})
+
+    def invalidate(self, contacts=False, groups=False):
+        self.invalidations += 1
+        self.stale_contacts |= contacts
+        self.stale_groups |= groups
+        self.wakeup.set()
+
+    async def request(self, make, account):
+        # a list* call's result, None when signal-cli couldn't give one
+        msg_id = self.caller.get_next_sent_id()
+        try:
+            event = await self.caller.send_request(make(account, msg_id), msg_id,
+                                                   connection=self.caller.connections.select(account))
+        except (a_TimeoutError, SendQueueFull, NoConnection) as err:
+            self.caller.lgr.warning('directory refresh for %s failed: %s',
+                                    account, str(err) or type(err).__name__)
+            return None
+        if(event.get_type() == SignalEvent.TYPE_ERROR):
+            self.caller.lgr.warning('directory refresh for %s failed: %s',
+                                    account, event.get_message())
+            return None
+        return event.json['result'] or []
+
+    async def refresh(self, contacts=True, groups=True):
+        # everything is loaded again and swapped in at once, so contacts and
+        # groups that are gone go too. returns False if anything failed,
+        # what was loaded before is kept for what failed
+        ok = True
+        accounts = list(self.caller.connections.accounts)
+        if(contacts):
+            new_contacts = {}
+            new_uuids = {}
+            for account in accounts:
+                result = await self.request(SignalEvent.make_listcontacts, account)
+                if(result is None):
+                    ok = contacts = False
+                    break
+                for contact in result:
+                    self.add_contact(new_contacts, new_uuids, ContactDirectory.make_contact(contact))
+            if(contacts):
+                self.contacts = new_contacts
+                self.uuids = new_uuids
+        if(groups):
+            new_groups = {}
+            for account in accounts:
+                result = await self.request(SignalEvent.make_listgroups, account)
+                if(result is None):
+                    ok = groups = False
+                    break
+                for group in result:
+                    group_id = group.get('id')
+                    if(not group_id):
+                        continue
+                    found = new_groups.get(group_id)
+                    if(found is None):
+                        if(len(new_groups) >= self.max_groups):
+                            self.dropped += 1
+                            continue
+                        found = new_groups[group_id] = ContactDirectory.make_group(group)
+                    if(group.get('isMember', True)):
+                        found['accounts'].append(account)
+            if(groups):
+                self.groups = new_groups
+        if(ok):
+            self.refreshes += 1
+            self.refreshed_at = self.caller.loop.time()
+            self.caller.lgr.info('directory has %d contacts and %d groups',
+                                 len(self.contacts), len(self.groups))
+        else:
+            self.failures += 1
+        return ok
+
+    async def run_loop(self):
+        while(not self.caller.shutting_down):
+            contacts, groups = self.stale_contacts, self.stale_groups
+            self.stale_contacts = self.stale_groups = False
+            self.wakeup.clear()
+            if(not await self.refresh(contacts, groups)):
+                # tried again with whatever else went stale meanwhile
+                self.stale_contacts |= contacts
+                self.stale_groups |= groups
+                timeout = min(self.refresh_interval, self.RETRY)
+            else:
+                timeout = self.refresh_interval
+            try:
+                await a_wait_for(self.wakeup.wait(), timeout)
+                await a_sleep(self.INVALIDATE_DELAY)
+            except a_TimeoutError:
+                self.stale_contacts = self.stale_groups = True
+
+    def get_stats(self):
+        return {
+            'contacts': len(self.contacts),
+            'groups': len(self.groups),
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'invalidations': self.invalidations,
+            'dropped': self.dropped,
+            'refreshed_s': round(self.caller.loop.time() - self.refreshed_at, 3)
+                           if self.refreshed_at is not None else None,
+        }
@@ -0,0 +1,128 @@
+from asyncio import Queue as a_Queue, gather as a_gather
+
+class EventDispatcher:
+    # workers handling inbound events
+    WORKERS = 4
+    # events buffered across all workers before we stop reading from
+    # signal-cli, reading resumes once half of them are handled. a
+    # connection with requests waiting on their answers keeps reading up
+    # to twice as many
+    QUEUE_SIZE = 1000
+
+    def __init__(self, caller, handler, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.caller = caller
+        self.handler = handler
+        self.queue_size = queue_size
+        # events for one conversation always land on the same worker, so
+        # they are handled in the order signal-cli sent them
+        self.queues = [a_Queue() for i in range(max(workers, 1))]
+        self.next_shard = 0
+        # transports we paused reading on
+        self.paused = []
+
+        # stats for /status
+        self.dispatched = 0
+        self.dropped = 0
+        self.handled = 0
+        self.errors = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        self.handle_total = 0
+        self.handle_max = 0
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    @staticmethod
+    def get_key(event):
+        # group messages are one conversation, otherwise it's the sender
+        if(event.group_id):
+            return event.group_id
+        if(event.sender):
+            return event.sender
+        return None
+
+    def dispatch(self, event):
+        # only inbound envelopes come through here, results and errors are
+        # acknowledged as they are read
+        key = self.get_key(event)
+        if(key is None):
+            # no envelope, nothing a handler could do with it
+            self.dropped += 1
+            self.caller.lgr.warning('unknown msg: %s', event)
+            return
+        self.queues[hash(key) % len(self.queues)].put_nowait((event, self.caller.loop.time()))
+        self.dispatched += 1
+        self.update_flow()
+
+    def update_flow(self):
+        # bounds the queues by pushing back on signal-cli instead of
+        # dropping events, the same way the transport does for writes.
+        # every connection feeds the same workers, so all of them wait,
+        # including any that (re)connected since, except that answers to
+        # requests written to a connection aren't held up until it is at
+        # twice the queue size
+        depth = self.depth()
+        if(depth < self.queue_size and not self.paused):
+            return
+        for connection in self.caller.connections:
+            transport = connection.transport
+            if(transport is None):
+                continue
+            waiting = len(connection.output.inflight) > 0
+            limit = self.queue_size * 2 if waiting else self.queue_size
+            if(transport not in self.paused):
+                if(depth >= limit):
+                    if(not self.paused):
+                        self.caller.lgr.warning(f'{depth} inbound events queued, pausing reads from signal-cli')
+                    transport.pause_reading()
+                    self.paused.append(transport)
+            elif(depth < limit if waiting else depth <= self.queue_size // 2):
+                self.paused.remove(transport)
+                if(not transport.is_closing()):
+                    transport.resume_reading()
+                if(not self.paused):
+                    self.caller.lgr.info('resuming reads from signal-cli')
+        # a connection that went away meanwhile starts out reading
+        self.paused = [t for t in self.paused if not t.is_closing()]
+
+    async def worker_loop(self, queue):
+        while True:
+            event, queued_at = await queue.get()
+            start = self.caller.loop.time()
+            if(self.paused):
+                self.update_flow()
+            try:
+                await self.handler(event)
+            except Exception as e:
+                self.errors += 1
+                self.caller.lgr.exception(f'inbound handler failed: {type(e).__name__}: {e}')
+            end = self.caller.loop.time()
+
+            self.handled += 1
+            wait = start - queued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            took = end - start
+            self.handle_total += took
+            self.handle_max = max(self.handle_max, took)
+
+    async def run_loop(self):
+        await a_gather(*[self.worker_loop(q) for q in self.queues])
+
+    def get_stats(self):
+        handled = self.handled or 1
+        return {
+            'workers': len(self.queues),
+            'queued': self.depth(),
+            'queued_per_worker': [q.qsize() for q in self.queues],
+            'reading_paused': len(self.paused) > 0,
+            'dispatched': self.dispatched,
+            'dropped': self.dropped,
+            'handled': self.handled,
+            'errors': self.errors,
+            'wait_avg_ms': round(self.wait_total / handled * 1000, 3),
+            'wait_max_ms': round(self.wait_max * 1000, 3),
+            'handle_avg_ms': round(self.handle_total / handled * 1000, 3),
+            'handle_max_ms': round(self.handle_max * 1000, 3),
+        }
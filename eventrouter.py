@@ -0,0 +1,217 @@
+from inspect import iscoroutine
+import re
+
+from signalevent import SignalEvent
+
+class Route:
+    __slots__ = ('handler', 'type', 'subtype', 'sender', 'group', 'account',
+                 'prefix', 'regex', 'order')
+
+    def __init__(self, handler, type, subtype, sender, group, account, prefix, regex, order):
+        self.handler = handler
+        self.type = type
+        self.subtype = subtype
+        self.sender = sender
+        self.group = group
+        self.account = account
+        self.prefix = prefix
+        self.regex = regex
+        # registration order, matching handlers are run in it
+        self.order = order
+
+    def matches(self, event, text):
+        # whatever the index it was found through didn't already check
+        return ((self.type is None or self.type == event.type) and
+                (self.subtype is None or self.subtype == event.subtype) and
+                (self.sender is None or self.sender in (event.sender, event.sender_uuid)) and
+                (self.group is None or self.group == event.group_id) and
+                (self.account is None or self.account == event.recipient) and
+                (self.prefix is None or text.startswith(self.prefix)) and
+                (self.regex is None or self.regex.search(text) is not None))
+
+class EventRouter:
+    # answers to our own requests, they are matched up as they are read
+    # and never get this far
+    UNROUTED = (SignalEvent.TYPE_RESULT, SignalEvent.TYPE_ERROR)
+
+    # handlers for inbound events, registered for any mix of type, subtype,
+    # sender, group, account, message prefix and message regex. every route
+    # is filed under its most selective field (prefix, sender, group, regex,
+    # then type/subtype) so an event only gets checked against the routes
+    # that could match it, however many there are:
+    #   prefixes by length, one dict lookup per distinct prefix length
+    #   senders and groups, one dict lookup each
+    #   regexes, one combined pattern first, the single ones on a hit
+    #   type/subtype, a dict lookup for each wildcard combination
+    def __init__(self, caller):
+        self.caller = caller
+        self.count = 0
+        self.added = 0
+        # prefix -> [routes]
+        self.prefixes = {}
+        self.prefix_lengths = []
+        # sender number or uuid -> [routes]
+        self.senders = {}
+        # group id -> [routes]
+        self.groups = {}
+        self.regexes = []
+        # any of the regexes, None when it has to be rebuilt or can't be
+        self.regex_any = None
+        self.regex_dirty = False
+        # (type or None, subtype or None) -> [routes]
+        self.kinds = {}
+
+        # stats for /status
+        self.dispatched = 0
+        self.matched = 0
+        self.errors = 0
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def get_constant(value, names):
+        # types and subtypes by SignalEvent constant or by name
+        if(value is None or value in names):
+            return value
+        for constant, name in names.items():
+            if(name == value):
+                return constant
+        raise ValueError(f'unknown event kind {value!r}, one of {list(names.values())}')
+
+    def add(self, handler, type=None, subtype=None, sender=None, group=None,
+            account=None, prefix=None, regex=None):
+        # handler is called with the event, and may be a coroutine function
+        if(type is None and subtype is None and (prefix is not None or regex is not None)):
+            # only messages have text to match
+            type = SignalEvent.TYPE_RECV
+            subtype = SignalEvent.SUBTYPE_MESSAGE
+        if(isinstance(regex, str)):
+            regex = re.compile(regex)
+        type = EventRouter.get_constant(type, SignalEvent.TYPES)
+        if(type in EventRouter.UNROUTED):
+            raise ValueError(f'{SignalEvent.TYPES[type]} events are not routed, '
+                             f'only inbound ones')
+        route = Route(handler, type,
+                      EventRouter.get_constant(subtype, SignalEvent.SUBTYPES),
+                      sender, group, account, prefix or None, regex, self.added)
+        self.added += 1
+        self.count += 1
+
+        if(route.prefix is not None):
+            self.prefixes.setdefault(route.prefix, []).append(route)
+            if(len(route.prefix) not in self.prefix_lengths):
+                self.prefix_lengths = sorted(self.prefix_lengths + [len(route.prefix)])
+        elif(sender is not None):
+            self.senders.setdefault(sender, []).append(route)
+        elif(group is not None):
+            self.groups.setdefault(group, []).append(route)
+        elif(regex is not None):
+            self.regexes.append(route)
+            self.regex_dirty = True
+        else:
+            self.kinds.setdefault((route.type, route.subtype), []).append(route)
+        return route
+
+    def on(self, **kwargs):
+        # the same as add, as a decorator:
+        #   @client.router.on(prefix='/weather')
+        #   async def weather(event): ...
+        def register(handler):
+            self.add(handler, **kwargs)
+            return handler
+        return register
+
+    def remove(self, route):
+        for index, key in ((self.prefixes, route.prefix), (self.senders, route.sender),
+                           (self.groups, route.group),
+                           (self.kinds, (route.type, route.subtype))):
+            routes = index.get(key)
+            if(routes and route in routes):
+                routes.remove(route)
+                if(not routes):
+                    del index[key]
+                    if(index is self.prefixes):
+                        self.prefix_lengths = sorted({len(p) for p in self.prefixes})
+                break
+        else:
+            if(route not in self.regexes):
+                raise ValueError('route is not registered')
+            self.regexes.remove(route)
+            self.regex_dirty = True
+        self.count -= 1
+
+    def build_regex_any(self):
+        self.regex_dirty = False
+        self.regex_any = None
+        flags = {route.regex.flags for route in self.regexes}
+        if(len(self.regexes) < 2 or len(flags) != 1):
+            return
+        try:
+            self.regex_any = re.compile('|'.join(f'(?:{route.regex.pattern})'
+                                                 for route in self.regexes), flags.pop())
+        except re.error:
+            # inline flags and the like, they all get tried one by one
+            pass
+
+    def match(self, event):
+        # the routes for an event, in the order they were added
+        text = event.message if event.data is not None else ''
+        found = []
+        if(text and self.prefix_lengths):
+            for length in self.prefix_lengths:
+                if(length > len(text)):
+                    break
+                routes = self.prefixes.get(text[:length])
+                if(routes):
+                    found.extend(routes)
+        if(self.senders and event.envelope is not None):
+            found.extend(self.senders.get(event.sender, ()))
+            if(event.sender_uuid):
+                found.extend(self.senders.get(event.sender_uuid, ()))
+        if(self.groups):
+            group_id = event.group_id
+            if(group_id):
+                found.extend(self.groups.get(group_id, ()))
+        if(text and self.regexes):
+            if(self.regex_dirty):
+                self.build_regex_any()
+            if(self.regex_any is None or self.regex_any.search(text)):
+                found.extend(self.regexes)
+        kinds = self.kinds
+        if(kinds):
+            found.extend(kinds.get((event.type, event.subtype), ()))
+            found.extend(kinds.get((event.type, None), ()))
+            found.extend(kinds.get((None, event.subtype), ()))
+            found.extend(kinds.get((None, None), ()))
+
+        matched = [route for route in found if route.matches(event, text)]
+        if(len(matched) > 1):
+            matched.sort(key=lambda route: route.order)
+        return matched
+
+    async def dispatch(self, event):
+        # runs every matching handler, one failing doesn't stop the rest.
+        # returns how many matched
+        self.dispatched += 1
+        routes = self.match(event)
+        if(routes):
+            self.matched += 1
+        for route in routes:
+            try:
+                ret = route.handler(event)
+                if(iscoroutine(ret)):
+                    await ret
+            except Exception as e:
+                self.errors += 1
+                self.caller.lgr.exception(f'event handler {getattr(route.handler, "__name__", route.handler)} '
+                                          f'failed: {type(e).__name__}: {e}')
+        return len(routes)
+
+    def get_stats(self):
+        return {
+            'routes': self.count,
+            'dispatched': self.dispatched,
+            'matched': self.matched,
+            'errors': self.errors,
+        }
@@ -0,0 +1,173 @@
+from asyncio import Event as a_Event, wait_for as a_wait_for
+from collections import deque
+
+from jsoncodec import codec
+from signalevent import SignalEvent
+
+class Subscriber:
+    def __init__(self, stream, kind, filters, buffer_size, policy):
+        self.stream = stream
+        # how its events are framed, see EventStream.FRAMES
+        self.kind = kind
+        # field -> set of values the event must have one of
+        self.filters = filters
+        self.buffer_size = max(buffer_size, 1)
+        self.policy = policy
+        self.buffer = deque()
+        self.ready = a_Event()
+        # why it was closed, None while open
+        self.closed = None
+        self.delivered = 0
+        self.dropped = 0
+
+    def wants(self, data):
+        for field, values in self.filters.items():
+            if(field == 'sender'):
+                if(data['sender'] not in values and data['sender_uuid'] not in values):
+                    return False
+            elif(data.get(field) not in values):
+                return False
+        return True
+
+    def offer(self, frame):
+        if(len(self.buffer) >= self.buffer_size):
+            self.dropped += 1
+            self.stream.dropped += 1
+            if(self.policy == 'disconnect'):
+                self.close(f'fell {self.buffer_size} events behind')
+                return
+            if(self.policy == 'drop_newest'):
+                return
+            self.buffer.popleft()
+        self.buffer.append(frame)
+        self.ready.set()
+
+    async def get(self, timeout=None):
+        # the next frame, None once closed. raises TimeoutError when
+        # nothing came within timeout seconds
+        while(not self.buffer):
+            if(self.closed is not None):
+                return None
+            self.ready.clear()
+            await a_wait_for(self.ready.wait(), timeout)
+        if(self.closed is not None and self.policy == 'disconnect'):
+            return None
+        self.delivered += 1
+        return self.buffer.popleft()
+
+    def close(self, reason='closed'):
+        if(self.closed is None):
+            self.closed = reason
+            self.stream.remove(self)
+            self.ready.set()
+
+class EventStream:
+    # events buffered for each subscriber
+    BUFFER_SIZE = 1000
+    # what happens when a subscriber's buffer is full
+    POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+    MAX_SUBSCRIBERS = 100
+    # fields subscribers can filter on
+    FILTERS = ('type', 'subtype', 'sender', 'group_id', 'account')
+    # each kind of subscriber's framing of the encoded event, made once
+    # per event for however many subscribers of that kind there are
+    FRAMES = {
+        'sse': lambda data: b'data: ' + data + b'\n\n',
+        'ws': lambda data: data.decode('utf-8'),
+        'ipc': lambda data: b'{"event":' + data + b'}\n',
+    }
+
+    # inbound events for whoever subscribed through /events, each encoded
+    # once however many subscribers get it. subscribers have a bounded
+    # buffer each, so a slow one loses events (or its subscription) and
+    # doesn't hold up the others or grow without bound
+    def __init__(self, caller, buffer_size=BUFFER_SIZE, policy=POLICIES[0],
+                 max_subscribers=MAX_SUBSCRIBERS, active_cb=None):
+        if(policy not in EventStream.POLICIES):
+            raise ValueError(f'stream policy must be one of {EventStream.POLICIES}')
+        self.caller = caller
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.max_subscribers = max_subscribers
+        # called with True on the first subscriber and False after the last
+        self.active_cb = active_cb
+        self.subscribers = []
+
+        # stats for /status
+        self.published = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    @staticmethod
+    def serialize(event):
+        data = {
+            'type': SignalEvent.TYPE_KEYS[event.type],
+            'subtype': SignalEvent.SUBTYPES[event.subtype],
+            'account': event.recipient,
+            'sender': event.sender,
+            'sender_name': event.sender_name,
+            'sender_uuid': event.sender_uuid,
+            'timestamp': event.timestamp,
+            'group_id': event.group_id,
+        }
+        if(event.data is not None):
+            data['message'] = event.message
+            data['reply_ts'] = event.re_timestamp
+            data['reaction'] = event.has_reaction
+            data['attachments'] = event.attachments
+        elif(event.subtype == SignalEvent.SUBTYPE_RECEIPT):
+            data['receipt_type'] = event.get_receipt_type_str()
+            data['timestamps'] = event.envelope['receiptMessage'].get('timestamps') or []
+        return data
+
+    def subscribe(self, kind, filters=None, buffer_size=None, policy=None):
+        if(len(self.subscribers) >= self.max_subscribers):
+            return None
+        subscriber = Subscriber(self, kind, filters or {},
+                                min(buffer_size or self.buffer_size, self.buffer_size),
+                                policy or self.policy)
+        self.subscribers.append(subscriber)
+        if(len(self.subscribers) == 1 and self.active_cb):
+            self.active_cb(True)
+        return subscriber
+
+    def remove(self, subscriber):
+        if(subscriber in self.subscribers):
+            self.subscribers.remove(subscriber)
+            if(subscriber.closed != 'closed'):
+                self.disconnected += 1
+            if(not self.subscribers and self.active_cb):
+                self.active_cb(False)
+
+    def publish(self, event):
+        if(self.subscribers):
+            self.publish_data(EventStream.serialize(event))
+
+    def publish_data(self, data, encoded=None):
+        # encoded is data already encoded, as it comes from the owner
+        # process in a rest worker
+        self.published += 1
+        frames = {}
+        for subscriber in list(self.subscribers):
+            if(subscriber.wants(data)):
+                frame = frames.get(subscriber.kind)
+                if(frame is None):
+                    if(encoded is None):
+                        encoded = codec.encode(data)
+                    frame = frames[subscriber.kind] = EventStream.FRAMES[subscriber.kind](encoded)
+                subscriber.offer(frame)
+
+    def close(self):
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+
+    def get_stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'dropped': self.dropped,
+            'disconnected': self.disconnected,
+        }
@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+from base64 import b64encode
+from random import Random
+
+from jsoncodec import codec, DecodeError
+from jsonlineframer import JsonLineFramer
+from trafficrecorder import TrafficRecorder
+
+# sample envelope in the shape signal-cli sends on receive
+def make_envelope(i, text='Ok', account='+12345678901', senders=500):
+    return {
+        "jsonrpc": "2.0",
+        "method": "receive",
+        "params": {
+            "envelope": {
+                "source": "+1555"+str(1000000 + i % senders),
+                "sourceNumber": "+1555"+str(1000000 + i % senders),
+                "sourceUuid": "12345e67-123c-4a56-789e-2345a2e3f4bd",
+                "sourceName": "D",
+                "sourceDevice": 1,
+                "timestamp": 1664746936057 + i,
+                "dataMessage": {
+                    "timestamp": 1664746936057 + i,
+                    "message": text,
+                    "expiresInSeconds": 0,
+                    "viewOnce": False
+                }
+            },
+            "account": account,
+            "subscription": 33
+        }
+    }
+
+def load_recording(path, max_gap=5.0):
+    # the notifications signal-cli sent in a recording, as (seconds from the
+    # first one, line). its answers were to requests made back then, the
+    # client being replayed to gets answers to its own. quiet stretches
+    # (or the time between runs, in the rotated files) are cut to max_gap
+    lines = []
+    elapsed = 0
+    last = None
+    for path in TrafficRecorder.get_files(path):
+        for now, direction, connection, line in TrafficRecorder.read(path):
+            if(direction != TrafficRecorder.RECEIVED):
+                continue
+            try:
+                if('method' not in codec.decode(line)):
+                    continue
+            except DecodeError:
+                pass
+            if(last is not None):
+                elapsed += min(max(now - last, 0), max_gap)
+            last = now
+            lines.append((elapsed, line))
+    return lines
+
+class FakeSignalCli:
+    # stand-in for `signal-cli daemon --tcp`, speaking the same newline
+    # delimited json-rpc so sigmsg can be run and load tested without a
+    # phone number or the docker image
+    METHODS = ('send', 'sendReceipt', 'sendTyping', 'updateProfile',
+               'listContacts', 'listGroups')
+    # groups listGroups answers with, each with a tenth of the senders
+    GROUPS = 10
+
+    def __init__(self, host='127.0.0.1', port=7583, recv_rate=0, chunk_size=0,
+                 error_rate=0.0, delay=0.0, seed=1, senders=500, duplicate_rate=0.0,
+                 replay=None, speed=1.0):
+        self.host = host
+        self.port = port
+        # synthetic receive envelopes per second per connection (0 = none)
+        self.recv_rate = recv_rate
+        # split everything written into chunks of this many bytes, so
+        # clients see messages cut at arbitrary points (0 = don't split)
+        self.chunk_size = chunk_size
+        # fraction of requests answered with an error
+        self.error_rate = error_rate
+        # seconds before each answer
+        self.delay = delay
+        self.random = Random(seed)
+        # distinct senders the synthetic envelopes come from
+        self.senders = senders
+        # fraction of the synthetic envelopes delivered twice, the way
+        # signal-cli can after a reconnect
+        self.duplicate_rate = duplicate_rate
+        # (seconds, line) from load_recording, played to the first client at
+        # speed times the recorded pace (0 = as fast as it takes them)
+        self.replay = replay
+        self.speed = speed
+        self.replayed = 0
+        # loop time the replay started and ended at
+        self.replay_start = None
+        self.replay_end = None
+        self.server = None
+        self.requests = 0
+        self.received = {}
+        self.envelopes = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def write(self, writer, data):
+        if(self.chunk_size):
+            for i in range(0, len(data), self.chunk_size):
+                writer.write(data[i:i + self.chunk_size])
+        else:
+            writer.write(data)
+
+    def make_response(self, request):
+        method = request.get('method')
+        self.received[method] = self.received.get(method, 0) + 1
+        msg_id = request.get('id')
+        if(method not in self.METHODS):
+            return {'jsonrpc': '2.0', 'id': msg_id, 'error': {
+                'code': -32601, 'message': f'Method not implemented: {method}'}}
+
+        params = request.get('params', {})
+        if(method == 'listContacts'):
+            # the synthetic envelopes' senders
+            return {'jsonrpc': '2.0', 'id': msg_id, 'result': [
+                {'number': '+1555'+str(1000000 + i),
+                 'uuid': '00000000-0000-4000-8000-%012d' % i,
+                 'name': f'Sender {i}', 'isBlocked': False,
+                 'profile': {'givenName': 'Sender', 'familyName': str(i)}}
+                for i in range(self.senders)]}
+        if(method == 'listGroups'):
+            return {'jsonrpc': '2.0', 'id': msg_id, 'result': [
+                {'id': b64encode(b'fake group %d' % g).decode('ascii'),
+                 'name': f'Group {g}', 'isMember': True, 'isBlocked': False,
+                 'members': [{'number': '+1555'+str(1000000 + i), 'uuid': None}
+                             for i in range(g, self.senders, self.GROUPS)]}
+                for g in range(self.GROUPS)]}
+        recipients = params.get('recipients') or [params.get('recipient')]
+        if('groupId' in params):
+            # members aren't known here
+            recipients = []
+        if(type(recipients) is str):
+            recipients = [recipients]
+        if(self.error_rate and self.random.random() < self.error_rate):
+            return {'jsonrpc': '2.0', 'id': msg_id, 'error': {
+                'code': -1, 'message': 'Failed to send message',
+                'data': {'response': {'results': [
+                    {'recipientAddress': {'number': r}, 'type': 'NETWORK_FAILURE'}
+                    for r in recipients]}}}}
+
+        if(method == 'send'):
+            result = {'timestamp': 1664746936057 + self.requests, 'results': [
+                {'recipientAddress': {'number': r}, 'type': 'SUCCESS'}
+                for r in recipients]}
+        else:
+            result = {}
+        return {'jsonrpc': '2.0', 'id': msg_id, 'result': result}
+
+    async def respond(self, writer, request):
+        await asyncio.sleep(self.delay)
+        if(not writer.is_closing()):
+            self.write(writer, codec.encode(self.make_response(request)) + b'\n')
+
+    async def send_envelopes(self, writer, account):
+        # paced in small batches so high rates don't need a timer per envelope
+        interval = max(1 / self.recv_rate, 0.01)
+        per_tick = max(int(self.recv_rate * interval), 1)
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while(not writer.is_closing()):
+            lines = []
+            for i in range(per_tick):
+                lines.append(codec.encode(make_envelope(self.envelopes, 'load', account,
+                                                          self.senders)))
+                if(self.duplicate_rate and self.random.random() < self.duplicate_rate):
+                    lines.append(lines[-1])
+                self.envelopes += 1
+            self.write(writer, b'\n'.join(lines) + b'\n')
+            await writer.drain()
+            next_tick += interval
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+
+    async def play(self, writer):
+        loop = asyncio.get_running_loop()
+        replay = self.replay
+        self.replay_start = start = loop.time()
+        i = 0
+        while(i < len(replay) and not writer.is_closing()):
+            if(self.speed):
+                due = start + replay[i][0] / self.speed
+                now = loop.time()
+                if(due > now):
+                    await asyncio.sleep(due - now)
+                    now = loop.time()
+                # everything that is due by now goes out in one write
+                j = i + 1
+                while(j < len(replay) and start + replay[j][0] / self.speed <= now):
+                    j += 1
+            else:
+                j = min(i + 1000, len(replay))
+            self.write(writer, b'\n'.join(line for ts, line in replay[i:j]) + b'\n')
+            self.replayed += j - i
+            i = j
+            await writer.drain()
+        self.replay_end = loop.time()
+
+    async def handle_client(self, reader, writer):
+        framer = JsonLineFramer()
+        sender = None
+        pending = set()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if(not data):
+                    break
+                for line in framer.feed(data):
+                    try:
+                        request = codec.decode(line)
+                    except DecodeError:
+                        continue
+                    self.requests += 1
+                    if(self.replay is not None and sender is None and self.replay_start is None):
+                        sender = asyncio.create_task(self.play(writer))
+                    elif(self.recv_rate and sender is None):
+                        account = request.get('params', {}).get('account', '+12345678901')
+                        sender = asyncio.create_task(self.send_envelopes(writer, account))
+                    if(self.delay):
+                        task = asyncio.create_task(self.respond(writer, request))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                    else:
+                        self.write(writer, codec.encode(self.make_response(request)) + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if(sender):
+                sender.cancel()
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='fake signal-cli json-rpc daemon')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7583)
+    parser.add_argument('--recv-rate', type=float, default=0,
+                        help='synthetic receive envelopes per second, once a client sends something')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='split writes into chunks of this many bytes')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds before each answer')
+    parser.add_argument('--senders', type=int, default=500,
+                        help='distinct senders of the synthetic envelopes')
+    parser.add_argument('--duplicate-rate', type=float, default=0,
+                        help='fraction of the synthetic envelopes delivered twice')
+    parser.add_argument('--replay', default='',
+                        help='play what signal-cli sent in this recording (RECORD_PATH) instead')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='replay at this many times the recorded pace, 0 = as fast as possible')
+    parser.add_argument('--max-gap', type=float, default=5,
+                        help='longest pause in a replay, longer quiet stretches are cut to this')
+    args = parser.parse_args()
+
+    async def run():
+        fake = await FakeSignalCli(args.host, args.port, args.recv_rate, args.chunk_size,
+                                   args.error_rate, args.delay,
+                                   senders=args.senders,
+                                   duplicate_rate=args.duplicate_rate,
+                                   replay=load_recording(args.replay, args.max_gap)
+                                          if args.replay else None,
+                                   speed=args.speed).start()
+        print(f'fake signal-cli listening on {args.host}:{args.port}')
+        await fake.server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+from asyncio import Semaphore as a_Semaphore, gather as a_gather
+import re
+
+from signalevent import SignalEvent
+
+class FanOut:
+    # recipients per send call to signal-cli
+    CHUNK_SIZE = 50
+    # send calls waiting on signal-cli at once per fan-out
+    CONCURRENCY = 8
+    # most recipients plus groups in one fan-out
+    MAX_TARGETS = 100000
+
+    PHONE = re.compile(r'^\+?[\d\s().\-/]+$')
+    UUID = re.compile(r'^[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}$')
+
+    # one big send call holds up signal-cli for its whole length and its
+    # failure says nothing about who got the message, so a broadcast is
+    # split into chunks (and one call per group) sent side by side, and
+    # the results arrays are put back together per recipient
+    def __init__(self, caller, chunk_size=CHUNK_SIZE, concurrency=CONCURRENCY,
+                 max_targets=MAX_TARGETS):
+        self.caller = caller
+        self.chunk_size = max(chunk_size, 1)
+        self.concurrency = max(concurrency, 1)
+        self.max_targets = max_targets
+
+    @staticmethod
+    def normalize(recipient):
+        # phone numbers lose their formatting, uuids their case, anything
+        # else (usernames) is only trimmed
+        recipient = str(recipient).strip()
+        if(FanOut.PHONE.match(recipient)):
+            return '+' + re.sub(r'\D', '', recipient)
+        if(FanOut.UUID.match(recipient)):
+            return recipient.lower()
+        return recipient
+
+    @staticmethod
+    def dedupe(targets, normalize=None):
+        # keeps the first of each, in order
+        seen = set()
+        ret = []
+        for target in targets:
+            if(normalize):
+                target = normalize(target)
+            if(target and target not in seen):
+                seen.add(target)
+                ret.append(target)
+        return ret
+
+    def make_chunks(self, recipients):
+        return [recipients[i:i + self.chunk_size]
+                for i in range(0, len(recipients), self.chunk_size)]
+
+    async def send(self, recipients, group_ids, message, priority=None, timeout=None,
+                   account=None):
+        # returns (per recipient results, per group results), in the order
+        # they were asked for
+        recipients = FanOut.dedupe(recipients, FanOut.normalize)
+        group_ids = FanOut.dedupe(group_ids)
+        limit = a_Semaphore(self.concurrency)
+
+        async def send_chunk(chunk):
+            async with limit:
+                try:
+                    event = await self.caller.send(chunk, message, timeout, priority,
+                                                   account=account)
+                except Exception as err:
+                    return [{'recipient': r, 'error': str(err) or type(err).__name__}
+                            for r in chunk]
+            return self.match_results(chunk, event)
+
+        async def send_group(group_id):
+            async with limit:
+                try:
+                    event = await self.caller.send(group_id, message, timeout, priority,
+                                                   group=True, account=account)
+                except Exception as err:
+                    return {'groupId': group_id, 'error': str(err) or type(err).__name__}
+            ret = {'groupId': group_id, 'results': event.results}
+            if(event.get_type() == SignalEvent.TYPE_ERROR):
+                ret['error'] = event.get_message()
+            return ret
+
+        chunks = self.make_chunks(recipients)
+        results = await a_gather(*[send_chunk(chunk) for chunk in chunks],
+                                 *[send_group(group_id) for group_id in group_ids])
+        return ([r for chunk in results[:len(chunks)] for r in chunk],
+                results[len(chunks):])
+
+    @staticmethod
+    def match_results(chunk, event):
+        # signal-cli answers with one entry per recipient, by number
+        # and/or uuid. anyone it left out gets the request's error
+        found = {}
+        for result in event.results:
+            address = result.get('recipientAddress') or {}
+            for key in ('number', 'uuid', 'username'):
+                if(address.get(key)):
+                    found[FanOut.normalize(address[key])] = result
+        error = event.get_message() if event.get_type() == SignalEvent.TYPE_ERROR else None
+
+        ret = []
+        for recipient in chunk:
+            result = found.get(recipient)
+            if(result is not None):
+                ret.append({'recipient': recipient, 'type': result.get('type')})
+            else:
+                ret.append({'recipient': recipient, 'error': error or 'no result from signal-cli'})
+        return ret
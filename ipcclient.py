@@ -0,0 +1,134 @@
+import asyncio
+
+from connectionpool import NoConnection
+from jsoncodec import codec
+from jsonlineframer import JsonLineFramer
+from signalsendhandler import SendQueueFull
+
+class IpcError(Exception):
+    pass
+
+class IpcClient:
+    # seconds to keep trying to reach the owner process on startup
+    CONNECT_TIMEOUT = 30
+    ERRORS = {
+        'no_connection': NoConnection,
+        'timeout': asyncio.TimeoutError,
+        'queue_full': SendQueueFull,
+    }
+
+    # a rest worker's side of IpcServer, with the same methods RestApi
+    # uses on SignalClient. inbound events from the owner go to stream
+    def __init__(self, caller, path, stream=None):
+        self.caller = caller
+        self.path = path
+        self.stream = stream
+        self.writer = None
+        self.next_id = 0
+        # request id -> future resolved with the response
+        self.requests = {}
+        self.accounts = set()
+
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        deadline = self.caller.loop.time() + timeout
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                if(self.caller.loop.time() > deadline):
+                    raise
+                await asyncio.sleep(0.1)
+        asyncio.create_task(self.reader_loop(reader))
+        self.accounts = set(await self.call('accounts'))
+        if(self.stream is not None and len(self.stream)):
+            await self.call('subscribe')
+
+    async def reader_loop(self, reader):
+        framer = JsonLineFramer()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if(not data):
+                    break
+                for line in framer.feed(data):
+                    if(line.startswith(b'{"event":')):
+                        # passed on as it came, without encoding it again
+                        encoded = line[9:-1]
+                        self.stream.publish_data(codec.decode(encoded), encoded)
+                        continue
+                    response = codec.decode(line)
+                    future = self.requests.pop(response.get('id'), None)
+                    if(future and not future.done()):
+                        future.set_result(response)
+        except ConnectionError:
+            pass
+        finally:
+            self.caller.lgr.error('lost the connection to the signal-cli owner process')
+            self.writer = None
+            for future in self.requests.values():
+                if(not future.done()):
+                    future.set_exception(SendQueueFull('signal-cli owner process went away'))
+            self.requests.clear()
+
+    async def call(self, op, **args):
+        if(self.writer is None):
+            # the owner restarted, or is restarting
+            try:
+                await self.connect(timeout=0)
+            except OSError as err:
+                raise SendQueueFull(f'signal-cli owner process is not reachable ({err})')
+        self.next_id += 1
+        future = self.caller.loop.create_future()
+        self.requests[self.next_id] = future
+        self.writer.write(codec.encode({'id': self.next_id, 'op': op, 'args': args}) + b'\n')
+        response = await future
+        if('error' in response):
+            raise IpcClient.ERRORS.get(response['error'], IpcError)(response['message'])
+        return response['result']
+
+    def set_subscribed(self, subscribe):
+        # the stream's active_cb, events only come over while this worker
+        # has subscribers of its own
+        if(not subscribe and self.writer is None):
+            # the owner dropped the subscription with the connection
+            return
+
+        async def call():
+            try:
+                await self.call('subscribe' if subscribe else 'unsubscribe')
+            except Exception as err:
+                self.caller.lgr.error('could not %s to events: %s',
+                                      'subscribe' if subscribe else 'unsubscribe', err)
+        asyncio.create_task(call())
+
+    def has_account(self, account):
+        return account in self.accounts
+
+    async def send_message(self, recipients, message, priority=None, account=None,
+                           attachments=None, idempotency_key=None, attachment_dir=None):
+        return await self.call('send', recipients=recipients, message=message,
+                               priority=priority, account=account,
+                               attachments=attachments, idempotency_key=idempotency_key,
+                               attachment_dir=attachment_dir)
+
+    async def send_batch(self, items):
+        return await self.call('batch', items=items)
+
+    async def send_fanout(self, recipients, group_ids, message, priority=None, account=None):
+        results, groups = await self.call('fanout', recipients=recipients,
+                                          group_ids=group_ids, message=message,
+                                          priority=priority, account=account)
+        return results, groups
+
+    async def get_status(self):
+        return await self.call('status')
+
+    async def get_metrics(self):
+        return await self.call('metrics')
+
+    async def get_contacts(self, key=None, offset=0, limit=100):
+        return await self.call('contacts', key=key, offset=offset, limit=limit)
+
+    async def get_groups(self, group_id=None, offset=0, limit=100):
+        return await self.call('groups', group_id=group_id, offset=offset, limit=limit)
@@ -0,0 +1,130 @@
+import asyncio
+from os import unlink
+from os.path import exists
+
+from connectionpool import NoConnection
+from jsoncodec import codec, DecodeError
+from jsonlineframer import JsonLineFramer
+from signalsendhandler import SendQueueFull
+
+class IpcServer:
+    # op -> the SignalClient method it calls
+    OPS = {
+        'send': 'send_message',
+        'batch': 'send_batch',
+        'fanout': 'send_fanout',
+        'status': 'get_status',
+        'metrics': 'get_metrics',
+        'accounts': 'get_accounts',
+        'contacts': 'get_contacts',
+        'groups': 'get_groups',
+    }
+    # exceptions the worker raises again on its side, by name
+    ERRORS = ((NoConnection, 'no_connection'),
+              (asyncio.TimeoutError, 'timeout'),
+              (SendQueueFull, 'queue_full'))
+
+    # rest workers hand their validated requests to the process that owns
+    # the signal-cli connections over a unix socket, as json lines of
+    # {id, op, args} answered by {id, result} or {id, error, message}.
+    # requests on one connection are handled concurrently. a worker with
+    # /events subscribers sends a subscribe op and gets every inbound event
+    # as an {event} line until it unsubscribes
+    def __init__(self, caller, path):
+        self.caller = caller
+        self.path = path
+        self.server = None
+        self.requests = 0
+
+    async def start(self):
+        # left over from a process that didn't get to clean up
+        if(exists(self.path)):
+            unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client, self.path)
+
+    async def close(self):
+        if(self.server):
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if(exists(self.path)):
+            unlink(self.path)
+
+    async def handle_client(self, reader, writer):
+        framer = JsonLineFramer()
+        tasks = set()
+        subscription = None
+        try:
+            while True:
+                data = await reader.read(65536)
+                if(not data):
+                    break
+                for line in framer.feed(data):
+                    try:
+                        request = codec.decode(line)
+                    except DecodeError as e:
+                        self.caller.lgr.error('bad ipc request: %s', e)
+                        continue
+                    if(request.get('op') in ('subscribe', 'unsubscribe')):
+                        # in order, so a quick unsubscribe can't overtake it
+                        subscription = self.set_subscribed(writer, subscription,
+                                                           request['op'] == 'subscribe')
+                        writer.write(codec.encode({'id': request.get('id'),
+                                                   'result': subscription is not None}) + b'\n')
+                        continue
+                    task = asyncio.create_task(self.handle_request(writer, request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.CancelledError):
+            # cancelled at shutdown, the streams callback doesn't expect
+            # this task to end cancelled
+            pass
+        finally:
+            self.set_subscribed(writer, subscription, False)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    def set_subscribed(self, writer, subscription, subscribe):
+        # returns the (subscriber, forwarding task) now in place, if any
+        if(subscription is not None and not subscribe):
+            subscriber, task = subscription
+            subscriber.close()
+            task.cancel()
+            return None
+        if(subscription is None and subscribe and self.caller.stream is not None):
+            # the worker's own subscribers have their own buffers and
+            # policies, this one just shouldn't hold anything up
+            subscriber = self.caller.stream.subscribe('ipc', policy='drop_oldest')
+            if(subscriber is not None):
+                return subscriber, asyncio.create_task(self.forward_events(writer, subscriber))
+        return subscription
+
+    async def forward_events(self, writer, subscriber):
+        try:
+            while True:
+                frame = await subscriber.get()
+                if(frame is None or writer.is_closing()):
+                    break
+                writer.write(frame)
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_request(self, writer, request):
+        self.requests += 1
+        try:
+            method = getattr(self.caller, IpcServer.OPS[request['op']])
+            response = {'id': request['id'],
+                        'result': await method(**(request.get('args') or {}))}
+        except Exception as err:
+            kind = 'failed'
+            for exc_type, name in IpcServer.ERRORS:
+                if(isinstance(err, exc_type)):
+                    kind = name
+                    break
+            if(kind == 'failed'):
+                self.caller.lgr.exception(f'ipc request {request.get("op")} failed')
+            response = {'id': request.get('id'), 'error': kind, 'message': str(err)}
+        if(not writer.is_closing()):
+            writer.write(codec.encode(response) + b'\n')
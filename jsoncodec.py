@@ -0,0 +1,61 @@
+from json import JSONEncoder, loads as j_decode
+from json.encoder import encode_basestring_ascii
+
+# faster codecs are used when installed, they are not required
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+class JsonCodec:
+    # in order of preference for 'auto'
+    CODECS = ('orjson', 'msgspec', 'json')
+    AUTO = 'auto'
+
+    # whatever the codec, encode returns utf-8 bytes and decode takes
+    # bytes (or str), so nothing on the socket path goes through str.
+    # quote encodes a single str, for filling in prebuilt json
+    def __init__(self, name=AUTO):
+        self.use(name)
+
+    @staticmethod
+    def available():
+        modules = {'orjson': orjson, 'msgspec': msgspec, 'json': True}
+        return [name for name in JsonCodec.CODECS if modules[name]]
+
+    def use(self, name):
+        if(name == JsonCodec.AUTO):
+            name = JsonCodec.available()[0]
+        if(name not in JsonCodec.available()):
+            raise ValueError(f'json codec {name} is not available, '
+                             f'choose from {JsonCodec.available()}')
+
+        if(name == 'orjson'):
+            self.encode = orjson.dumps
+            self.decode = orjson.loads
+            self.quote = orjson.dumps
+        elif(name == 'msgspec'):
+            self.encode = msgspec.json.Encoder().encode
+            self.decode = msgspec.json.Decoder().decode
+            self.quote = self.encode
+        else:
+            # json.dumps builds a new encoder whenever it gets options
+            encoder = JSONEncoder(separators=(',', ':'))
+            self.encode = lambda obj: encoder.encode(obj).encode('utf-8')
+            self.decode = j_decode
+            self.quote = lambda text: encode_basestring_ascii(text).encode('utf-8')
+        self.name = name
+
+# every codec's decode errors, for except clauses
+if(msgspec):
+    DecodeError = (ValueError, msgspec.DecodeError)
+else:
+    DecodeError = (ValueError,)
+
+# shared by the send and receive paths, switch it with codec.use()
+codec = JsonCodec()
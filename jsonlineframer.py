@@ -0,0 +1,79 @@
+class JsonLineFramer:
+    # signal-cli json-rpc messages are delimited by a single return, so a
+    # tcp read can hold several messages, part of one or even stop in the
+    # middle of a multi-byte utf-8 character. the framer works on raw bytes
+    # and only hands back complete lines, keeping the trailing partial line
+    # around until its return arrives
+    DELIMITER = b'\n'
+    # envelopes are small, anything bigger than this is most likely a
+    # desynced stream, so drop it instead of growing without bound
+    MAX_LINE = 16 * 1024 * 1024
+
+    def __init__(self, max_line=MAX_LINE, overflow_cb=None):
+        self.buffer = bytearray()
+        self.max_line = max_line
+        self.overflow_cb = overflow_cb
+        # bytes at the front of the buffer already known to have no return
+        self.scanned = 0
+        # set while skipping the rest of an oversized line
+        self.discarding = False
+        self.discarded = 0
+
+    def feed(self, data):
+        lines = []
+        buf = self.buffer
+
+        # fast path: nothing buffered and the chunk holds only whole lines
+        if(not buf and not self.discarding and data.endswith(self.DELIMITER)
+           and len(data) <= self.max_line):
+            for line in data.split(self.DELIMITER):
+                # sometimes we just get return characters, ignore those
+                if(line and not line.isspace()):
+                    lines.append(line)
+            return lines
+
+        buf += data
+        start = 0
+        pos = buf.find(self.DELIMITER, self.scanned)
+        while(pos != -1):
+            if(self.discarding):
+                # end of an oversized line we already reported
+                self.discarding = False
+            elif(pos - start > self.max_line):
+                self.discard(pos - start)
+            elif(pos > start):
+                line = bytes(memoryview(buf)[start:pos])
+                if(not line.isspace()):
+                    lines.append(line)
+            start = pos + 1
+            pos = buf.find(self.DELIMITER, start)
+
+        # only keep the trailing partial line
+        if(start):
+            del buf[:start]
+        self.scanned = len(buf)
+
+        if(self.discarding):
+            # still inside an oversized line, nothing here is worth keeping
+            buf.clear()
+            self.scanned = 0
+        elif(self.scanned > self.max_line):
+            # no return in sight, drop what we have and skip until the next one
+            self.discard(self.scanned)
+            self.discarding = True
+            buf.clear()
+            self.scanned = 0
+        return lines
+
+    def discard(self, size):
+        self.discarded += 1
+        if(self.overflow_cb):
+            self.overflow_cb(size)
+
+    def pending(self):
+        return len(self.buffer)
+
+    def reset(self):
+        self.buffer.clear()
+        self.scanned = 0
+        self.discarding = False
@@ -0,0 +1,121 @@
+import asyncio
+from time import perf_counter
+
+# uvloop is used when asked for (or 'auto') and installed, not required
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+class LoopMonitor:
+    # event loop implementations, in order of preference for 'auto'
+    LOOPS = ('uvloop', 'asyncio')
+    AUTO = 'auto'
+    # seconds between loop lag samples
+    LAG_INTERVAL = 0.5
+    # a callback or task step running this many seconds blocked the loop,
+    # 0 leaves them untimed
+    SLOW_CALLBACK = 0
+    # lag logged as a warning when slow callbacks aren't timed
+    LAG_WARNING = 0.1
+
+    # how late the loop gets around to a timer (lag) and which callbacks
+    # hold it up (slow callbacks), reported to the caller's on_loop_lag and
+    # on_slow_callback. slow callbacks are only timed when asked for, by
+    # wrapping asyncio's Handle._run for as long as our loop runs. uvloop
+    # doesn't use it, so with uvloop only the lag is measured
+    def __init__(self, caller, lag_interval=LAG_INTERVAL, slow_callback=SLOW_CALLBACK):
+        self.caller = caller
+        self.lag_interval = lag_interval
+        self.slow_callback = slow_callback
+        # (asyncio's Handle._run, our wrapper) while installed
+        self.wrapped = None
+
+        # stats for /status
+        self.lag = 0
+        self.lag_max = 0
+        self.slow = 0
+        self.slowest = ''
+        self.slowest_took = 0
+
+    @staticmethod
+    def new_event_loop(name='asyncio'):
+        # uvloop when asked for and installed, otherwise asyncio's own
+        if(name not in LoopMonitor.LOOPS + (LoopMonitor.AUTO,)):
+            raise ValueError(f'event loop must be one of {LoopMonitor.LOOPS + (LoopMonitor.AUTO,)}')
+        if(name in ('uvloop', LoopMonitor.AUTO) and uvloop):
+            loop = uvloop.new_event_loop()
+        else:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+    @staticmethod
+    def get_name(loop):
+        return 'uvloop' if uvloop and isinstance(loop, uvloop.Loop) else 'asyncio'
+
+    @staticmethod
+    def describe(handle):
+        # the coroutine of the task a step belongs to, or the callback. no
+        # task names or ids, it ends up as a metric label
+        callback = handle._callback
+        task = getattr(callback, '__self__', None)
+        if(isinstance(task, asyncio.Task)):
+            callback = task.get_coro()
+        return getattr(callback, '__qualname__', None) or type(callback).__name__
+
+    def install(self):
+        # every asyncio callback and task step goes through Handle._run,
+        # only the ones on our loop are timed
+        if(self.wrapped or self.slow_callback <= 0 or
+           LoopMonitor.get_name(self.caller.loop) != 'asyncio'):
+            return
+        monitor = self
+        loop = self.caller.loop
+        run = asyncio.events.Handle._run
+
+        def timed_run(handle):
+            if(handle._loop is not loop):
+                return run(handle)
+            start = perf_counter()
+            run(handle)
+            took = perf_counter() - start
+            if(took >= monitor.slow_callback):
+                monitor.report_slow(handle, took)
+        asyncio.events.Handle._run = timed_run
+        self.wrapped = (run, timed_run)
+
+    def uninstall(self):
+        # puts back what was there, unless somebody wrapped it since
+        if(self.wrapped):
+            run, timed_run = self.wrapped
+            if(asyncio.events.Handle._run is timed_run):
+                asyncio.events.Handle._run = run
+            self.wrapped = None
+
+    def report_slow(self, handle, took):
+        name = LoopMonitor.describe(handle)
+        self.slow += 1
+        if(took > self.slowest_took):
+            self.slowest = name
+            self.slowest_took = took
+        self.caller.on_slow_callback(name, took)
+
+    async def run_loop(self):
+        loop = self.caller.loop
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lag = max(loop.time() - start - self.lag_interval, 0)
+            self.lag_max = max(self.lag_max, self.lag)
+            self.caller.on_loop_lag(self.lag)
+
+    def get_stats(self):
+        return {
+            'event_loop': LoopMonitor.get_name(self.caller.loop),
+            'lag_ms': round(self.lag * 1000, 3),
+            'lag_max_ms': round(self.lag_max * 1000, 3),
+            'slow_callbacks': self.slow,
+            'slowest': self.slowest,
+            'slowest_ms': round(self.slowest_took * 1000, 3),
+        }
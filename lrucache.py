@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from time import monotonic
+
+class LruCache:
+    MISSING = object()
+
+    # a dict holding at most max_size entries, the least recently used
+    # going first, and none for longer than ttl seconds (0 = no limit).
+    # expired entries are dropped when they are looked up, or as the
+    # least recently used ones, so max_size is what bounds the memory
+    def __init__(self, max_size, ttl=0, clock=monotonic):
+        self.max_size = max(max_size, 1)
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (clock time it expires at, value)
+        self.entries = OrderedDict()
+
+        # stats for /status
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if(entry is not None and self.ttl and entry[0] <= self.clock()):
+            del self.entries[key]
+            self.expired += 1
+            entry = None
+        if(entry is None):
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while(len(self.entries) > self.max_size):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def add(self, key):
+        # for using it as a set of recently seen keys: False if key was
+        # already there, otherwise it is added and True is returned
+        if(self.get(key, LruCache.MISSING) is not LruCache.MISSING):
+            return False
+        self.put(key, True)
+        return True
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def get_stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+        }
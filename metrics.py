@@ -0,0 +1,97 @@
+from bisect import bisect_left
+
+# minimal prometheus text format metrics. updates on the hot paths are a
+# dict lookup and an add, everything else happens when /metrics is scraped
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    return '{'+','.join(pairs)+'}' if pairs else ''
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values tuple -> count
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        return [f'{self.name}{format_labels(self.labels, k)} {v}'
+                for k, v in self.values.items()]
+
+class Gauge:
+    TYPE = 'gauge'
+
+    # the value is read from a callback when scraped
+    def __init__(self, name, help, value_cb):
+        self.name = name
+        self.help = help
+        self.value_cb = value_cb
+
+    def render(self):
+        return [f'{self.name} {self.value_cb()}']
+
+class Histogram:
+    TYPE = 'histogram'
+    # seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = []
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {total}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+class MetricsRegistry:
+    CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, value_cb):
+        return self.add(Gauge(name, help, value_cb))
+
+    def histogram(self, name, help, buckets=Histogram.BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
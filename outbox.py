@@ -0,0 +1,154 @@
+import sqlite3
+from queue import SimpleQueue, Empty
+from threading import Thread
+from time import time
+
+from jsoncodec import codec
+
+class Outbox:
+    # most operations grouped into one transaction
+    BATCH_MAX = 500
+
+    # messages accepted through the REST api are stored here until
+    # signal-cli answers for them, and sent again after a restart if it
+    # never did. all database work happens on one thread, which commits
+    # whatever piled up while the previous commit was running, so the
+    # cost per message shrinks as the rate goes up
+    def __init__(self, caller, path, batch_max=BATCH_MAX):
+        self.caller = caller
+        self.path = path
+        self.batch_max = batch_max
+        self.ops = SimpleQueue()
+        self.thread = None
+        self.commits = 0
+        self.committed = 0
+
+    def start(self):
+        # opened here so a bad path fails at startup, then handed to the thread
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # a process crash can't lose a committed transaction in wal mode
+        # with synchronous=NORMAL, only a power cut can lose the last few
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                   'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                   'created REAL, recipients BLOB, message TEXT, priority INTEGER, '
+                   'account TEXT)')
+        # files from before sends could pick their account
+        if('account' not in [row[1] for row in db.execute('PRAGMA table_info(outbox)')]):
+            db.execute('ALTER TABLE outbox ADD COLUMN account TEXT')
+        db.commit()
+        self.thread = Thread(target=self.writer_loop, args=(db,),
+                             name='outbox', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # finishes everything queued before returning
+        if(self.thread):
+            self.ops.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def depth(self):
+        return self.ops.qsize()
+
+    def submit(self, op, args):
+        future = self.caller.loop.create_future()
+        self.ops.put((op, args, future))
+        return future
+
+    async def append(self, recipients, message, priority, account=None):
+        # resolves with the row's seq once it is committed
+        seqs = await self.submit('append', [(recipients, message, priority, account)])
+        return seqs[0]
+
+    async def append_many(self, items):
+        # items are (recipients, message, priority, account), all in one commit
+        return await self.submit('append', items)
+
+    def done(self, seq):
+        # signal-cli answered, nobody needs to wait for the delete
+        self.ops.put(('done', seq, None))
+
+    async def load(self):
+        # everything accepted by an earlier run and never answered, oldest
+        # first, as (seq, recipients, message, priority, account)
+        return await self.submit('load', None)
+
+    def resolve(self, future, result):
+        if(not future.done()):
+            future.set_result(result)
+
+    def fail(self, future, exc):
+        if(not future.done()):
+            future.set_exception(exc)
+
+    def writer_loop(self, db):
+        while True:
+            op = self.ops.get()
+            if(op is None):
+                break
+            ops = [op]
+            stop = False
+            while(len(ops) < self.batch_max):
+                try:
+                    op = self.ops.get_nowait()
+                except Empty:
+                    break
+                if(op is None):
+                    stop = True
+                    break
+                ops.append(op)
+
+            try:
+                self.commit(db, ops)
+            except Exception as e:
+                if(len(ops) == 1):
+                    self.report(ops[0], e)
+                else:
+                    # one bad operation shouldn't take the rest of the batch
+                    # down with it, so each is tried again on its own
+                    self.caller.lgr.warning('outbox commit of %d operations failed, '
+                                            'retrying them one at a time: %s', len(ops), e)
+                    for op in ops:
+                        try:
+                            self.commit(db, [op])
+                        except Exception as e:
+                            self.report(op, e)
+            if(stop):
+                break
+        db.close()
+
+    def commit(self, db, ops):
+        # all of ops in one transaction, nothing is resolved unless it commits
+        with db:
+            results = [(future, self.execute(db, op, args)) for op, args, future in ops]
+        self.commits += 1
+        self.committed += len(ops)
+        for future, result in results:
+            if(future):
+                self.caller.loop.call_soon_threadsafe(self.resolve, future, result)
+
+    def report(self, op, exc):
+        op, args, future = op
+        self.caller.lgr.error('outbox %s failed: %s', op, exc)
+        if(future):
+            self.caller.loop.call_soon_threadsafe(self.fail, future, exc)
+
+    def execute(self, db, op, args):
+        if(op == 'append'):
+            now = time()
+            seqs = []
+            for recipients, message, priority, account in args:
+                cur = db.execute('INSERT INTO outbox (created, recipients, message, priority, account) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 (now, codec.encode(recipients), message, priority, account))
+                seqs.append(cur.lastrowid)
+            return seqs
+        elif(op == 'done'):
+            db.execute('DELETE FROM outbox WHERE seq = ?', (args,))
+        elif(op == 'load'):
+            return [(seq, codec.decode(recipients), message, priority, account)
+                    for seq, recipients, message, priority, account in
+                    db.execute('SELECT seq, recipients, message, priority, account '
+                               'FROM outbox ORDER BY seq')]
@@ -0,0 +1,65 @@
+from asyncio import wait_for as a_wait_for, TimeoutError as a_TimeoutError
+
+class PendingRequests:
+    # seconds to wait for signal-cli to answer a json-rpc request
+    TIMEOUT = 30
+
+    def __init__(self, loop, timeout=TIMEOUT):
+        self.loop = loop
+        self.timeout = timeout
+        # json-rpc id -> (future resolved with the matching result/error
+        # event, loop time the request was made)
+        self.requests = {}
+        # requests that got their answer
+        self.resolved = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, msg_id):
+        return msg_id in self.requests
+
+    def add(self, msg_id):
+        if(msg_id in self.requests):
+            raise KeyError(f'request id {msg_id} is already pending')
+        future = self.loop.create_future()
+        self.requests[msg_id] = (future, self.loop.time())
+        return future
+
+    def get_start(self, msg_id):
+        request = self.requests.get(msg_id)
+        return request[1] if request else None
+
+    async def wait(self, msg_id, timeout=None):
+        if(timeout is None):
+            timeout = self.timeout
+        future = self.requests[msg_id][0]
+        try:
+            return await a_wait_for(future, timeout)
+        except a_TimeoutError:
+            raise a_TimeoutError(f'no response to request id {msg_id} after {timeout}s')
+        finally:
+            # whatever happened, the id is no longer of interest
+            request = self.requests.get(msg_id)
+            if(request and request[0] is future):
+                del self.requests[msg_id]
+
+    def discard(self, msg_id):
+        request = self.requests.pop(msg_id, None)
+        if(request and not request[0].done()):
+            request[0].cancel()
+
+    def resolve(self, event):
+        # returns True if somebody was waiting on this result
+        request = self.requests.get(event.id)
+        if(request is None or request[0].done()):
+            return False
+        request[0].set_result(event)
+        self.resolved += 1
+        return True
+
+    def fail_all(self, exc):
+        for future, start in self.requests.values():
+            if(not future.done()):
+                future.set_exception(exc)
+        self.requests.clear()
@@ -0,0 +1,87 @@
+from asyncio import Event as a_Event, sleep as a_sleep
+
+from signalevent import SignalEvent
+from signalsendhandler import SendQueueFull
+
+class ReceiptAggregator:
+    # seconds a receipt waits for more messages from the same sender
+    WINDOW = 0.25
+    # most message timestamps acknowledged by one sendReceipt
+    MAX_TIMESTAMPS = 100
+
+    # signal-cli takes a list of targetTimestamps, so in a busy chat one
+    # sendReceipt covers everything a sender sent during the window
+    # instead of one request per message
+    def __init__(self, caller, window=WINDOW, max_timestamps=MAX_TIMESTAMPS):
+        self.caller = caller
+        self.window = window
+        self.max_timestamps = max(max_timestamps, 1)
+        # (account, sender) -> (loop time to send by, [timestamps],
+        # connection the messages came in on). the window is the same for
+        # everybody so insertion order is the order they are due in
+        self.batches = {}
+        self.wakeup = a_Event()
+
+        # stats for /status
+        self.timestamps = 0
+        self.requests = 0
+
+    def __len__(self):
+        return sum(len(batch[1]) for batch in self.batches.values())
+
+    async def add(self, account, sender, timestamp, connection=None):
+        if(self.window <= 0):
+            self.timestamps += 1
+            await self.send(account, sender, [timestamp], connection)
+            return
+        key = (account, sender)
+        batch = self.batches.get(key)
+        if(batch is None):
+            batch = self.batches[key] = (self.caller.loop.time() + self.window, [], connection)
+            if(len(self.batches) == 1):
+                self.wakeup.set()
+        if(timestamp in batch[1]):
+            # a handler acknowledging a message that already is
+            return
+        self.timestamps += 1
+        batch[1].append(timestamp)
+        if(len(batch[1]) >= self.max_timestamps):
+            del self.batches[key]
+            await self.send(account, sender, batch[1], batch[2])
+
+    async def send(self, account, sender, timestamps, connection=None):
+        self.requests += 1
+        msg_id = self.caller.get_next_sent_id()
+        if(len(timestamps) == 1):
+            timestamps = timestamps[0]
+        msg = SignalEvent.make_receipt(account, sender, timestamps, msg_id=msg_id)
+        try:
+            if(connection):
+                await connection.send_raw(msg, msg_id)
+            else:
+                await self.caller.send_raw(msg, msg_id, account)
+        except SendQueueFull:
+            # receipts are a courtesy, not worth holding up the loop for
+            self.caller.lgr.warning('send queue is full, dropped read receipt to %s', sender)
+
+    async def flush(self):
+        # sends everything still waiting, used at shutdown
+        batches = self.batches
+        self.batches = {}
+        for (account, sender), (deadline, timestamps, connection) in batches.items():
+            await self.send(account, sender, timestamps, connection)
+
+    async def run_loop(self):
+        while True:
+            if(not self.batches):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            key, (deadline, timestamps, connection) = next(iter(self.batches.items()))
+            delay = deadline - self.caller.loop.time()
+            if(delay > 0):
+                # whatever is added meanwhile is due after this one
+                await a_sleep(delay)
+                continue
+            del self.batches[key]
+            await self.send(key[0], key[1], timestamps, connection)
@@ -0,0 +1,462 @@
+from asyncio import TimeoutError as a_TimeoutError, create_task as a_create_task
+from aiohttp import web, WSCloseCode
+
+from attachmentstore import AttachmentTooLarge
+from connectionpool import NoConnection
+from eventstream import EventStream
+from fanout import FanOut
+from jsoncodec import codec, DecodeError
+from metrics import MetricsRegistry
+from sendscheduler import SendScheduler
+from signalsendhandler import SendQueueFull
+
+class RestApi:
+    INVALID_MESSAGE = ('must have recipients and a text message, '
+                       'priority if given must be alert, normal or digest')
+    INVALID_RECIPIENTS = 'recipients must be a number or group id, or a list of them'
+    # seconds between keepalives on an idle /events stream
+    KEEPALIVE = 15
+    # longest Idempotency-Key accepted
+    IDEMPOTENCY_KEY_MAX = 255
+
+    # the http side: parsing, validation and responses. everything that
+    # needs signal-cli goes through the backend, which is the SignalClient
+    # itself, or an IpcClient forwarding to it from a rest worker process:
+    #   send_message(recipients, message, priority, account, attachments,
+    #   idempotency_key)
+    #   send_batch(items), send_fanout(recipients, group_ids, message,
+    #   priority, account), get_status(), get_metrics(), has_account(account),
+    #   get_contacts(key, offset, limit), get_groups(group_id, offset, limit)
+    def __init__(self, caller, backend, batch_max, fanout_max, attachments=None, stream=None):
+        self.caller = caller
+        self.backend = backend
+        # most messages accepted by one /batch request
+        self.batch_max = batch_max
+        self.fanout_max = fanout_max
+        # AttachmentStore for /attachments, None when not enabled
+        self.attachments = attachments
+        # EventStream for /events, None when not enabled
+        self.stream = stream
+        # cleared at shutdown, requests get a 503 from then on
+        self.accepting = True
+        # requests being handled
+        self.inflight = 0
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.drain_middleware])
+        app.router.add_post('/', self.rest_handler)
+        app.router.add_post('/batch', self.batch_handler)
+        app.router.add_post('/attachments', self.attachment_handler)
+        app.router.add_post('/fanout', self.fanout_handler)
+        app.router.add_get('/events', self.events_handler)
+        app.router.add_get('/contacts', self.contacts_handler)
+        app.router.add_get('/groups', self.groups_handler)
+        app.router.add_get('/status', self.status_handler)
+        app.router.add_get('/metrics', self.metrics_handler)
+        return app
+
+    @web.middleware
+    async def drain_middleware(self, request, handler):
+        if(not self.accepting):
+            data = {'error': 'shutting down'}
+            return web.json_response(data, status=503,
+                                     headers={'Retry-After': '1', 'Connection': 'close'})
+        self.inflight += 1
+        try:
+            return await handler(request)
+        finally:
+            self.inflight -= 1
+
+    def stop_accepting(self):
+        # requests already being handled carry on. /events subscribers
+        # stay until the stream is closed
+        self.accepting = False
+
+    async def serve(self, host, port, reuse_port=None):
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port, reuse_port=reuse_port)
+        await site.start()
+        return runner
+
+    @staticmethod
+    def get_idempotency_key(request):
+        # returns (key or None, error response or None)
+        key = request.headers.get('Idempotency-Key')
+        if(key is not None and not 0 < len(key) <= RestApi.IDEMPOTENCY_KEY_MAX):
+            data = {'error': f'Idempotency-Key must be 1 to {RestApi.IDEMPOTENCY_KEY_MAX} characters'}
+            return None, web.json_response(data, status=400)
+        return key, None
+
+    @staticmethod
+    def make_send_response(data):
+        # a repeated Idempotency-Key gets the first request's result
+        headers = {'Idempotent-Replayed': 'true'} if data.pop('replayed', False) else None
+        return web.json_response(data, status=200, headers=headers)
+
+    def elapsed_ms(self, start):
+        return round((self.caller.loop.time() - start)*1000, 3)
+
+    @staticmethod
+    def send_error_response(err):
+        # what a send that never got an answer from signal-cli looks like
+        data = {'error': str(err)}
+        if(isinstance(err, NoConnection)):
+            return web.json_response(data, status=400)
+        if(isinstance(err, a_TimeoutError)):
+            return web.json_response(data, status=504)
+        return web.json_response(data, status=503, headers={'Retry-After': '1'})
+
+    async def rest_handler(self, request):
+        try:
+            json = await request.json(loads=codec.decode)
+
+            if(self.is_valid_message(json)):
+                key, error = self.get_idempotency_key(request)
+                if(error):
+                    return error
+
+                start = self.caller.loop.time()
+                try:
+                    data = await self.backend.send_message(
+                        json['recipients'],
+                        json['message'],
+                        priority=json.get('priority'),
+                        account=json.get('account'),
+                        idempotency_key=key,
+                    )
+                except (NoConnection, a_TimeoutError, SendQueueFull) as err:
+                    return self.send_error_response(err)
+
+                data['latency_ms'] = self.elapsed_ms(start)
+                return self.make_send_response(data)
+            elif(type(json) is dict and 'recipients' in json and
+                 not self.is_valid_recipients(json['recipients'])):
+                data = {'error': RestApi.INVALID_RECIPIENTS}
+                return web.json_response(data, status=400)
+            else:
+                data = {'error': RestApi.INVALID_MESSAGE}
+                return web.json_response(data, status=400)
+        except DecodeError as err:
+            data = {'error': 'invalid json format: '+str(err)}
+            self.caller.lgr.warning('invalid json')
+            return web.json_response(data, status=200)
+
+    async def batch_handler(self, request):
+        # accepts either a json array of {recipients, message} objects or
+        # the same objects as newline delimited json (application/x-ndjson)
+        items = []
+        try:
+            if(request.content_type == 'application/x-ndjson'):
+                async for line in request.content:
+                    if(line.strip()):
+                        items.append(codec.decode(line))
+                    if(len(items) > self.batch_max):
+                        break
+            else:
+                items = await request.json(loads=codec.decode)
+        except DecodeError as err:
+            data = {'error': 'invalid json format: '+str(err)}
+            self.caller.lgr.warning('invalid json')
+            return web.json_response(data, status=400)
+
+        if(type(items) is not list):
+            data = {'error': 'batch must be a list of messages'}
+            return web.json_response(data, status=400)
+        if(len(items) > self.batch_max):
+            data = {'error': f'batch is limited to {self.batch_max} messages'}
+            return web.json_response(data, status=413)
+
+        # validate everything before anything goes out, the sends are
+        # queued in order and their writes to signal-cli get coalesced
+        start = self.caller.loop.time()
+        responses = [None] * len(items)
+        sending = []
+        for i, item in enumerate(items):
+            if(not self.is_valid_message(item)):
+                responses[i] = {'error': RestApi.INVALID_MESSAGE}
+            elif(item.get('account') and not self.backend.has_account(item['account'])):
+                responses[i] = {'error': f'no signal-cli connection for account {item["account"]}'}
+            else:
+                sending.append(i)
+
+        results = await self.backend.send_batch([items[i] for i in sending])
+        for i, result in zip(sending, results):
+            responses[i] = result
+
+        data = {'results': responses,
+                'latency_ms': self.elapsed_ms(start)}
+        return web.json_response(data, status=200)
+
+    async def fanout_handler(self, request):
+        # {recipients, groupIds, message, priority}: recipients are cleaned
+        # up, deduplicated and sent in chunks, each group gets its own send,
+        # and the response has a result per recipient and per group
+        try:
+            json = await request.json(loads=codec.decode)
+        except DecodeError as err:
+            data = {'error': 'invalid json format: '+str(err)}
+            self.caller.lgr.warning('invalid json')
+            return web.json_response(data, status=400)
+
+        if(type(json) is not dict):
+            json = {}
+        recipients = json.get('recipients') or []
+        group_ids = json.get('groupIds') or []
+        if(type(recipients) is str):
+            recipients = [recipients]
+        if(type(group_ids) is str):
+            group_ids = [group_ids]
+        if(type(recipients) is not list or type(group_ids) is not list or
+           not self.is_valid_message(dict(json, recipients=recipients + group_ids))):
+            data = {'error': 'must have recipients and/or groupIds, and a message, '
+                             'priority if given must be alert, normal or digest'}
+            return web.json_response(data, status=400)
+        if(json.get('account') and not self.backend.has_account(json['account'])):
+            data = {'error': f'no signal-cli connection for account {json["account"]}'}
+            return web.json_response(data, status=400)
+        if(len(recipients) + len(group_ids) > self.fanout_max):
+            data = {'error': f'fan-out is limited to {self.fanout_max} recipients and groups'}
+            return web.json_response(data, status=413)
+
+        start = self.caller.loop.time()
+        results, groups = await self.backend.send_fanout(recipients, group_ids, json['message'],
+                                                         json.get('priority'),
+                                                         json.get('account'))
+        sent = (sum(1 for r in results if r.get('type') == 'SUCCESS') +
+                sum(1 for g in groups if 'error' not in g))
+        data = {'results': results,
+                'groups': groups,
+                'sent': sent,
+                'failed': len(results) + len(groups) - sent,
+                'latency_ms': self.elapsed_ms(start)}
+        return web.json_response(data, status=200)
+
+    async def attachment_handler(self, request):
+        # multipart form with recipients (a json array or one field per
+        # recipient), message, optional priority and any number of files.
+        # the files are streamed to the shared directory and removed once
+        # the send is done with them, which can be after this request
+        if(self.attachments is None):
+            data = {'error': 'attachments are not enabled, set ATTACHMENT_DIR'}
+            return web.json_response(data, status=404)
+        if(not request.content_type.startswith('multipart/')):
+            data = {'error': 'attachments must be sent as multipart/form-data'}
+            return web.json_response(data, status=400)
+        key, error = self.get_idempotency_key(request)
+        if(error):
+            return error
+
+        start = self.caller.loop.time()
+        json = {'recipients': [], 'message': ''}
+        paths = []
+        directory = await self.attachments.create()
+        # the backend removes the directory once it has the send
+        sending = False
+        try:
+            reader = await request.multipart()
+            while True:
+                part = await reader.next()
+                if(part is None):
+                    break
+                name = getattr(part, 'name', None)
+                if(getattr(part, 'filename', None) is not None):
+                    if(len(paths) >= self.attachments.max_files):
+                        data = {'error': f'limited to {self.attachments.max_files} attachments'}
+                        return web.json_response(data, status=413)
+                    paths.append(await self.attachments.save(directory, part, len(paths)))
+                elif(name == 'recipients'):
+                    value = (await part.text()).strip()
+                    if(value.startswith('[')):
+                        json['recipients'].extend(codec.decode(value))
+                    elif(value):
+                        json['recipients'].append(value)
+                elif(name in ('message', 'priority', 'account')):
+                    json[name] = await part.text()
+                else:
+                    await part.release()
+
+            # a message can be just the attachments
+            if(not self.is_valid_message(dict(json, message=json['message'] or (' ' if paths else '')))):
+                data = {'error': RestApi.INVALID_MESSAGE}
+                return web.json_response(data, status=400)
+            try:
+                sending = True
+                data = await self.backend.send_message(json['recipients'], json['message'],
+                                                       priority=json.get('priority'),
+                                                       account=json.get('account'),
+                                                       attachments=paths,
+                                                       idempotency_key=key,
+                                                       attachment_dir=directory)
+            except (NoConnection, a_TimeoutError, SendQueueFull) as err:
+                # a send that timed out may still be using the files,
+                # the others never got going
+                sending = isinstance(err, a_TimeoutError)
+                return self.send_error_response(err)
+
+            data['attachments'] = len(paths)
+            data['latency_ms'] = self.elapsed_ms(start)
+            return self.make_send_response(data)
+        except AttachmentTooLarge as err:
+            data = {'error': str(err)}
+            return web.json_response(data, status=413)
+        except DecodeError as err:
+            data = {'error': 'invalid json format: '+str(err)}
+            return web.json_response(data, status=400)
+        finally:
+            if(not sending):
+                await self.attachments.remove(directory)
+
+    async def events_handler(self, request):
+        # inbound events as server-sent events, or over a websocket when
+        # the request asks for an upgrade. filtered with any of the
+        # EventStream.FILTERS as comma separated query parameters, e.g.
+        # /events?subtype=message,receipt&sender=+12345678901
+        if(self.stream is None):
+            data = {'error': 'the event stream is not enabled'}
+            return web.json_response(data, status=404)
+        filters = {}
+        for field in EventStream.FILTERS:
+            raw = request.query.getall(field, [])
+            if(field == 'group_id'):
+                # a + in a query string comes through as a space, and base64
+                # group ids have +s but never spaces
+                raw = [value.replace(' ', '+') for value in raw]
+            values = {v.strip() for value in raw for v in value.split(',') if v.strip()}
+            if(values and field in ('sender', 'account')):
+                # numbers are cleaned up, which puts their + back
+                values = {FanOut.normalize(v) for v in values}
+            if(values):
+                filters[field] = values
+        policy = request.query.get('policy')
+        if(policy is not None and policy not in EventStream.POLICIES):
+            data = {'error': f'policy must be one of {EventStream.POLICIES}'}
+            return web.json_response(data, status=400)
+        try:
+            buffer_size = int(request.query.get('buffer', 0))
+        except ValueError:
+            data = {'error': 'buffer must be a number of events'}
+            return web.json_response(data, status=400)
+
+        ws = web.WebSocketResponse(heartbeat=RestApi.KEEPALIVE)
+        is_ws = ws.can_prepare(request).ok
+        subscriber = self.stream.subscribe('ws' if is_ws else 'sse', filters,
+                                           buffer_size, policy)
+        if(subscriber is None):
+            data = {'error': f'limited to {self.stream.max_subscribers} subscribers'}
+            return web.json_response(data, status=503, headers={'Retry-After': '5'})
+        self.caller.lgr.info('%s subscriber from %s, filters %s', 'websocket' if is_ws else 'sse',
+                             request.remote, filters)
+        try:
+            if(is_ws):
+                return await self.stream_ws(request, ws, subscriber)
+            return await self.stream_sse(request, subscriber)
+        finally:
+            subscriber.close()
+            self.caller.lgr.info('subscriber from %s gone, %d events sent, %d dropped',
+                                 request.remote, subscriber.delivered, subscriber.dropped)
+
+    async def stream_sse(self, request, subscriber):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                               'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        try:
+            while True:
+                try:
+                    frame = await subscriber.get(RestApi.KEEPALIVE)
+                except a_TimeoutError:
+                    await response.write(b': keepalive\n\n')
+                    continue
+                if(frame is None):
+                    break
+                await response.write(frame)
+            if(subscriber.closed != 'closed'):
+                await response.write(b'event: closed\ndata: ' +
+                                     codec.encode({'error': subscriber.closed}) + b'\n\n')
+        except ConnectionError:
+            # the subscriber went away
+            pass
+        return response
+
+    async def stream_ws(self, request, ws, subscriber):
+        await ws.prepare(request)
+
+        async def read():
+            # nothing is expected from the client, but closes and pings
+            # only get handled while something reads
+            async for msg in ws:
+                pass
+            subscriber.close()
+        reader = a_create_task(read())
+        try:
+            while True:
+                frame = await subscriber.get()
+                if(frame is None):
+                    break
+                await ws.send_str(frame)
+            if(subscriber.closed != 'closed'):
+                await ws.close(code=WSCloseCode.POLICY_VIOLATION,
+                               message=subscriber.closed.encode('utf-8'))
+            else:
+                await ws.close()
+        finally:
+            reader.cancel()
+        return ws
+
+    async def contacts_handler(self, request):
+        # ?id= a number or uuid, without it a page of contacts (offset, limit)
+        return await self.directory_response(request, self.backend.get_contacts, 'contacts')
+
+    async def groups_handler(self, request):
+        # ?id= a group id, without it a page of groups (offset, limit)
+        return await self.directory_response(request, self.backend.get_groups, 'groups')
+
+    async def directory_response(self, request, lookup, kind):
+        query = request.query
+        try:
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 100))
+        except ValueError:
+            return web.json_response({'error': 'offset and limit must be numbers'}, status=400)
+        data = await lookup(query.get('id'), offset, limit)
+        if(data is None):
+            return web.json_response({'error': 'the contact directory is off (DIRECTORY_REFRESH)'},
+                                     status=404)
+        if('id' in query):
+            if(not data[kind]):
+                return web.json_response({'error': f'{query["id"]} is not known'}, status=404)
+            return web.json_response(data[kind][0], status=200)
+        return web.json_response(data, status=200)
+
+    async def status_handler(self, request):
+        data = await self.backend.get_status()
+        return web.json_response(data, status=200)
+
+    async def metrics_handler(self, request):
+        text = await self.backend.get_metrics()
+        return web.Response(body=text.encode('utf-8'),
+                            headers={'Content-Type': MetricsRegistry.CONTENT_TYPE})
+
+    @staticmethod
+    def is_valid_recipients(recipients):
+        # a number/group id, or a list of them
+        if(type(recipients) is str):
+            return len(recipients) > 0
+        return (type(recipients) is list and
+                len(recipients) > 0 and
+                all(type(r) is str and r for r in recipients))
+
+    @staticmethod
+    def is_valid_message(json):
+        if(type(json) is dict and 'priority' in json):
+            try:
+                SendScheduler.get_priority(json['priority'])
+            except KeyError:
+                return False
+        return (type(json) is dict and
+                'recipients' in json and
+                RestApi.is_valid_recipients(json['recipients']) and
+                'message' in json and
+                type(json['message']) is str and
+                len(json['message']) > 0 and
+                type(json.get('account', '')) in (str, type(None)))
@@ -0,0 +1,83 @@
+from asyncio import sleep as a_sleep
+import logging
+import multiprocessing
+
+from asyncloop import AsyncLoop
+from attachmentstore import AttachmentStore
+from eventstream import EventStream
+from ipcclient import IpcClient
+from jsoncodec import codec, JsonCodec
+from loopmonitor import LoopMonitor
+from restapi import RestApi
+
+class RestWorker(AsyncLoop):
+    # one of SignalClient's rest worker processes: serves the REST api on
+    # the shared port (SO_REUSEPORT lets the kernel spread connections over
+    # the workers) and passes what it accepted to the owner process
+    def __init__(self, index, host, rest_port, ipc_path, batch_max, fanout_max,
+                 attachment_dir='', attachment_remote_dir='',
+                 attachment_max_size=AttachmentStore.MAX_SIZE,
+                 attachment_max_files=AttachmentStore.MAX_FILES,
+                 stream_buffer=EventStream.BUFFER_SIZE,
+                 stream_policy=EventStream.POLICIES[0],
+                 stream_max_subscribers=EventStream.MAX_SUBSCRIBERS,
+                 shutdown_timeout=AsyncLoop.SHUTDOWN_TIMEOUT,
+                 event_loop='asyncio', loop_lag_interval=LoopMonitor.LAG_INTERVAL,
+                 slow_callback=LoopMonitor.SLOW_CALLBACK,
+                 json_codec=JsonCodec.AUTO,
+                 log_level=logging.DEBUG, log_rate_limit=0):
+        super().__init__(f'restworker{index}', log_levels=[logging.NOTSET,
+                                                           logging.INFO],
+                         log_rate_limit=log_rate_limit, event_loop=event_loop,
+                         lag_interval=loop_lag_interval, slow_callback=slow_callback)
+        self.lgr.setLevel(log_level)
+        codec.use(json_codec)
+        self.shutdown_timeout = shutdown_timeout
+        self.host = host
+        self.rest_port = rest_port
+        self.batch_max = batch_max
+        self.fanout_max = fanout_max
+        self.backend = IpcClient(self, ipc_path)
+        # this worker's /events subscribers, fed from the owner's stream
+        self.stream = None
+        if(stream_max_subscribers > 0):
+            self.stream = EventStream(self, stream_buffer, stream_policy,
+                                      stream_max_subscribers, self.backend.set_subscribed)
+            self.backend.stream = self.stream
+        self.attachments = None
+        if(attachment_dir):
+            self.attachments = AttachmentStore(self, attachment_dir, attachment_remote_dir,
+                                               attachment_max_size, attachment_max_files)
+        self.api = None
+        self.tasks = [self.request_handler_loop]
+
+    async def request_handler_loop(self):
+        await self.backend.connect()
+        self.api = RestApi(self, self.backend, self.batch_max, self.fanout_max,
+                           self.attachments, self.stream)
+        await self.api.serve(self.host, self.rest_port, reuse_port=True)
+        self.lgr.debug('request handler started')
+        # a worker outliving its owner would keep the port, and answer 503s
+        parent = multiprocessing.parent_process()
+        while(parent is None or parent.is_alive()):
+            await a_sleep(1)
+        self.lgr.error('signal-cli owner process is gone, exiting')
+        await self.shutdown()
+
+    async def drain(self, deadline):
+        # the owner keeps answering until the requests taken here are done.
+        # the subscribers end here, the owner's side of their subscription
+        # goes with the socket
+        if(self.api):
+            self.api.stop_accepting()
+        if(self.stream is not None):
+            self.stream.active_cb = None
+            self.stream.close()
+        while(self.api and self.api.inflight and self.loop.time() < deadline):
+            await a_sleep(0.05)
+        if(self.api and self.api.inflight):
+            self.lgr.warning('abandoning %d requests', self.api.inflight)
+
+# started by SignalClient in a new process
+def run(index, kwargs):
+    RestWorker(index, **kwargs).run_loop()
@@ -0,0 +1,207 @@
+from asyncio import (Event as a_Event, sleep as a_sleep,
+                     wait_for as a_wait_for, TimeoutError as a_TimeoutError)
+from collections import deque
+from heapq import heappush, heappop
+from time import monotonic
+
+from signalsendhandler import SendQueueFull
+
+class TokenBucket:
+    # float refills can land a hair under a whole token
+    EPSILON = 1e-9
+
+    # a rate of 0 means unlimited
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = now
+
+    def refill(self, now):
+        if(now > self.last):
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def take(self, now):
+        if(not self.rate):
+            return True
+        self.refill(now)
+        if(self.tokens >= 1 - self.EPSILON):
+            self.tokens = max(0, self.tokens - 1)
+            return True
+        return False
+
+    def wait_time(self, now):
+        # seconds until the next token is available
+        if(not self.rate):
+            return 0
+        self.refill(now)
+        if(self.tokens >= 1 - self.EPSILON):
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        if(not self.rate):
+            return True
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class SendScheduler:
+    # lower goes first
+    PRIORITY_ALERT = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_DIGEST = 2
+    PRIORITIES = {
+        'alert': PRIORITY_ALERT,
+        'normal': PRIORITY_NORMAL,
+        'digest': PRIORITY_DIGEST,
+    }
+    # messages waiting to be scheduled
+    QUEUE_SIZE = 100000
+    # idle per-recipient buckets are dropped once there are more than this
+    BUCKETS_MAX = 10000
+    # messages handed off before giving the rest of the loop a turn
+    YIELD_EVERY = 500
+
+    def __init__(self, rate=0, burst=1, recipient_rate=0, recipient_burst=1,
+                 queue_size=QUEUE_SIZE, clock=monotonic):
+        self.clock = clock
+        self.rate = rate
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.bucket = TokenBucket(rate, burst, clock())
+        # recipient key -> TokenBucket
+        self.buckets = {}
+        self.queue_size = queue_size
+        self.queued = 0
+
+        # (priority, recipient key) -> deque of items, each of these queues
+        # has exactly one entry in either the ready or the throttled heap
+        self.queues = {}
+        # (priority, turn, seq, key): every recipient with something
+        # queued takes one turn per round, so a big fan-out to one recipient
+        # interleaves with everybody else instead of going first
+        self.ready = []
+        # (ready_at, seq, priority, turn, key): recipients out of tokens
+        self.throttled = []
+        # turn last served for each priority
+        self.turns = {}
+        self.seq = 0
+
+        self.wakeup = a_Event()
+
+    def __len__(self):
+        return self.queued
+
+    @staticmethod
+    def get_priority(priority):
+        # accepts the names used by the REST api as well as the numbers
+        if(priority is None):
+            return SendScheduler.PRIORITY_NORMAL
+        if(type(priority) is str):
+            return SendScheduler.PRIORITIES[priority]
+        if(type(priority) is int and priority in SendScheduler.PRIORITIES.values()):
+            return priority
+        raise KeyError(priority)
+
+    @staticmethod
+    def get_key(recipients):
+        # messages to several recipients queue as one conversation, but
+        # every one of them is charged against their own bucket
+        if(type(recipients) is str):
+            return recipients
+        recipients = sorted(set(str(r) for r in recipients))
+        if(len(recipients) == 1):
+            return recipients[0]
+        return tuple(recipients)
+
+    def push(self, key, item, priority=PRIORITY_NORMAL):
+        if(self.queued >= self.queue_size):
+            raise SendQueueFull(f'send scheduler is full ({self.queue_size} messages)')
+        self.queued += 1
+        q = self.queues.get((priority, key))
+        if(q is None):
+            # newcomers join the current round rather than the back of the line
+            q = self.queues[(priority, key)] = deque()
+            self.seq += 1
+            heappush(self.ready, (priority, self.turns.get(priority, 0), self.seq, key))
+        q.append(item)
+        self.wakeup.set()
+
+    def get_bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if(bucket is None):
+            if(len(self.buckets) >= self.BUCKETS_MAX):
+                self.prune(now)
+            bucket = self.buckets[key] = TokenBucket(self.recipient_rate,
+                                                     self.recipient_burst, now)
+        return bucket
+
+    def prune(self, now):
+        # a full bucket is the same as a brand new one
+        for key in [k for k, b in self.buckets.items() if b.is_full(now)]:
+            del self.buckets[key]
+
+    def pop(self, now=None):
+        # returns (item, 0) when something can go out now, or
+        # (None, seconds until it is worth asking again)
+        if(now is None):
+            now = self.clock()
+
+        while(self.throttled and self.throttled[0][0] <= now):
+            ready_at, seq, priority, turn, key = heappop(self.throttled)
+            heappush(self.ready, (priority, turn, seq, key))
+
+        if(not self.ready):
+            if(self.throttled):
+                return None, self.throttled[0][0] - now
+            return None, None
+
+        wait = self.bucket.wait_time(now)
+        if(wait > 0):
+            return None, wait
+
+        while(self.ready):
+            priority, turn, seq, key = heappop(self.ready)
+            if(self.recipient_rate):
+                buckets = ([self.get_bucket(k, now) for k in key] if type(key) is tuple
+                           else [self.get_bucket(key, now)])
+                wait = max(b.wait_time(now) for b in buckets)
+                if(wait > 0):
+                    # this recipient has to wait, everybody else can go ahead
+                    heappush(self.throttled, (now + wait, seq, priority, turn, key))
+                    continue
+                for bucket in buckets:
+                    bucket.take(now)
+
+            self.bucket.take(now)
+            self.turns[priority] = turn
+            q = self.queues[(priority, key)]
+            item = q.popleft()
+            self.queued -= 1
+            if(q):
+                heappush(self.ready, (priority, turn + 1, seq, key))
+            else:
+                del self.queues[(priority, key)]
+            return item, 0
+
+        return None, self.throttled[0][0] - now
+
+    async def run_loop(self, send_cb):
+        sent = 0
+        while True:
+            item, wait = self.pop()
+            if(item is not None):
+                await send_cb(item)
+                sent += 1
+                if(sent % self.YIELD_EVERY == 0):
+                    await a_sleep(0)
+                continue
+
+            # nothing can go out yet, sleep until a token shows up or
+            # somebody pushes something new
+            self.wakeup.clear()
+            try:
+                await a_wait_for(self.wakeup.wait(), wait)
+            except a_TimeoutError:
+                pass
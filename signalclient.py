@@ -1,136 +1,703 @@
 import logging
-from asyncio import Event as a_Event
-from json.decoder import JSONDecodeError
-from aiohttp import web
+from asyncio import (TimeoutError as a_TimeoutError, gather as a_gather, shield as a_shield,
+                     sleep as a_sleep, all_tasks as a_all_tasks)
+import multiprocessing
+from os.path import join
+from tempfile import gettempdir
 from YamJam import yamjam
 
 from asyncloop import AsyncLoop
+from attachmentstore import AttachmentStore
+from connectionpool import ConnectionPool, NoConnection
+from contactdirectory import ContactDirectory
+from eventdispatcher import EventDispatcher
+from eventrouter import EventRouter
+from eventstream import EventStream
+from fanout import FanOut
+from ipcserver import IpcServer
+from jsoncodec import codec, JsonCodec
+from loopmonitor import LoopMonitor
+from lrucache import LruCache
+from metrics import MetricsRegistry
+from outbox import Outbox
+from pendingrequests import PendingRequests
+from receiptaggregator import ReceiptAggregator
+from restapi import RestApi
+import restworker
+from sendscheduler import SendScheduler
+from signalconnection import SignalConnection
 from signalevent import SignalEvent
-from signalreceivehandler import SignalReceiveHandler
-from signalsendhandler import SignalSendHandler
+from signalsendhandler import SignalSendHandler, SendQueueFull, NotWritten
+from trafficrecorder import TrafficRecorder
 
 class SignalClient(AsyncLoop):
+    # each connection's connect_and_receive_loop reconnects on its own
+    SHUTDOWN_ON_CONNECTION_ERROR = False
+    # seconds between reconnect attempts, doubling up to the max
+    RECONNECT_MIN = 0.05
+    RECONNECT_MAX = 30
+    # envelopes remembered to drop ones signal-cli delivers again, and
+    # for how many seconds
+    INBOUND_DEDUPE_SIZE = 10000
+    INBOUND_DEDUPE_TTL = 600
+    # Idempotency-Key results remembered, and for how many seconds
+    IDEMPOTENCY_SIZE = 10000
+    IDEMPOTENCY_TTL = 86400
+
     def __init__(self, host, signal_port, rest_port,
-                 phone, user, first='', last=''):
+                 phone, user, first='', last='',
+                 connections=None, connection_routing=ConnectionPool.ROUTING[0],
+                 request_timeout=PendingRequests.TIMEOUT,
+                 batch_max=10000,
+                 send_queue_size=SignalSendHandler.QUEUE_SIZE,
+                 send_queue_timeout=SignalSendHandler.QUEUE_TIMEOUT,
+                 send_flush_max=SignalSendHandler.FLUSH_MAX,
+                 send_rate=0, send_burst=1,
+                 recipient_rate=0, recipient_burst=1,
+                 schedule_size=SendScheduler.QUEUE_SIZE,
+                 reconnect_min=RECONNECT_MIN, reconnect_max=RECONNECT_MAX,
+                 inbound_workers=EventDispatcher.WORKERS,
+                 inbound_queue_size=EventDispatcher.QUEUE_SIZE,
+                 json_codec=JsonCodec.AUTO,
+                 outbox_path='', outbox_batch=Outbox.BATCH_MAX,
+                 attachment_dir='', attachment_remote_dir='',
+                 attachment_max_size=AttachmentStore.MAX_SIZE,
+                 attachment_max_files=AttachmentStore.MAX_FILES,
+                 fanout_chunk_size=FanOut.CHUNK_SIZE,
+                 fanout_concurrency=FanOut.CONCURRENCY,
+                 fanout_max=FanOut.MAX_TARGETS,
+                 receipt_window=ReceiptAggregator.WINDOW,
+                 receipt_max=ReceiptAggregator.MAX_TIMESTAMPS,
+                 inbound_dedupe_size=INBOUND_DEDUPE_SIZE,
+                 inbound_dedupe_ttl=INBOUND_DEDUPE_TTL,
+                 idempotency_size=IDEMPOTENCY_SIZE, idempotency_ttl=IDEMPOTENCY_TTL,
+                 stream_buffer=EventStream.BUFFER_SIZE,
+                 stream_policy=EventStream.POLICIES[0],
+                 stream_max_subscribers=EventStream.MAX_SUBSCRIBERS,
+                 rest_workers=0, rest_ipc_path='',
+                 shutdown_timeout=AsyncLoop.SHUTDOWN_TIMEOUT,
+                 event_loop='asyncio', loop_lag_interval=LoopMonitor.LAG_INTERVAL,
+                 slow_callback=LoopMonitor.SLOW_CALLBACK,
+                 record_path='', record_max_bytes=TrafficRecorder.MAX_BYTES,
+                 record_backups=TrafficRecorder.BACKUPS,
+                 directory_refresh=ContactDirectory.REFRESH_INTERVAL,
+                 directory_max_contacts=ContactDirectory.MAX_CONTACTS,
+                 directory_max_groups=ContactDirectory.MAX_GROUPS,
+                 log_level=logging.DEBUG, log_rate_limit=0):
         super().__init__('signalclient', log_levels=[logging.NOTSET,
                                                      logging.DEBUG,
-                                                     logging.INFO])
+                                                     logging.INFO],
+                         log_rate_limit=log_rate_limit, event_loop=event_loop,
+                         lag_interval=loop_lag_interval, slow_callback=slow_callback)
+        # above DEBUG the per-message logging costs next to nothing
+        self.lgr.setLevel(log_level)
         self.debug = False
+        codec.use(json_codec)
+        self.lgr.debug(f'using {codec.name} for json')
         self.host = host
-        self.signal_port = signal_port
         self.rest_port = rest_port
-        self.tasks = [self.connect_and_receive_loop,
-                      self.request_handler_loop]
+        self.tasks = [self.request_handler_loop]
         self.close_signal = self.loop.create_future()
-        self.transport_event = a_Event()
-        # transport will be set once the transport_event occurs
-        self.transport = None
-        self.input = SignalReceiveHandler(self)
-        self.output = SignalSendHandler(self)
-        self.account = phone
-        self.name_user = user
-        self.name_first = first
-        self.name_last = last
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        # every json-rpc line to and from signal-cli, for replaying later
+        self.recorder = None
+        if(record_path):
+            self.recorder = TrafficRecorder(self, record_path, record_max_bytes, record_backups)
+            self.recorder.start()
+        # one or more signal-cli daemons, each with the account sent as
+        # through it. without a list it's the single one from the arguments
+        if(not connections):
+            connections = [{'name': 'default', 'host': host, 'port': signal_port,
+                            'account': phone, 'user': user, 'first': first, 'last': last}]
+        self.connections = ConnectionPool(
+            [SignalConnection(self, c.get('name') or f'{c["host"]}:{c["port"]}',
+                              c['host'], c['port'], c['account'],
+                              c.get('user', ''), c.get('first', ''), c.get('last', ''),
+                              send_queue_size, send_queue_timeout, send_flush_max, index)
+             for index, c in enumerate(connections)],
+            connection_routing)
+        for connection in self.connections:
+            self.tasks.append(connection.connect_and_receive_loop)
+            self.tasks.append(connection.output.writer_loop)
         # if this were multithreaded, this would need to be made thread safe
         # but we should be good as a single threaded asyncio app
         self.sent_id = 1
+        # requests waiting on their json-rpc result, keyed by id
+        self.pending = PendingRequests(self.loop, request_timeout)
+        # most messages accepted by one /batch request
+        self.batch_max = batch_max
+        # rate limits and prioritises everything going through send()
+        self.scheduler = SendScheduler(send_rate, send_burst,
+                                       recipient_rate, recipient_burst,
+                                       schedule_size)
+        self.tasks.append({'func': self.scheduler.run_loop,
+                           'args': [self.transmit_scheduled]})
+        # inbound events are handled by a fixed pool of workers
+        self.dispatcher = EventDispatcher(self, self.receive_handler,
+                                          inbound_workers, inbound_queue_size)
+        self.tasks.append(self.dispatcher.run_loop)
+        # envelopes already seen, redelivered ones (after a reconnect, or
+        # from a second daemon for the same account) go no further
+        self.inbound_seen = None
+        if(inbound_dedupe_size > 0):
+            self.inbound_seen = LruCache(inbound_dedupe_size, inbound_dedupe_ttl, self.loop.time)
+        # Idempotency-Key -> the task making that send, so a retried request
+        # gets the first one's result instead of sending again
+        self.idempotency = None
+        if(idempotency_size > 0):
+            self.idempotency = LruCache(idempotency_size, idempotency_ttl, self.loop.time)
+        # contacts and groups from signal-cli, kept up to date in the
+        # background so looking them up never waits on it
+        self.directory = None
+        if(directory_refresh > 0):
+            self.directory = ContactDirectory(self, directory_refresh, directory_max_contacts,
+                                              directory_max_groups)
+            self.tasks.append(self.directory.run_loop)
+        # what the application does with inbound events, see EventRouter.add
+        self.router = EventRouter(self)
+        # and what subscribers to /events get of them
+        self.stream = None
+        if(stream_max_subscribers > 0):
+            self.stream = EventStream(self, stream_buffer, stream_policy,
+                                      stream_max_subscribers)
+        # uploads for /attachments, in a directory shared with signal-cli
+        self.attachments = None
+        if(attachment_dir):
+            self.attachments = AttachmentStore(self, attachment_dir, attachment_remote_dir,
+                                               attachment_max_size, attachment_max_files)
+        # broadcasts through /fanout are split into chunks sent side by side
+        self.fanout = FanOut(self, fanout_chunk_size, fanout_concurrency, fanout_max)
+        # read receipts to one sender go out together
+        self.receipts = ReceiptAggregator(self, receipt_window, receipt_max)
+        self.tasks.append(self.receipts.run_loop)
+        # accepted sends are kept on disk until signal-cli answers for them
+        # and the ones left over from the last run are sent again
+        self.outbox = None
+        if(outbox_path):
+            self.outbox = Outbox(self, outbox_path, outbox_batch)
+            self.outbox.start()
+            self.tasks.append(self.replay_outbox)
+        # with rest workers, REST requests are parsed and validated in that
+        # many other processes and reach us over a unix socket
+        self.rest_workers = rest_workers
+        self.rest_ipc_path = rest_ipc_path or join(gettempdir(), f'sigmsg-{rest_port}.sock')
+        self.rest_worker_args = {
+            'host': host, 'rest_port': rest_port, 'ipc_path': self.rest_ipc_path,
+            'batch_max': batch_max, 'fanout_max': fanout_max,
+            'attachment_dir': attachment_dir,
+            'attachment_remote_dir': attachment_remote_dir,
+            'attachment_max_size': attachment_max_size,
+            'attachment_max_files': attachment_max_files,
+            'stream_buffer': stream_buffer, 'stream_policy': stream_policy,
+            'stream_max_subscribers': stream_max_subscribers,
+            'shutdown_timeout': shutdown_timeout,
+            'event_loop': event_loop, 'loop_lag_interval': loop_lag_interval,
+            'slow_callback': slow_callback,
+            'json_codec': codec.name, 'log_level': log_level,
+            'log_rate_limit': log_rate_limit,
+        }
+        self.rest_processes = []
+        self.ipc = None
+        # the in-process RestApi, once it is serving
+        self.rest_api = None
+        self.shutdown_timeout = shutdown_timeout
+        self.setup_metrics()
 
-    async def connect_and_receive_loop(self):
-        self.transport, protocol = await(self.loop.create_connection(
-            lambda: self.input, self.host, self.signal_port))
-        # Wait until the protocol signals that the connection
-        # is lost and close the transport.
-        try:
-            await self.close_signal
-        finally:
-            self.transport.close()
+    def setup_metrics(self):
+        self.metrics = MetricsRegistry()
+        m = self.metrics
+        m.events_received = m.counter(
+            'signalclient_events_received_total',
+            'events received from signal-cli by SignalEvent type and subtype',
+            ('type', 'subtype'))
+        m.messages_sent = m.counter(
+            'signalclient_messages_sent_total',
+            'json-rpc messages written to signal-cli by method (type) and '
+            'group or direct (subtype)',
+            ('type', 'subtype'))
+        m.duplicates = m.counter(
+            'signalclient_inbound_duplicates_total',
+            'envelopes dropped as already received')
+        m.slow_callbacks = m.counter(
+            'signalclient_slow_callbacks_total',
+            'callbacks and task steps that blocked the event loop, by coroutine or callback',
+            ('callback',))
+        m.loop_lag = m.histogram(
+            'signalclient_event_loop_lag_seconds',
+            'how late the event loop ran a timer, sampled every loop lag interval')
+        m.request_outcomes = m.counter(
+            'signalclient_requests_total',
+            'requests waited on by outcome (result, error, timeout)',
+            ('outcome',))
+        m.rest_to_socket = m.histogram(
+            'signalclient_rest_to_socket_seconds',
+            'time from a send being accepted to it being written to signal-cli')
+        m.round_trip = m.histogram(
+            'signalclient_rpc_round_trip_seconds',
+            'time from a json-rpc request being written to its result arriving')
+        m.gauge('signalclient_pending_requests',
+                'requests waiting on a result', lambda: len(self.pending))
+        m.gauge('signalclient_scheduled_messages',
+                'messages waiting on the rate limits', lambda: len(self.scheduler))
+        m.gauge('signalclient_send_queue_messages',
+                'messages waiting to be written to signal-cli',
+                lambda: sum(c.output.depth() for c in self.connections))
+        m.gauge('signalclient_send_buffer_bytes',
+                'bytes in the transport write buffers',
+                lambda: sum(c.output.get_buffer_size() for c in self.connections))
+        m.gauge('signalclient_connections_up',
+                'signal-cli connections currently connected',
+                lambda: sum(1 for c in self.connections if c.is_connected()))
+        m.gauge('signalclient_receipts_waiting',
+                'message timestamps waiting to be sent in a read receipt',
+                lambda: len(self.receipts))
+        m.gauge('signalclient_inbound_queue_events',
+                'inbound events waiting on a worker', self.dispatcher.depth)
+        if(self.outbox):
+            m.gauge('signalclient_outbox_operations',
+                    'outbox writes waiting to be committed', self.outbox.depth)
+        m.gauge('signalclient_tasks', 'live asyncio tasks',
+                lambda: len(a_all_tasks(self.loop)))
+
+    def get_backlog(self):
+        # everything accepted that hasn't been seen through yet
+        return {
+            'rest_requests': self.rest_api.inflight if self.rest_api else 0,
+            'inbound_events': self.dispatcher.depth(),
+            'scheduled': len(self.scheduler),
+            'queued': sum(c.output.depth() for c in self.connections),
+            'buffered_bytes': sum(c.output.get_buffer_size() for c in self.connections),
+            'unanswered': len(self.pending),
+        }
+
+    def on_loop_lag(self, lag):
+        self.metrics.loop_lag.observe(lag)
+        super().on_loop_lag(lag)
+
+    def on_slow_callback(self, name, took):
+        self.metrics.slow_callbacks.inc((name,))
+        super().on_slow_callback(name, took)
+
+    async def drain(self, deadline):
+        # no new requests, here or in the rest workers, which finish the
+        # ones they have and exit. /events subscribers are let go
+        if(self.rest_api):
+            self.rest_api.stop_accepting()
+        for process in self.rest_processes:
+            process.terminate()
+        if(self.stream is not None):
+            self.stream.close()
+
+        # what was accepted goes out and gets its answer, while there is time.
+        # receipts still waiting on their window go now
+        start = self.loop.time()
+        resolved = self.pending.resolved
+        await self.receipts.flush()
+        self.lgr.info('draining %s', self.get_backlog())
+        while(self.loop.time() < deadline and
+              (any(self.get_backlog().values()) or
+               any(process.is_alive() for process in self.rest_processes))):
+            await a_sleep(0.05)
+        # receipts for anything that came in meanwhile, and whatever the
+        # connection takes without waiting on the writer
+        await self.receipts.flush()
+        written = sum(c.output.write_queued() for c in self.connections)
+
+        left = self.get_backlog()
+        self.lgr.info('drained in %.2fs: %d requests answered, %d messages written at the end; '
+                      'abandoned %d unanswered requests, %d scheduled and %d queued messages',
+                      self.loop.time() - start, self.pending.resolved - resolved, written,
+                      left['unanswered'], left['scheduled'], left['queued'])
+        # whoever is still waiting on an answer gets a timeout now rather
+        # than being cancelled with the rest of the tasks
+        self.pending.fail_all(a_TimeoutError('shutting down before signal-cli answered'))
+        await a_sleep(0)
+        self.stop_rest_workers()
+        if(self.ipc):
+            await self.ipc.close()
+
+    async def shutdown(self, signal=None):
+        await super().shutdown(signal)
+        if(self.outbox):
+            # after the last sends have had their answers marked
+            self.outbox.close()
+        if(self.recorder):
+            self.recorder.close()
+
+    async def replay_outbox(self):
+        rows = await self.outbox.load()
+        # sends as an account that is no longer configured can never go
+        # out, they would be tried again on every start
+        gone = {}
+        for row in rows:
+            account = row[4]
+            if(account and not self.has_account(account)):
+                gone[account] = gone.get(account, 0) + 1
+                self.outbox.done(row[0])
+        if(gone):
+            self.lgr.error('dropped %d messages from the outbox for accounts that are no longer '
+                           'configured: %s', sum(gone.values()),
+                           ', '.join(f'{account} ({count})' for account, count in gone.items()))
+            rows = [row for row in rows if not row[4] or self.has_account(row[4])]
+        if(not rows):
+            return
+        self.lgr.info('sending %d messages left in the outbox', len(rows))
+        # group sends are stored as {groupId}
+        events = await a_gather(*[self.send(recipients.get('groupId')
+                                            if type(recipients) is dict else recipients,
+                                            message, priority=priority, outbox_seq=seq,
+                                            group=type(recipients) is dict, account=account)
+                                  for seq, recipients, message, priority, account in rows],
+                                return_exceptions=True)
+        failed = sum(1 for event in events if isinstance(event, BaseException))
+        self.lgr.info('outbox replay done, %d of %d not answered', failed, len(rows))
 
     async def request_handler_loop(self):
-        await self.set_account()
-        server = web.Server(self.rest_handler)
-        runner = web.ServerRunner(server)
-        await runner.setup()
-        site = web.TCPSite(runner, self.host, self.rest_port)
-        await site.start()
+        for connection in self.connections:
+            await connection.set_account()
+        if(self.rest_workers):
+            self.ipc = IpcServer(self, self.rest_ipc_path)
+            await self.ipc.start()
+            await self.rest_worker_loop()
+            return
+        self.rest_api = RestApi(self, self, self.batch_max, self.fanout.max_targets,
+                                self.attachments, self.stream)
+        await self.rest_api.serve(self.host, self.rest_port)
         self.lgr.debug('request handler started')
         await self.close_signal
 
-    async def rest_handler(self, request):
+    def start_rest_worker(self, index):
+        # spawned rather than forked, a copy of a running event loop is no use
+        process = multiprocessing.get_context('spawn').Process(
+            target=restworker.run, args=(index, self.rest_worker_args),
+            name=f'restworker{index}', daemon=True)
+        process.start()
+        return process
+
+    async def rest_worker_loop(self):
+        # starts the workers and replaces any that die
+        self.rest_processes = [self.start_rest_worker(i) for i in range(self.rest_workers)]
+        self.lgr.info(f'started {self.rest_workers} rest workers on port {self.rest_port}')
+        while(not self.close_signal.done()):
+            await a_sleep(1)
+            if(self.shutting_down):
+                # drain stops them
+                return
+            for i, process in enumerate(self.rest_processes):
+                if(not process.is_alive()):
+                    self.lgr.error(f'rest worker {i} exited with {process.exitcode}, restarting it')
+                    self.rest_processes[i] = self.start_rest_worker(i)
+
+    def stop_rest_workers(self):
+        # drain has given them their time, any still around are killed
+        processes = self.rest_processes
+        self.rest_processes = []
+        for process in processes:
+            process.join(0.5)
+            if(process.is_alive()):
+                self.lgr.warning(f'rest worker {process.name} did not exit, killing it')
+                process.kill()
+                process.join(1)
+
+    # what RestApi calls, here or over ipc from a rest worker
+    def has_account(self, account):
+        return self.connections.has_account(account)
+
+    async def send_message(self, recipients, message, priority=None, account=None,
+                           attachments=None, idempotency_key=None, attachment_dir=None):
+        # attachment_dir is the upload directory of the attachments, it
+        # is removed once the send is done with it
+        async def send():
+            event = await self.send(recipients, message, priority=priority,
+                                    attachments=attachments, account=account)
+            return self.make_result_response(event)
+
+        if(idempotency_key is None or self.idempotency is None):
+            if(attachment_dir is None):
+                return await send()
+            return dict(await a_shield(self.start_send(send(), attachment_dir)))
+        task = self.idempotency.get(idempotency_key)
+        if(task is not None):
+            self.lgr.info('request with Idempotency-Key %r seen before, not sending again',
+                          idempotency_key)
+            if(attachment_dir is not None and self.attachments is not None):
+                # the first request's files are the ones being sent
+                self.attachments.remove(attachment_dir)
+            return dict(await a_shield(task), replayed=True)
+        # a retry after a client side timeout waits for the same send
+        task = self.start_send(send(), attachment_dir)
+        self.idempotency.put(idempotency_key, task)
         try:
-            json = await request.json()
-
-            if('recipients' in json and
-               hasattr(json['recipients'], '__len__') and
-               len(json['recipients']) > 0 and
-               'message' in json and
-               len(json['message']) > 0):
-
-                # send the message in chunks
-                await self.send(
-                    json['recipients'],
-                    json['message'],
-                )
-                data = {'success': 'success'}
-                return web.json_response(data, status=200)
-            else:
-                data = {'error': 'must have recipients and message fields'}
-                return web.json_response(data, status=200)
-        except JSONDecodeError as err:
-            data = {'error': 'invalid json format: '+str(err)}
-            self.lgr.warning('invalid json')
-            return web.json_response(data, status=200)
+            # a copy, the response gets added to
+            return dict(await a_shield(task))
+        except (NoConnection, SendQueueFull, NotWritten):
+            # nothing went out, a retry may send it
+            if(self.idempotency.get(idempotency_key) is task):
+                self.idempotency.discard(idempotency_key)
+            raise
+
+    def start_send(self, coro, attachment_dir=None):
+        # the send carries on if the request that made it goes away, and
+        # its attachments stay until signal-cli has answered or it gave up
+        task = self.loop.create_task(coro)
+        if(attachment_dir is not None and self.attachments is not None):
+            task.add_done_callback(lambda task: self.attachments.remove(attachment_dir))
+        return task
+
+    async def send_batch(self, items):
+        # items are already validated, returns a response for each
+        # the whole batch goes into the outbox in one commit
+        seqs = [None] * len(items)
+        if(self.outbox):
+            seqs = await self.outbox.append_many(
+                [(item['recipients'], item['message'],
+                  SendScheduler.get_priority(item.get('priority')),
+                  item.get('account'))
+                 for item in items])
+
+        events = await a_gather(*[self.send(item['recipients'],
+                                            item['message'],
+                                            priority=item.get('priority'),
+                                            outbox_seq=seq,
+                                            account=item.get('account'))
+                                  for item, seq in zip(items, seqs)],
+                                return_exceptions=True)
+        return [{'error': str(event)} if isinstance(event, BaseException)
+                else self.make_result_response(event)
+                for event in events]
+
+    async def send_fanout(self, recipients, group_ids, message, priority=None, account=None):
+        return await self.fanout.send(recipients, group_ids, message, priority,
+                                      account=account)
+
+    async def get_status(self):
+        data = {
+            'send_queue': sum(c.output.depth() for c in self.connections),
+            'send_queue_max': sum(c.output.queue.maxsize for c in self.connections),
+            'writing_paused': any(c.output.is_paused() for c in self.connections),
+            'pending_requests': len(self.pending),
+            'scheduled': len(self.scheduler),
+            'connections': [c.get_stats() for c in self.connections],
+            'inbound': self.dispatcher.get_stats(),
+            'router': self.router.get_stats(),
+            'dedupe': {'inbound': self.inbound_seen.get_stats() if self.inbound_seen is not None else None,
+                       'idempotency': self.idempotency.get_stats() if self.idempotency is not None else None},
+            'stream': self.stream.get_stats() if self.stream is not None else None,
+            'loop': self.monitor.get_stats(),
+            'recorder': self.recorder.get_stats() if self.recorder else None,
+            'directory': self.directory.get_stats() if self.directory is not None else None,
+            'receipts': {'waiting': len(self.receipts),
+                         'timestamps': self.receipts.timestamps,
+                         'requests': self.receipts.requests},
+        }
+        if(self.rest_workers):
+            data['rest_workers'] = {
+                'processes': [{'pid': p.pid, 'alive': p.is_alive()}
+                              for p in self.rest_processes],
+                'ipc_requests': self.ipc.requests if self.ipc else 0,
+            }
+        if(self.outbox):
+            data['outbox'] = {'queued': self.outbox.depth(),
+                              'commits': self.outbox.commits,
+                              'committed': self.outbox.committed}
+        return data
+
+    async def get_metrics(self):
+        return self.metrics.render()
+
+    async def get_accounts(self):
+        return list(self.connections.accounts)
+
+    async def get_contacts(self, key=None, offset=0, limit=100):
+        # one contact by number or uuid, or a page of them. None when the
+        # directory is off
+        if(self.directory is None):
+            return None
+        if(key is not None):
+            contact = self.directory.get_contact(key)
+            return {'total': 1 if contact else 0, 'contacts': [contact] if contact else []}
+        return {'total': len(self.directory.contacts),
+                'contacts': self.directory.get_page(self.directory.contacts, offset, limit)}
+
+    async def get_groups(self, group_id=None, offset=0, limit=100):
+        if(self.directory is None):
+            return None
+        if(group_id is not None):
+            group = self.directory.get_group(group_id)
+            return {'total': 1 if group else 0, 'groups': [group] if group else []}
+        return {'total': len(self.directory.groups),
+                'groups': self.directory.get_page(self.directory.groups, offset, limit)}
+
+    @staticmethod
+    def make_result_response(event):
+        data = {'id': event.id, 'results': event.results}
+        if(event.get_type() == SignalEvent.TYPE_ERROR):
+            data['error'] = event.get_message()
+        else:
+            data['success'] = 'success'
+        return data
+
+    def is_duplicate(self, event):
+        if(self.inbound_seen is None or event.envelope is None):
+            return False
+        if(self.inbound_seen.add(event.dedupe_key)):
+            return False
+        self.metrics.duplicates.inc()
+        self.lgr.debug('dropping duplicate envelope from %s at %d', event.sender, event.timestamp)
+        return True
 
     def get_next_sent_id(self):
         self.sent_id += 1
         return self.sent_id
 
-    async def send(self, recipients, message):
-        msg = SignalEvent.make_message(self.account,
-                                       recipients,
-                                       message,
-                                       msg_id=self.get_next_sent_id())
-        await self.send_raw(msg)
+    async def send(self, recipients, message, timeout=None, priority=None,
+                   outbox_seq=None, attachments=None, group=False, account=None):
+        # sent as account if given, otherwise as whichever connection is
+        # picked, or for a group one of our accounts that is in it. the
+        # connection is only picked once the scheduler lets it go
+        if(group and account is None and self.directory is not None):
+            account = self.directory.get_group_account(recipients)
+        # an account with no connection fails before anything is stored
+        self.connections.get_candidates(account)
+        priority = SendScheduler.get_priority(priority)
+        # rows don't keep attachment paths, and the files are removed once
+        # this send is done either way, so a replay would have nothing to attach
+        if(self.outbox and outbox_seq is None and not attachments):
+            # only sent once it is committed, so an accepted send survives
+            # the process going away
+            outbox_seq = await self.outbox.append({'groupId': recipients} if group else recipients,
+                                                  message, priority, account)
+        msg_id = self.get_next_sent_id()
+        # built for the account of the connection it goes out on
+        def make(sender):
+            return SignalEvent.make_message(sender,
+                                            recipients,
+                                            message,
+                                            attachments=attachments or [],
+                                            msg_id=msg_id,
+                                            group=group)
+        try:
+            event = await self.send_request(make, msg_id, timeout,
+                                            SendScheduler.get_key(recipients),
+                                            priority, account=account)
+        except (SendQueueFull, NotWritten):
+            # refused or taken back unwritten, the caller knows it wasn't sent
+            if(outbox_seq is not None):
+                self.outbox.done(outbox_seq)
+            raise
+        # a timeout leaves it in the outbox for the next start
+        if(outbox_seq is not None):
+            self.outbox.done(outbox_seq)
+        return event
+
+    async def send_request(self, msg, msg_id, timeout=None, key=None, priority=None,
+                           connection=None, account=None):
+        # sends msg and waits for the result/error event with the same id,
+        # other requests can be sent on the socket in the meantime.
+        # with a recipient key the message goes through the rate limiting
+        # scheduler, otherwise straight to the send queue. msg can be a
+        # function making it for the account it is sent as
+        self.pending.add(msg_id)
+        try:
+            if(key is None):
+                if(connection is None):
+                    connection = self.connections.select(account)
+                await connection.send_raw(msg(connection.account) if callable(msg) else msg,
+                                          msg_id)
+            else:
+                # [msg_id, msg, account, connection it went out on]
+                item = [msg_id, msg, account, connection]
+                self.schedule(key, item, priority)
+        except BaseException:
+            self.pending.discard(msg_id)
+            raise
+        outcome = None
+        try:
+            event = await self.pending.wait(msg_id, timeout)
+            outcome = 'error' if event.get_type() == SignalEvent.TYPE_ERROR else 'result'
+            return event
+        except a_TimeoutError as err:
+            outcome = 'timeout'
+            if(key is not None):
+                connection = item[3]
+            if(connection is None or connection.output.cancel(msg_id)):
+                # still waiting on the scheduler or in the send queue
+                raise NotWritten(str(err)) from None
+            raise
+        finally:
+            if(key is not None):
+                # None if the scheduler never let it go
+                connection = item[3]
+            if(connection is not None):
+                connection.output.acknowledge(msg_id)
+            if(outcome is not None):
+                self.metrics.request_outcomes.inc((outcome,))
+                if(connection is not None):
+                    connection.count_outcome(outcome)
+
+    def schedule(self, key, item, priority=None):
+        if(priority is None):
+            priority = SendScheduler.PRIORITY_NORMAL
+        self.scheduler.push(key, item, priority)
 
-    async def send_raw(self, msg):
-        await self.output.transmit_message(msg)
+    async def transmit_scheduled(self, item):
+        msg_id, msg, account, connection = item
+        if(msg_id not in self.pending):
+            # the caller gave up waiting while it was scheduled
+            self.lgr.debug('dropping scheduled request %s, nobody is waiting', msg_id)
+            return
+        # picked now, so least_loaded sees what the scheduler held back
+        if(connection is None):
+            connection = item[3] = self.connections.select(account)
+        if(callable(msg)):
+            msg = msg(connection.account)
+        await connection.output.transmit_message(msg, block=True, msg_id=msg_id)
+
+    async def send_raw(self, msg, msg_id=None, account=None):
+        await self.connections.select(account).send_raw(msg, msg_id)
 
-    async def set_account(self):
-        msg = SignalEvent.make_updateprofile(self.account,
-                                             self.name_user,
-                                             self.name_first,
-                                             self.name_last,
-                                             self.get_next_sent_id())
-        await self.send_raw(msg)
+    def acknowledge(self, event):
+        # only the connection it was written to can be replaying it
+        written = None
+        if(event.connection):
+            written = event.connection.output.acknowledge(event.id)
+        if(written is not None):
+            self.metrics.round_trip.observe(self.loop.time() - written)
+        self.pending.resolve(event)
+        if(event.get_type() == SignalEvent.TYPE_ERROR):
+            self.lgr.error('error msg: %s', event)
+        else:
+            self.lgr.debug('result msg: %s', event)
 
     async def receive_handler(self, event):
-        # output the event
+        # output the event. results and errors never get here, they are
+        # acknowledged as they are read
         if(event.get_type() != SignalEvent.TYPE_RECV):
-            if(event.get_type() == SignalEvent.TYPE_RESULT):
-                self.lgr.debug('result msg: '+str(event))
-            elif(event.get_type() == SignalEvent.TYPE_ERROR):
-                self.lgr.error('error msg: '+str(event))
-            elif(event.get_type() == SignalEvent.TYPE_UNKNOWN):
-                self.lgr.warning('unknown msg: '+str(event))
-            elif(event.get_type() == SignalEvent.TYPE_SENT):
-                self.lgr.debug(event)
+            if(event.get_type() == SignalEvent.TYPE_SENT):
+                self.lgr.debug('%s', event)
             else:
-                self.lgr.error('unexpected msg type: '+str(event))
-            return
+                self.lgr.error('unexpected msg type: %s', event)
+        elif(event.get_subtype() != SignalEvent.SUBTYPE_MESSAGE):
+            if(event.get_subtype() == SignalEvent.SUBTYPE_RECEIPT):
+                if(self.lgr.isEnabledFor(logging.DEBUG)):
+                    self.lgr.debug('receipt from %s, %s', event.sender, event.get_receipt_type_str())
+            else:
+                self.lgr.debug('%s', event)
         else:
-            if(event.get_subtype() != SignalEvent.SUBTYPE_MESSAGE):
-                if(event.get_subtype() == SignalEvent.SUBTYPE_RECEIPT):
-                    self.lgr.debug(f'receipt from {event.sender}, {event.get_receipt_type_str()}')
-                else:
-                    self.lgr.debug(event)
-                return
+            # acknowledge the receipt of the message
+            await self.receipts.add(event.recipient, event.sender, event.timestamp,
+                                    event.connection)
 
-        # acknowledge the receipt of the message
-        await event.ack_receipt()
-
-        msg = event.get_message()
-
-        # do something here
-        self.lgr.debug(msg)
+        # hand it to /events subscribers and whatever handlers the
+        # application registered
+        if(self.directory is not None and event.envelope is not None):
+            self.directory.observe(event)
+        if(self.stream is not None):
+            self.stream.publish(event)
+        if(not await self.router.dispatch(event) and
+           event.get_subtype() == SignalEvent.SUBTYPE_MESSAGE):
+            self.lgr.debug('%s', event.get_message())
 
 
 def main():
@@ -141,6 +708,16 @@ def main():
 
     YJ = yamjam()[APP_NAME]
 
+    # extra daemons/accounts, the top level ones are used when there are none
+    connections = [{'name': c.get('NAME'),
+                    'host': c['HOST'],
+                    'port': c['SIGNAL_CLI_PORT'],
+                    'account': c['SIGNAL_ACCOUNT'],
+                    'user': c.get('SIGNAL_USER', ''),
+                    'first': c.get('SIGNAL_FIRST', ''),
+                    'last': c.get('SIGNAL_LAST', '')}
+                   for c in YJ.get('CONNECTIONS') or []]
+
     sc = SignalClient(
         YJ['HOST'],
         YJ['SIGNAL_CLI_PORT'],
@@ -149,6 +726,55 @@ def main():
         YJ['SIGNAL_USER'],
         YJ['SIGNAL_FIRST'],
         YJ['SIGNAL_LAST'],
+        connections=connections,
+        connection_routing=YJ.get('CONNECTION_ROUTING', ConnectionPool.ROUTING[0]),
+        request_timeout=YJ.get('REQUEST_TIMEOUT', PendingRequests.TIMEOUT),
+        batch_max=YJ.get('BATCH_MAX', 10000),
+        send_queue_size=YJ.get('SEND_QUEUE_SIZE', SignalSendHandler.QUEUE_SIZE),
+        send_queue_timeout=YJ.get('SEND_QUEUE_TIMEOUT', SignalSendHandler.QUEUE_TIMEOUT),
+        send_flush_max=YJ.get('SEND_FLUSH_MAX', SignalSendHandler.FLUSH_MAX),
+        send_rate=YJ.get('SEND_RATE', 0),
+        send_burst=YJ.get('SEND_BURST', 1),
+        recipient_rate=YJ.get('RECIPIENT_RATE', 0),
+        recipient_burst=YJ.get('RECIPIENT_BURST', 1),
+        schedule_size=YJ.get('SCHEDULE_SIZE', SendScheduler.QUEUE_SIZE),
+        reconnect_min=YJ.get('RECONNECT_MIN', SignalClient.RECONNECT_MIN),
+        reconnect_max=YJ.get('RECONNECT_MAX', SignalClient.RECONNECT_MAX),
+        inbound_workers=YJ.get('INBOUND_WORKERS', EventDispatcher.WORKERS),
+        inbound_queue_size=YJ.get('INBOUND_QUEUE_SIZE', EventDispatcher.QUEUE_SIZE),
+        json_codec=YJ.get('JSON_CODEC', JsonCodec.AUTO),
+        attachment_dir=YJ.get('ATTACHMENT_DIR', ''),
+        attachment_remote_dir=YJ.get('ATTACHMENT_REMOTE_DIR', ''),
+        attachment_max_size=YJ.get('ATTACHMENT_MAX_SIZE', AttachmentStore.MAX_SIZE),
+        attachment_max_files=YJ.get('ATTACHMENT_MAX_FILES', AttachmentStore.MAX_FILES),
+        fanout_chunk_size=YJ.get('FANOUT_CHUNK_SIZE', FanOut.CHUNK_SIZE),
+        fanout_concurrency=YJ.get('FANOUT_CONCURRENCY', FanOut.CONCURRENCY),
+        fanout_max=YJ.get('FANOUT_MAX', FanOut.MAX_TARGETS),
+        receipt_window=YJ.get('RECEIPT_WINDOW', ReceiptAggregator.WINDOW),
+        receipt_max=YJ.get('RECEIPT_MAX', ReceiptAggregator.MAX_TIMESTAMPS),
+        outbox_path=YJ.get('OUTBOX_PATH', ''),
+        outbox_batch=YJ.get('OUTBOX_BATCH', Outbox.BATCH_MAX),
+        inbound_dedupe_size=YJ.get('INBOUND_DEDUPE_SIZE', SignalClient.INBOUND_DEDUPE_SIZE),
+        inbound_dedupe_ttl=YJ.get('INBOUND_DEDUPE_TTL', SignalClient.INBOUND_DEDUPE_TTL),
+        idempotency_size=YJ.get('IDEMPOTENCY_SIZE', SignalClient.IDEMPOTENCY_SIZE),
+        idempotency_ttl=YJ.get('IDEMPOTENCY_TTL', SignalClient.IDEMPOTENCY_TTL),
+        stream_buffer=YJ.get('STREAM_BUFFER', EventStream.BUFFER_SIZE),
+        stream_policy=YJ.get('STREAM_POLICY', EventStream.POLICIES[0]),
+        stream_max_subscribers=YJ.get('STREAM_MAX_SUBSCRIBERS', EventStream.MAX_SUBSCRIBERS),
+        rest_workers=YJ.get('REST_WORKERS', 0),
+        rest_ipc_path=YJ.get('REST_IPC_PATH', ''),
+        shutdown_timeout=YJ.get('SHUTDOWN_TIMEOUT', AsyncLoop.SHUTDOWN_TIMEOUT),
+        event_loop=YJ.get('EVENT_LOOP', 'asyncio'),
+        loop_lag_interval=YJ.get('LOOP_LAG_INTERVAL', LoopMonitor.LAG_INTERVAL),
+        slow_callback=YJ.get('SLOW_CALLBACK', LoopMonitor.SLOW_CALLBACK),
+        record_path=YJ.get('RECORD_PATH', ''),
+        record_max_bytes=YJ.get('RECORD_MAX_BYTES', TrafficRecorder.MAX_BYTES),
+        record_backups=YJ.get('RECORD_BACKUPS', TrafficRecorder.BACKUPS),
+        directory_refresh=YJ.get('DIRECTORY_REFRESH', ContactDirectory.REFRESH_INTERVAL),
+        directory_max_contacts=YJ.get('DIRECTORY_MAX_CONTACTS', ContactDirectory.MAX_CONTACTS),
+        directory_max_groups=YJ.get('DIRECTORY_MAX_GROUPS', ContactDirectory.MAX_GROUPS),
+        log_level=logging.getLevelName(YJ.get('LOG_LEVEL', 'DEBUG')),
+        log_rate_limit=YJ.get('LOG_DEBUG_RATE', 0),
     )
 
     sc.run_loop()
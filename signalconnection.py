@@ -0,0 +1,159 @@
+from asyncio import Event as a_Event, sleep as a_sleep
+from random import uniform
+
+from signalevent import SignalEvent
+from signalreceivehandler import SignalReceiveHandler
+from signalsendhandler import SignalSendHandler
+
+class SignalConnection:
+    # one signal-cli daemon and the account we send as through it. the
+    # receive/send handlers were written against SignalClient and use
+    # their caller for the transport and shared state, so this offers
+    # the same attributes, passing the shared ones through to the client
+    def __init__(self, client, name, host, port, account, user='', first='', last='',
+                 send_queue_size=SignalSendHandler.QUEUE_SIZE,
+                 send_queue_timeout=SignalSendHandler.QUEUE_TIMEOUT,
+                 send_flush_max=SignalSendHandler.FLUSH_MAX, index=0):
+        self.client = client
+        self.name = name
+        # position in the client's connections, as recorded in the traffic
+        self.index = index
+        self.host = host
+        self.port = port
+        self.account = account
+        self.name_user = user
+        self.name_first = first
+        self.name_last = last
+        self.loop = client.loop
+        self.lgr = client.lgr
+        # resolved when the current signal-cli connection goes away
+        self.disconnect_signal = None
+        self.transport_event = a_Event()
+        # transport will be set once the transport_event occurs
+        self.transport = None
+        self.input = SignalReceiveHandler(self)
+        self.output = SignalSendHandler(self, send_queue_size,
+                                        send_queue_timeout, send_flush_max)
+
+        # health, for /status and picking a connection
+        self.connects = 0
+        self.disconnects = 0
+        self.failures = 0
+        self.last_error = ''
+        self.connected_at = None
+        # outcome (result, error, timeout) -> count
+        self.outcomes = {}
+
+    # shared with the client and every other connection
+    @property
+    def metrics(self):
+        return self.client.metrics
+
+    @property
+    def pending(self):
+        return self.client.pending
+
+    @property
+    def dispatcher(self):
+        return self.client.dispatcher
+
+    @property
+    def receipts(self):
+        return self.client.receipts
+
+    @property
+    def recorder(self):
+        return self.client.recorder
+
+    @property
+    def debug(self):
+        return self.client.debug
+
+    def get_next_sent_id(self):
+        return self.client.get_next_sent_id()
+
+    def acknowledge(self, event):
+        return self.client.acknowledge(event)
+
+    def is_duplicate(self, event):
+        # the same account can be on several daemons, so this is shared too
+        return self.client.is_duplicate(event)
+
+    def is_connected(self):
+        return self.transport is not None
+
+    def get_load(self):
+        # messages waiting to go out plus ones signal-cli hasn't answered
+        return self.output.depth() + len(self.output.inflight)
+
+    def count_outcome(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def get_stats(self):
+        return {
+            'name': self.name,
+            'address': f'{self.host}:{self.port}',
+            'account': self.account,
+            'connected': self.is_connected(),
+            'connected_s': round(self.loop.time() - self.connected_at, 3)
+                           if self.connected_at is not None else None,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'send_queue': self.output.depth(),
+            'inflight': len(self.output.inflight),
+            'writing_paused': self.output.is_paused(),
+            'outcomes': self.outcomes,
+        }
+
+    async def send_raw(self, msg, msg_id=None):
+        await self.output.transmit_message(msg, msg_id=msg_id)
+
+    async def set_account(self):
+        msg = SignalEvent.make_updateprofile(self.account,
+                                             self.name_user,
+                                             self.name_first,
+                                             self.name_last,
+                                             self.get_next_sent_id())
+        await self.send_raw(msg)
+
+    def get_reconnect_delay(self, attempt):
+        # exponential backoff with full jitter, so the first retry after a
+        # daemon restart is quick but a long outage doesn't spin
+        return uniform(0, min(self.client.reconnect_max,
+                              self.client.reconnect_min * 2 ** attempt))
+
+    async def connect_and_receive_loop(self):
+        # keeps the connection to signal-cli up, a daemon restart only
+        # holds outbound messages until we are back
+        attempt = 0
+        while(not self.client.close_signal.done()):
+            self.disconnect_signal = self.loop.create_future()
+            try:
+                transport, protocol = await(self.loop.create_connection(
+                    lambda: self.input, self.host, self.port))
+            except OSError as err:
+                delay = self.get_reconnect_delay(attempt)
+                attempt += 1
+                self.failures += 1
+                self.last_error = str(err)
+                self.lgr.warning(f'connecting to signal-cli {self.name} failed ({err}), retry {attempt} in {delay:.2f}s')
+                await a_sleep(delay)
+                continue
+
+            if(attempt):
+                self.lgr.info(f'reconnected to signal-cli {self.name} after {attempt} retries')
+            attempt = 0
+            self.connects += 1
+            self.connected_at = self.loop.time()
+            # Wait until the protocol signals that the connection
+            # is lost and close the transport.
+            try:
+                exc = await self.disconnect_signal
+                if(exc):
+                    self.last_error = str(exc)
+            finally:
+                transport.close()
+                self.disconnects += 1
+                self.connected_at = None
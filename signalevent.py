@@ -1,6 +1,6 @@
 from pprint import pformat as j_pretty
 from random import randint
-from json import dumps as j_encode
+from jsoncodec import codec
 
 class SignalEvent:
     TYPE_SENT = 1
@@ -15,6 +15,14 @@ class SignalEvent:
         TYPE_ERROR: 'error',
         TYPE_UNKNOWN: 'unknown',
     }
+    # the same as label values and in the api, these don't change
+    TYPE_KEYS = {
+        TYPE_SENT: 'sent',
+        TYPE_RECV: 'received',
+        TYPE_RESULT: 'result',
+        TYPE_ERROR: 'error',
+        TYPE_UNKNOWN: 'unknown',
+    }
     SUBTYPE_MESSAGE = 1
     SUBTYPE_RECEIPT = 2
     SUBTYPE_TYPING = 3
@@ -37,106 +45,187 @@ class SignalEvent:
         RCPTYPE_VIEWED: 'viewed',
         RCPTYPE_UNKNOWN: 'unknown',
     }
+    # typing and receipts go out for every message we get, so they are
+    # filled into prebuilt json instead of building and encoding a dict
+    TYPING_TEMPLATE = (b'{"jsonrpc":"2.0","method":"sendTyping","params":'
+                       b'{"account":%b,"recipient":%b},"id":%d}')
+    RECEIPT_TEMPLATE = (b'{"jsonrpc":"2.0","method":"sendReceipt","params":'
+                        b'{"account":%b,"recipient":%b,"targetTimestamp":%b},"id":%d}')
+
+    # events are created for every line signal-cli sends, most of which
+    # (typing, receipts) are looked at once and thrown away, so only the
+    # type/subtype is worked out up front and the rest is read from the
+    # json when it is asked for
+    __slots__ = ('json', 'send_cb', 'sent_id_cb', 'connection', 'type',
+                 'subtype', 'id', 'envelope', 'data')
 
-    def __init__(self, json_obj, send_cb, sent_id_cb):
+    def __init__(self, json_obj, send_cb, sent_id_cb, connection=None):
         self.json = json_obj
         self.send_cb = send_cb
         self.sent_id_cb = sent_id_cb
+        # the SignalConnection it arrived on, replies go back through it
+        self.connection = connection
         # event is one of these types:
         self.type = SignalEvent.TYPE_UNKNOWN
 
         # if sent or recv then one of these types:
         self.subtype = SignalEvent.SUBTYPE_UNKNOWN
 
-        # if this is a result
-        self.has_results = False
-        self.results = []
-
-        # if message, it may have one or more of these attrs
-        self.has_message = False
-        self.has_reply = False
-        self.has_reaction = False
-        self.has_attachment = False
-
-        # actual pieces of info
         self.id = 0
-        self.sender = ''
-        self.sender_name = ''
-        self.sender_uuid = ''
-
-        self.recipient = ''
-        self.timestamp = 0
-        self.message = ''
-        self.re_timestamp = 0
+        # envelope of a sent/recv event, and its dataMessage if a message
+        self.envelope = None
+        self.data = None
 
         if('result' in json_obj):
             self.type = SignalEvent.TYPE_RESULT
             self.id = json_obj['id']
-            if('results' in json_obj['result']):
-                self.results = json_obj['result']['results']
         elif('error' in json_obj):
             self.type = SignalEvent.TYPE_ERROR
             self.id = json_obj['id']
-            self.has_message = True
-            self.message = json_obj['error']['message']
-            if('data' in json_obj['error'] and
-               json_obj['error']['data'] and
-               'response' in json_obj['error']['data'] and
-               json_obj['error']['data']['response'] and
-               'results' in json_obj['error']['data']['response']):
-                self.results = json_obj['error']['data']['response']['results']
         else:
-            if('method' in json_obj):
-                if(json_obj['method'] == 'send'):
-                    self.type = SignalEvent.TYPE_SENT
-                elif(json_obj['method'] == 'receive'):
-                    self.type = SignalEvent.TYPE_RECV
-
-        if(self.type == SignalEvent.TYPE_SENT or
-           self.type == SignalEvent.TYPE_RECV):
-            if('params' in json_obj and
-               'account' in json_obj['params'] and
-               'envelope' in json_obj['params'] and
-               'source' in  json_obj['params']['envelope']):
-                self.recipient = json_obj['params']['account']
-                envelope = json_obj['params']['envelope']
-                self.sender = envelope['source']
-                self.sender_name = envelope['sourceName']
-                self.sender_uuid = envelope['sourceUuid']
-
-                if('typingMessage' in envelope):
-                    self.subtype = SignalEvent.SUBTYPE_TYPING
-                elif('receiptMessage' in envelope):
-                    self.subtype = SignalEvent.SUBTYPE_RECEIPT
-                elif('syncMessage' in envelope):
-                    self.subtype = SignalEvent.SUBTYPE_SYNC
-                elif('dataMessage' in envelope):
-                    self.subtype = SignalEvent.SUBTYPE_MESSAGE
-                    dm = envelope['dataMessage']
-                    if('message' in dm and dm['message'] != None):
-                        self.has_message = True
-                        self.message = dm['message']
-                    if('quote' in dm):
-                        self.has_reply = True
-                        self.re_timestamp = dm['quote']['id']
-                    if('reaction' in dm):
-                        self.has_reaction = True
-                        self.message = dm['reaction']['emoji']
-                        self.re_timestamp = dm['reaction']['targetSentTimestamp']
-                    ##TODO attachment
-
-                self.timestamp = envelope['timestamp']
+            method = json_obj.get('method')
+            if(method == 'send'):
+                self.type = SignalEvent.TYPE_SENT
+            elif(method == 'receive'):
+                self.type = SignalEvent.TYPE_RECV
+            else:
+                return
+
+            params = json_obj.get('params')
+            if(params and 'account' in params):
+                envelope = params.get('envelope')
+                if(envelope and 'source' in envelope):
+                    self.envelope = envelope
+                    if('typingMessage' in envelope):
+                        self.subtype = SignalEvent.SUBTYPE_TYPING
+                    elif('receiptMessage' in envelope):
+                        self.subtype = SignalEvent.SUBTYPE_RECEIPT
+                    elif('syncMessage' in envelope):
+                        self.subtype = SignalEvent.SUBTYPE_SYNC
+                    elif('dataMessage' in envelope):
+                        self.subtype = SignalEvent.SUBTYPE_MESSAGE
+                        self.data = envelope['dataMessage']
+
+    # if this is a result
+    @property
+    def results(self):
+        if(self.type == SignalEvent.TYPE_RESULT):
+            result = self.json['result']
+            if(result and 'results' in result):
+                return result['results']
+        elif(self.type == SignalEvent.TYPE_ERROR):
+            data = self.json['error'].get('data')
+            if(data and data.get('response') and 'results' in data['response']):
+                return data['response']['results']
+        return []
+
+    @property
+    def has_results(self):
+        return len(self.results) > 0
+
+    # actual pieces of info
+    @property
+    def sender(self):
+        return self.envelope['source'] if self.envelope else ''
+
+    @property
+    def sender_name(self):
+        return self.envelope.get('sourceName') or '' if self.envelope else ''
+
+    @property
+    def sender_uuid(self):
+        return self.envelope.get('sourceUuid') or '' if self.envelope else ''
+
+    @property
+    def recipient(self):
+        return self.json['params']['account'] if self.envelope else ''
+
+    @property
+    def timestamp(self):
+        return self.envelope.get('timestamp', 0) if self.envelope else 0
+
+    @property
+    def group_id(self):
+        if(self.data):
+            group = self.data.get('groupInfo')
+            return group.get('groupId') or '' if group else ''
+        if(self.subtype == SignalEvent.SUBTYPE_TYPING):
+            return self.envelope['typingMessage'].get('groupId') or ''
+        return ''
+
+    # if message, it may have one or more of these attrs
+    @property
+    def has_message(self):
+        if(self.type == SignalEvent.TYPE_ERROR):
+            return True
+        return self.data is not None and self.data.get('message') is not None
+
+    @property
+    def has_reply(self):
+        return self.data is not None and 'quote' in self.data
+
+    @property
+    def has_reaction(self):
+        return self.data is not None and 'reaction' in self.data
+
+    @property
+    def has_attachment(self):
+        return self.data is not None and len(self.data.get('attachments') or []) > 0
+
+    @property
+    def attachments(self):
+        # signal-cli's metadata for each file (contentType, filename, id,
+        # size, ...), the files are in its data directory under attachments/id
+        if(self.data is None):
+            return []
+        return self.data.get('attachments') or []
+
+    @property
+    def message(self):
+        if(self.type == SignalEvent.TYPE_ERROR):
+            return self.json['error']['message']
+        if(self.data is None):
+            return ''
+        if('reaction' in self.data):
+            return self.data['reaction']['emoji']
+        return self.data.get('message') or ''
+
+    @property
+    def dedupe_key(self):
+        # what an envelope is recognised by when signal-cli delivers it again
+        if(self.envelope is None):
+            return None
+        return (self.json['params']['account'], self.envelope.get('sourceUuid') or
+                self.envelope['source'], self.envelope.get('timestamp', 0), self.subtype)
+
+    @property
+    def re_timestamp(self):
+        if(self.data is None):
+            return 0
+        if('reaction' in self.data):
+            return self.data['reaction']['targetSentTimestamp']
+        if('quote' in self.data):
+            return self.data['quote']['id']
+        return 0
 
     async def reply(self, msg_text):
-        msg = SignalEvent.make_typing(self.recipient, self.sender, msg_id=self.sent_id_cb())
-        await self.send_cb(msg)
+        msg_id = self.sent_id_cb()
+        msg = SignalEvent.make_typing(self.recipient, self.sender, msg_id=msg_id)
+        await self.send_cb(msg, msg_id)
         #TODO maybe need to change recipient in groups
-        msg = SignalEvent.make_message(self.recipient, self.sender, msg_text, msg_id=self.sent_id_cb())
-        await self.send_cb(msg)
+        msg_id = self.sent_id_cb()
+        msg = SignalEvent.make_message(self.recipient, self.sender, msg_text, msg_id=msg_id)
+        await self.send_cb(msg, msg_id)
 
     async def ack_receipt(self):
-        msg = SignalEvent.make_receipt(self.recipient, self.sender, self.timestamp, msg_id=self.sent_id_cb())
-        await self.send_cb(msg)
+        # coalesced with the other receipts going to the sender
+        if(self.connection is not None):
+            await self.connection.receipts.add(self.recipient, self.sender, self.timestamp,
+                                               self.connection)
+            return
+        msg_id = self.sent_id_cb()
+        msg = SignalEvent.make_receipt(self.recipient, self.sender, self.timestamp, msg_id=msg_id)
+        await self.send_cb(msg, msg_id)
 
     def get_type(self):
         return self.type
@@ -168,8 +257,9 @@ class SignalEvent:
     def __str__(self):
         ret = '['+SignalEvent.TYPES[self.type]+']'
         if(self.type == SignalEvent.TYPE_RESULT):
+            # results are logged for every request, so keep them on one line
             ret += ' id="'+str(self.id)+'"'
-            ret += '\n'+j_pretty(self.json)
+            ret += ' result='+str(self.json['result'])
         elif(self.type == SignalEvent.TYPE_ERROR):
             ret += ' id="'+str(self.id)+'"'
             ret += ' msg="'+self.message+'"'
@@ -190,7 +280,9 @@ class SignalEvent:
                ret += ' reply_ts="'+str(self.re_timestamp)+'"'
             if(self.subtype == SignalEvent.SUBTYPE_RECEIPT):
                ret += ' type="'+self.get_receipt_type_str()+'"'
-            ##TODO attachment
+            if(self.has_attachment):
+               ret += ' attachments="'+','.join(str(a.get('filename') or a.get('id'))
+                                                for a in self.attachments)+'"'
             # ret += '\n'+j_pretty(self.json)
         return ret
 
@@ -218,7 +310,7 @@ class SignalEvent:
         else:
             ret['params']['recipients'] = recipients
 
-        return j_encode(ret)
+        return codec.encode(ret)
 
     @staticmethod
     def make_updateprofile(sender, user_n, given_n='', family_n='', msg_id=randint(1, 5000)):
@@ -236,31 +328,45 @@ class SignalEvent:
                 },
                 "id": msg_id
             }
-        return j_encode(ret)
+        return codec.encode(ret)
 
     @staticmethod
-    def make_typing(sender, recipient, msg_id=randint(1, 5000)):
+    def make_listcontacts(sender, msg_id=randint(1, 5000)):
         ret = {
                 "jsonrpc": "2.0",
-                "method": "sendTyping",
+                "method": "listContacts",
                 "params": {
                     "account": sender,
-                    "recipient": recipient,
                 },
                 "id": msg_id
             }
-        return j_encode(ret)
+        return codec.encode(ret)
 
     @staticmethod
-    def make_receipt(sender, recipient, timestamp, msg_id=randint(1, 5000)):
+    def make_listgroups(sender, msg_id=randint(1, 5000)):
         ret = {
                 "jsonrpc": "2.0",
-                "method": "sendReceipt",
+                "method": "listGroups",
                 "params": {
                     "account": sender,
-                    "recipient": recipient,
-                    "targetTimestamp": timestamp,
                 },
                 "id": msg_id
             }
-        return j_encode(ret)
+        return codec.encode(ret)
+
+    @staticmethod
+    def make_typing(sender, recipient, msg_id=randint(1, 5000)):
+        return SignalEvent.TYPING_TEMPLATE % (codec.quote(sender),
+                                              codec.quote(recipient),
+                                              msg_id)
+
+    @staticmethod
+    def make_receipt(sender, recipient, timestamp, msg_id=randint(1, 5000)):
+        if(type(timestamp) is int):
+            timestamp = b'%d' % timestamp
+        else:
+            timestamp = codec.encode(timestamp)
+        return SignalEvent.RECEIPT_TEMPLATE % (codec.quote(sender),
+                                               codec.quote(recipient),
+                                               timestamp,
+                                               msg_id)
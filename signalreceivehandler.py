@@ -1,16 +1,19 @@
-from asyncio import Protocol as a_Protocol, create_task as a_create_task
-from json import loads as j_decode
+from asyncio import Protocol as a_Protocol
 from pprint import pformat as j_pretty
-from json.decoder import JSONDecodeError
+from jsoncodec import codec, DecodeError
+from jsonlineframer import JsonLineFramer
 from signalevent import SignalEvent
 
 class SignalReceiveHandler(a_Protocol):
     def __init__(self, caller):
         self.caller = caller
-        self.json_buffer = ''
+        self.framer = JsonLineFramer(overflow_cb=self.line_overflow)
 
     def connection_made(self, transport):
+        # the same protocol is reused for every reconnect
+        self.framer.reset()
         self.caller.transport = transport
+        self.caller.output.connection_made(transport)
         self.caller.transport_event.set()
         self.caller.lgr.debug('transport connected');
 
@@ -38,48 +41,56 @@ class SignalReceiveHandler(a_Protocol):
     #     }
     #  }
     def data_received(self, data):
-        raw = data.decode()
+        # the framer only hands back complete lines, so a message split
+        # across reads (even mid utf-8 character) is held until it is whole
+        lines = self.framer.feed(data)
+        if(self.caller.recorder is not None and lines):
+            self.caller.recorder.record_received(self.caller.index, lines)
+        for line in lines:
+            try:
+                ret = codec.decode(line)
+            except DecodeError as e:
+                self.caller.lgr.error('json err: %s, raw:\n%r', e, line)
+                continue
 
-        # check to make sure we are at the end of
-        # json transmission, if we aren't, buffer
-        if(raw[len(raw) - 1] != '\n'):
-            # we need to save this
-            # self.caller.lgr.info('buffering json:\n\t'+self.json_buffer+'\n\twith:\n\t'+raw)
-            self.json_buffer += raw;
-            return
-        else:
-            # otherwise, let more forward and clear the buffer
-            if(self.json_buffer != ''):
-                raw = self.json_buffer + raw
-                self.json_buffer = ''
+            if(self.caller.debug):
+               self.caller.lgr.debug("\n"+j_pretty(ret))
 
-        if(len(raw) <= 1):
-            # sometimes we just get return characters
-            # so when we do, ignore it
-            return
+            event = SignalEvent(ret, self.caller.send_raw, self.caller.get_next_sent_id,
+                                self.caller)
+            self.caller.metrics.events_received.inc((SignalEvent.TYPE_KEYS[event.type],
+                                                     SignalEvent.SUBTYPES[event.subtype]))
+            if(event.type == SignalEvent.TYPE_RESULT or event.type == SignalEvent.TYPE_ERROR):
+                # answers to our requests are matched up right here, they
+                # never wait behind inbound events
+                self.caller.acknowledge(event)
+                continue
+            if(self.caller.is_duplicate(event)):
+                continue
+            # handled by the dispatcher's workers, in order per conversation
+            self.caller.dispatcher.dispatch(event)
 
-        try:
-            #sometimes we get multiple messages
-            raws = raw.split('\n')
-            for cmd in raws:
-                # the 2nd val in cmd can be an empty value if it was a normal
-                # message with just a json and a return vs json, return, json
-                if(cmd):
-                    ret = j_decode(cmd);
-                    if(self.caller.debug):
-                       self.caller.lgr.debug("\n"+j_pretty(ret))
+    def line_overflow(self, size):
+        self.caller.lgr.error(f'dropping json line over {self.framer.max_line} bytes ({size} bytes buffered)')
 
-                    self.caller.loop.create_task(self.caller.receive_handler(SignalEvent(ret, self.caller.send_raw, self.caller.get_next_sent_id)))
-        except JSONDecodeError as e:
-            self.caller.lgr.error('json err: '+str(e)+", raw:\n"+ j_pretty(raw))
+    # the transport's write buffer is over its high water mark, let the
+    # send handler hold messages in its own bounded queue until it drains
+    def pause_writing(self):
+        self.caller.output.pause_writing()
+
+    def resume_writing(self):
+        self.caller.output.resume_writing()
 
     def eof_received(self):
+        # returning nothing lets the transport close, connection_lost follows
         self.caller.lgr.warning('signal-cli daemon signaled no more data')
-        if(self.caller.close_signal and not (self.caller.close_signal.done() or self.caller.close_signal.cancelled())):
-                self.caller.close_signal.set_result(True)
 
     def connection_lost(self, exc):
-        self.caller.lgr.error('signal-cli daemon connection was closed')
-        if(self.caller.close_signal and not (self.caller.close_signal.done() or self.caller.close_signal.cancelled())):
-            self.caller.close_signal.set_result(True)
-        a_create_task(self.caller.shutdown())
+        self.caller.lgr.error(f'signal-cli daemon connection {self.caller.name} was closed')
+        # hold everything outbound until connect_and_receive_loop reconnects,
+        # pending requests keep waiting and get replayed
+        self.caller.transport_event.clear()
+        self.caller.transport = None
+        self.caller.output.connection_lost()
+        if(self.caller.disconnect_signal and not self.caller.disconnect_signal.done()):
+            self.caller.disconnect_signal.set_result(exc)
@@ -1,21 +1,204 @@
+from asyncio import (Event as a_Event, Queue as a_Queue, QueueFull as a_QueueFull,
+                     wait_for as a_wait_for, TimeoutError as a_TimeoutError)
+
+class SendQueueFull(Exception):
+    pass
+
+class NotWritten(a_TimeoutError):
+    # timed out before it was ever written to signal-cli, and never will be
+    pass
+
 class SignalSendHandler:
+    # messages waiting to be written to signal-cli
+    QUEUE_SIZE = 10000
+    # seconds a sender waits for room in a full queue, 0 fails right away
+    QUEUE_TIMEOUT = 0
+    # most messages coalesced into a single socket write
+    FLUSH_MAX = 500
 
-    def __init__(self, caller):
+    def __init__(self, caller, queue_size=QUEUE_SIZE,
+                 queue_timeout=QUEUE_TIMEOUT, flush_max=FLUSH_MAX):
         self.caller = caller
-        self.first_time = True
+        self.queue = a_Queue(queue_size)
+        self.queue_timeout = queue_timeout
+        self.flush_max = flush_max
+        # cleared while the transport asks us to stop writing
+        self.can_write = a_Event()
+        self.can_write.set()
+        # json-rpc id -> (encoded message, loop time written), for everything
+        # written to signal-cli that has not been answered yet. if the
+        # connection drops these are written again once it is back
+        self.inflight = {}
+        self.inflight_max = queue_size
+        # ids of requests queued and not written yet. a cancelled one is
+        # taken out, and the writer drops queued messages whose id is gone
+        self.queued = set()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def is_paused(self):
+        return not self.can_write.is_set()
+
+    # called from the protocol when the transport buffer
+    # crosses its high/low water marks
+    def pause_writing(self):
+        self.caller.lgr.warning(f'signal-cli is not keeping up, pausing writes with {self.depth()} queued')
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.caller.lgr.info('resuming writes to signal-cli')
+        self.can_write.set()
+
+    def cancel(self, msg_id):
+        # returns False if it has been written already, or was never queued
+        if(msg_id not in self.queued):
+            return False
+        self.queued.discard(msg_id)
+        return True
+
+    def acknowledge(self, msg_id):
+        # signal-cli answered (or the caller gave up), no need to replay it.
+        # returns when it was written, if it was
+        sent = self.inflight.pop(msg_id, None)
+        return sent[1] if sent else None
+
+    def connection_made(self, transport):
+        # a new transport starts out writable, and whatever the last one
+        # lost goes out before anything else that is queued
+        self.can_write.set()
+        if(self.inflight):
+            self.caller.lgr.info(f'replaying {len(self.inflight)} unanswered requests')
+            msgs = [msg for msg, written in self.inflight.values()]
+            if(self.caller.recorder is not None):
+                self.caller.recorder.record_sent(self.caller.index, msgs)
+            transport.write(b''.join(msgs))
 
-    async def transmit_message(self, json):
-        # before we can send, we need to make sure the
-        #  we are connected to signal-cli
-        if(self.first_time):
+    def connection_lost(self):
+        # the writer will wait on the transport_event, not the old pause
+        self.can_write.set()
+
+    async def wait_for_transport(self):
+        # before we can send, we need to make sure the we are connected to
+        # signal-cli, and that it is keeping up with what we already sent
+        while(not (self.caller.transport_event.is_set() and self.can_write.is_set())):
             await self.caller.transport_event.wait()
-            self.first_time = False
+            await self.can_write.wait()
+
+    async def transmit_message(self, json, block=False, msg_id=None):
+        # messages come encoded from the SignalEvent.make_* builders
+        if(type(json) is str):
+            json = json.encode('utf-8')
+        # all messages are delimited by return, only messages with
+        # an id are replayed after a reconnect
+        msg = (msg_id, json + b"\n")
+        # before the put, so a request given up on while it waits for room
+        # is known to be unwritten and dropped when it gets in
+        if(msg_id is not None):
+            self.queued.add(msg_id)
+
+        try:
+            if(block):
+                await self.queue.put(msg)
+            elif(self.queue_timeout > 0):
+                await a_wait_for(self.queue.put(msg), self.queue_timeout)
+            else:
+                self.queue.put_nowait(msg)
+        except (a_QueueFull, a_TimeoutError):
+            self.queued.discard(msg_id)
+            raise SendQueueFull(f'send queue is full ({self.queue.maxsize} messages)')
+        except BaseException:
+            self.queued.discard(msg_id)
+            raise
+
+        self.caller.lgr.debug("queued: %s", json)
+
+    def add_write(self, msgs, msg_id, msg, now):
+        if(msg_id is not None):
+            if(msg_id not in self.queued):
+                return
+            self.queued.discard(msg_id)
+            self.mark_written(msg_id, msg, now)
+        msgs.append(msg)
+
+    def mark_written(self, msg_id, msg, now):
+        self.inflight[msg_id] = (msg, now)
+        start = self.caller.pending.get_start(msg_id)
+        if(start is not None):
+            self.caller.metrics.rest_to_socket.observe(now - start)
+
+    @staticmethod
+    def get_labels(msg):
+        # (json-rpc method, group or direct) of an encoded message. the
+        # builders put the method up front and encode compactly. a quote in
+        # the message text is always escaped, so ,"key": is only ever a key
+        start = msg.find(b'"method":"')
+        if(start < 0):
+            return ('unknown', 'none')
+        start += 10
+        method = msg[start:msg.find(b'"', start)].decode('utf-8', 'replace')
+        if(msg.find(b',"groupId":') >= 0):
+            return (method, 'group')
+        if(msg.find(b',"recipients":') >= 0 or msg.find(b',"recipient":') >= 0):
+            return (method, 'direct')
+        return (method, 'none')
+
+    def count_sent(self, msgs):
+        counts = {}
+        for msg in msgs:
+            labels = self.get_labels(msg)
+            counts[labels] = counts.get(labels, 0) + 1
+        for labels, count in counts.items():
+            self.caller.metrics.messages_sent.inc(labels, count)
+
+    def get_buffer_size(self):
+        transport = self.caller.transport
+        return transport.get_write_buffer_size() if transport else 0
+
+    def write_queued(self):
+        # at shutdown, writes out whatever is queued without waiting on
+        # the writer loop, if there is a connection to write to
+        transport = self.caller.transport
+        if(transport is None or self.queue.empty()):
+            return 0
+        msgs = []
+        now = self.caller.loop.time()
+        while(not self.queue.empty()):
+            msg_id, msg = self.queue.get_nowait()
+            self.add_write(msgs, msg_id, msg, now)
+        if(not msgs):
+            return 0
+        if(self.caller.recorder is not None):
+            self.caller.recorder.record_sent(self.caller.index, msgs)
+        transport.write(b''.join(msgs))
+        self.count_sent(msgs)
+        return len(msgs)
 
-        # all messages are delimited by return
-        msg = json + "\n"
+    async def writer_loop(self):
+        # the only place that writes to the transport, so backpressure
+        # from signal-cli ends up as a full queue instead of unbounded
+        # memory in the transport buffer
+        while True:
+            msg_id, msg = await self.queue.get()
+            # during an outage messages are held here until we reconnect
+            await self.wait_for_transport()
 
-        self.caller.lgr.debug(f"sent: {json}")
+            # coalesce whatever else is already waiting into the same write
+            now = self.caller.loop.time()
+            msgs = []
+            self.add_write(msgs, msg_id, msg, now)
+            while(len(msgs) < self.flush_max and not self.queue.empty()):
+                msg_id, msg = self.queue.get_nowait()
+                self.add_write(msgs, msg_id, msg, now)
+            if(not msgs):
+                continue
 
-        # send the message
-        self.caller.transport.write(msg.encode('utf-8'))
+            # requests signal-cli never answered can't pile up forever
+            while(len(self.inflight) > self.inflight_max):
+                del self.inflight[next(iter(self.inflight))]
 
+            if(self.caller.recorder is not None):
+                self.caller.recorder.record_sent(self.caller.index, msgs)
+            self.caller.transport.write(b''.join(msgs))
+            self.count_sent(msgs)
+            self.caller.lgr.debug("sent %d messages in one write", len(msgs))
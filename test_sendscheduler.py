@@ -0,0 +1,128 @@
+import unittest
+
+from sendscheduler import SendScheduler
+from signalsendhandler import SendQueueFull
+
+# python -m unittest test_sendscheduler
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class SendSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make(self, **kwargs):
+        return SendScheduler(clock=self.clock, **kwargs)
+
+    def drain(self, scheduler, until):
+        # pops everything that can go out before until, advancing the clock
+        # as the scheduler says to. returns [(time sent, item)]
+        sent = []
+        while(self.clock.now <= until):
+            item, wait = scheduler.pop()
+            if(item is not None):
+                sent.append((self.clock.now, item))
+            elif(wait is None):
+                break
+            else:
+                self.clock.now += wait
+        return sent
+
+    def test_rate(self):
+        scheduler = self.make(rate=10, burst=5)
+        for i in range(100):
+            scheduler.push(f'+1{i:03}', i)
+        sent = self.drain(scheduler, 2.0)
+        # the burst right away, then one every 1/rate seconds
+        self.assertEqual([t for t, item in sent[:5]], [0.0] * 5)
+        self.assertEqual(len(sent), 5 + 20)
+        for (a, _), (b, _) in zip(sent[5:], sent[6:]):
+            self.assertAlmostEqual(b - a, 0.1)
+        self.assertEqual(len(scheduler), 75)
+
+    def test_unlimited(self):
+        scheduler = self.make()
+        for i in range(1000):
+            scheduler.push('+1000', i)
+        sent = self.drain(scheduler, 0)
+        self.assertEqual([item for t, item in sent], list(range(1000)))
+        self.assertEqual(self.clock.now, 0)
+
+    def test_priority(self):
+        scheduler = self.make(rate=1, burst=1)
+        scheduler.push('+1000', 'digest', SendScheduler.PRIORITY_DIGEST)
+        scheduler.push('+1001', 'normal', SendScheduler.PRIORITY_NORMAL)
+        scheduler.push('+1002', 'alert', SendScheduler.PRIORITY_ALERT)
+        scheduler.push('+1003', 'alert 2', SendScheduler.PRIORITY_ALERT)
+        sent = self.drain(scheduler, 10)
+        self.assertEqual([item for t, item in sent], ['alert', 'alert 2', 'normal', 'digest'])
+
+    def test_priority_names(self):
+        self.assertEqual(SendScheduler.get_priority(None), SendScheduler.PRIORITY_NORMAL)
+        self.assertEqual(SendScheduler.get_priority('alert'), SendScheduler.PRIORITY_ALERT)
+        self.assertEqual(SendScheduler.get_priority(2), SendScheduler.PRIORITY_DIGEST)
+        for priority in ('urgent', 7, 1.0):
+            with self.assertRaises(KeyError):
+                SendScheduler.get_priority(priority)
+
+    def test_fairness(self):
+        # a big fan-out to one recipient doesn't hold up everybody else
+        scheduler = self.make()
+        for i in range(100):
+            scheduler.push('+1000', ('big', i))
+        for i in range(3):
+            scheduler.push(f'+200{i}', ('other', i))
+        sent = [item for t, item in self.drain(scheduler, 0)]
+        self.assertEqual(len(sent), 103)
+        # one each per round
+        self.assertEqual(sent[:5], [('big', 0), ('other', 0), ('other', 1), ('other', 2),
+                                    ('big', 1)])
+        # and each recipient's messages keep their order
+        self.assertEqual([i for kind, i in sent if kind == 'big'], list(range(100)))
+
+    def test_recipient_rate(self):
+        scheduler = self.make(recipient_rate=2, recipient_burst=1)
+        for i in range(10):
+            scheduler.push('+1000', ('slow', i))
+        scheduler.push('+2000', ('other', 0))
+        sent = self.drain(scheduler, 2.0)
+        slow = [t for t, (kind, i) in sent if kind == 'slow']
+        self.assertEqual(len(slow), 5)
+        for a, b in zip(slow, slow[1:]):
+            self.assertAlmostEqual(b - a, 0.5)
+        # the throttled recipient doesn't hold up the other one
+        self.assertIn((0.0, ('other', 0)), sent)
+
+    def test_recipient_rate_several_recipients(self):
+        # a message to several recipients is charged to each of them
+        scheduler = self.make(recipient_rate=1, recipient_burst=1)
+        scheduler.push('+1000', 'one')
+        scheduler.push(SendScheduler.get_key(['+2000', '+1000']), 'both')
+        scheduler.push('+2000', 'two')
+        sent = self.drain(scheduler, 5)
+        self.assertEqual(sent, [(0.0, 'one'), (0.0, 'two'), (1.0, 'both')])
+
+    def test_get_key(self):
+        self.assertEqual(SendScheduler.get_key('+1000'), '+1000')
+        self.assertEqual(SendScheduler.get_key(['+1000']), '+1000')
+        self.assertEqual(SendScheduler.get_key(['+2000', '+1000', '+2000']), ('+1000', '+2000'))
+        self.assertEqual(SendScheduler.get_key(['+1000', 1000]), ('+1000', '1000'))
+
+    def test_full(self):
+        scheduler = self.make(rate=1, queue_size=3)
+        for i in range(3):
+            scheduler.push('+1000', i)
+        with self.assertRaises(SendQueueFull):
+            scheduler.push('+1001', 3)
+        self.assertEqual(len(scheduler), 3)
+        # room again once something has gone out
+        self.assertEqual(scheduler.pop(), (0, 0))
+        scheduler.push('+1001', 3)
+        self.assertEqual(len(scheduler), 3)
+
+if __name__ == '__main__':
+    unittest.main()
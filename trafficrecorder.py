@@ -0,0 +1,194 @@
+import argparse
+import os
+from queue import SimpleQueue, Empty
+import struct
+import sys
+from threading import Thread
+
+class TrafficRecorder:
+    # every file starts with this
+    MAGIC = b'SIGREC2\n'
+    # then a header per line: monotonic seconds, direction, connection
+    # index and line length, followed by the line as it was on the wire
+    # (without its return)
+    HEADER = struct.Struct('<dBHI')
+    RECEIVED = 0
+    SENT = 1
+    DIRECTIONS = ('<', '>')
+    # bytes in a file before it is rotated, and rotated files kept
+    MAX_BYTES = 64 * 1024 * 1024
+    BACKUPS = 5
+    # batches of lines waiting on the writer before new ones are dropped
+    QUEUE_MAX = 10000
+
+    # records every json-rpc line to and from signal-cli, for replaying an
+    # incident later (see benchmark.py replay). the loop only puts the
+    # lines it already has on a queue, packing and writing them happens on
+    # a thread. files are rotated like the logs, path.1 being the newest
+    # of the old ones
+    def __init__(self, caller, path, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.caller = caller
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = SimpleQueue()
+        self.thread = None
+
+        # stats for /status
+        self.records = 0
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+    def start(self):
+        # opened here so a bad path fails at startup. every run starts a
+        # file of its own, the loop clock isn't comparable across runs
+        if(os.path.exists(self.path) and os.path.getsize(self.path)):
+            self.rotate()
+        out = self.open()
+        self.thread = Thread(target=self.writer_loop, args=(out,),
+                             name='recorder', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # writes out everything queued before returning
+        if(self.thread):
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def open(self):
+        out = open(self.path, 'wb')
+        out.write(TrafficRecorder.MAGIC)
+        return out
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if(os.path.exists(f'{self.path}.{i}')):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if(self.backups > 0):
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def record(self, direction, connection, lines):
+        if(self.queue.qsize() >= self.QUEUE_MAX):
+            self.dropped += len(lines)
+            return
+        self.records += len(lines)
+        self.queue.put((self.caller.loop.time(), direction, connection, lines))
+
+    def record_received(self, connection, lines):
+        # lines as the framer hands them back
+        self.record(TrafficRecorder.RECEIVED, connection, lines)
+
+    def record_sent(self, connection, msgs):
+        # messages as they are written, each with its return
+        self.record(TrafficRecorder.SENT, connection, msgs)
+
+    def writer_loop(self, out):
+        pack = TrafficRecorder.HEADER.pack
+        while True:
+            item = self.queue.get()
+            items = [item]
+            # whatever else piled up goes out in the same write
+            while(item is not None):
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+                items.append(item)
+
+            chunk = bytearray()
+            size = out.tell()
+            for item in items:
+                if(item is None):
+                    break
+                now, direction, connection, lines = item
+                for line in lines:
+                    if(line.endswith(b'\n')):
+                        line = line[:-1]
+                    chunk += pack(now, direction, connection, len(line))
+                    chunk += line
+                if(size + len(chunk) >= self.max_bytes):
+                    out = self.write(out, chunk, True)
+                    size = out.tell()
+                    chunk = bytearray()
+            out = self.write(out, chunk, False)
+            if(items[-1] is None):
+                break
+        out.close()
+
+    def write(self, out, chunk, rotate):
+        try:
+            out.write(chunk)
+            out.flush()
+            self.written += len(chunk)
+            if(rotate):
+                out.close()
+                self.rotate()
+                out = self.open()
+        except OSError as e:
+            self.caller.lgr.error('recording %d bytes failed: %s', len(chunk), e)
+        return out
+
+    def get_stats(self):
+        return {
+            'path': self.path,
+            'records': self.records,
+            'written_bytes': self.written,
+            'dropped': self.dropped,
+            'rotations': self.rotations,
+        }
+
+    @staticmethod
+    def get_files(path):
+        # a recording and its rotated files, oldest first
+        files = []
+        i = 1
+        while(os.path.exists(f'{path}.{i}')):
+            files.insert(0, f'{path}.{i}')
+            i += 1
+        if(os.path.exists(path)):
+            files.append(path)
+        return files
+
+    @staticmethod
+    def read(path):
+        # (loop time, direction, connection, line) for every line in a file
+        size = TrafficRecorder.HEADER.size
+        unpack = TrafficRecorder.HEADER.unpack_from
+        with open(path, 'rb') as f:
+            data = f.read()
+        if(not data.startswith(TrafficRecorder.MAGIC)):
+            raise ValueError(f'{path} is not a traffic recording')
+        pos = len(TrafficRecorder.MAGIC)
+        while(pos + size <= len(data)):
+            now, direction, connection, length = unpack(data, pos)
+            pos += size
+            if(pos + length > len(data)):
+                # cut off by a crash, the rest of the file is lost
+                break
+            yield now, direction, connection, data[pos:pos + length]
+            pos += length
+
+def main():
+    parser = argparse.ArgumentParser(description='print a signal-cli traffic recording')
+    parser.add_argument('path', help='RECORD_PATH, its rotated files are read too')
+    parser.add_argument('--received', action='store_true', help='only lines from signal-cli')
+    args = parser.parse_args()
+
+    start = None
+    for path in TrafficRecorder.get_files(args.path):
+        for now, direction, connection, line in TrafficRecorder.read(path):
+            if(args.received and direction != TrafficRecorder.RECEIVED):
+                continue
+            if(start is None):
+                start = now
+            sys.stdout.write(f'{now - start:12.6f} {connection} '
+                             f'{TrafficRecorder.DIRECTIONS[direction]} '
+                             f'{line.decode("utf-8", "replace")}\n')
+
+if __name__ == '__main__':
+    main()